@@ -63,7 +63,7 @@ async def health_check():
     from utils.chat_system_init import get_chat_system
     
     chat_system = get_chat_system()
-    system_status = chat_system.get_system_status()
+    system_status = await chat_system.get_system_status()
     
     return {
         "status": "healthy" if system_status["status"] == "running" else "unhealthy",
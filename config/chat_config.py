@@ -0,0 +1,67 @@
+"""
+Конфигурация состояния чата поддержки (очередь, операторы, назначения)
+"""
+import os
+import socket
+
+from config.constants import DEV_CONSTANT
+
+
+class ChatStateBackend:
+    """Хранилища состояния очереди поддержки"""
+
+    MEMORY = "memory"  # состояние в памяти процесса (один экземпляр приложения)
+    REDIS = "redis"    # общее состояние в Redis (горизонтальное масштабирование)
+
+
+# Где хранить состояние очереди: memory | redis
+CHAT_STATE_BACKEND = os.getenv('CHAT_STATE_BACKEND', ChatStateBackend.MEMORY).lower()
+
+# Подключение к Redis для состояния очереди
+CHAT_STATE_REDIS_URL = os.getenv('CHAT_STATE_REDIS_URL', os.getenv('REDIS_URL', DEV_CONSTANT.REDIS_URL))
+
+# Префикс ключей (позволяет держать несколько окружений в одном Redis)
+CHAT_STATE_KEY_PREFIX = os.getenv('CHAT_STATE_KEY_PREFIX', 'support_chat:')
+
+# Таймаут отправки одному получателю при рассылке по WebSocket (сек)
+WEBSOCKET_SEND_TIMEOUT = float(os.getenv('WEBSOCKET_SEND_TIMEOUT', '5'))
+
+# Размер исходящей очереди соединения (кадров); необязательные сообщения сверх него отбрасываются
+WEBSOCKET_OUTBOUND_QUEUE_SIZE = int(os.getenv('WEBSOCKET_OUTBOUND_QUEUE_SIZE', '256'))
+
+# Сколько соединение может оставаться переполненным, прежде чем будет закрыто (сек)
+WEBSOCKET_SLOW_CONSUMER_TIMEOUT = float(os.getenv('WEBSOCKET_SLOW_CONSUMER_TIMEOUT', '10'))
+
+# Доставка сообщений чатов между узлами через Redis pub/sub
+CHAT_FANOUT_ENABLED = os.getenv('CHAT_FANOUT_ENABLED', 'false').lower() == 'true'
+
+# Подключение к Redis для pub/sub (по умолчанию - тот же Redis, что и для состояния)
+CHAT_FANOUT_REDIS_URL = os.getenv('CHAT_FANOUT_REDIS_URL', CHAT_STATE_REDIS_URL)
+
+# Префикс каналов чатов: <префикс><chat_id>
+CHAT_FANOUT_CHANNEL_PREFIX = os.getenv('CHAT_FANOUT_CHANNEL_PREFIX', CHAT_STATE_KEY_PREFIX + 'chat:')
+
+# Идентификатор узла (сообщения своего узла из Redis не доставляются повторно)
+CHAT_NODE_ID = os.getenv('CHAT_NODE_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+# Подписка на все каналы чатов одним шаблоном вместо канала на чат
+# (для узлов с тысячами активных чатов)
+CHAT_FANOUT_PATTERN_SUBSCRIBE = os.getenv('CHAT_FANOUT_PATTERN_SUBSCRIBE', 'false').lower() == 'true'
+
+# Сколько последних событий чата хранить для досылки после переподключения
+CHAT_REPLAY_BUFFER_SIZE = int(os.getenv('CHAT_REPLAY_BUFFER_SIZE', '256'))
+
+# Для скольких чатов держать буфер событий в памяти (хранилище memory без рассылки между узлами)
+CHAT_REPLAY_MAX_CHATS = int(os.getenv('CHAT_REPLAY_MAX_CHATS', '10000'))
+
+# Время жизни буфера событий неактивного чата в Redis (сек)
+CHAT_REPLAY_TTL = int(os.getenv('CHAT_REPLAY_TTL', '86400'))
+
+# Сколько последних сообщений отдавать из БД, если буфер событий уже перезаписан
+CHAT_REPLAY_DB_LIMIT = int(os.getenv('CHAT_REPLAY_DB_LIMIT', '50'))
+
+# Групповая запись сообщений чатов: сколько ждать попутных сообщений перед
+# записью батча (сек, 0 - только сообщения, накопленные за время записи
+# предыдущего батча) и максимальный размер батча
+CHAT_MESSAGE_BATCH_DELAY = float(os.getenv('CHAT_MESSAGE_BATCH_DELAY', '0.002'))
+CHAT_MESSAGE_BATCH_SIZE = int(os.getenv('CHAT_MESSAGE_BATCH_SIZE', '500'))
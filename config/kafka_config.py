@@ -145,10 +145,54 @@ KAFKA_CONFIG = {
     'bootstrap_servers': ['localhost:9092'],
     'client_id': 'support_chat_service',
     'auto_offset_reset': 'latest',
-    'enable_auto_commit': True,
+    'enable_auto_commit': False,  # offset'ы фиксируются вручную после обработки
     'group_id': 'support_chat_group'
 }
 
+# Конвейерная отправка: событие ставится в буфер producer'а без ожидания
+# подтверждения брокера, доставка отслеживается в фоне
+KAFKA_PRODUCER_PIPELINED = os.getenv('KAFKA_PRODUCER_PIPELINED', 'true').lower() == 'true'
+
+# Сколько producer ждет попутных событий перед отправкой батча (мс) и размер батча (байт)
+KAFKA_PRODUCER_LINGER_MS = int(os.getenv('KAFKA_PRODUCER_LINGER_MS', '5'))
+KAFKA_PRODUCER_BATCH_SIZE = int(os.getenv('KAFKA_PRODUCER_BATCH_SIZE', '65536'))
+
+# Сжатие батчей: lz4, zstd, gzip, snappy или none (lz4 и zstd требуют aiokafka[lz4] / aiokafka[zstd])
+KAFKA_PRODUCER_COMPRESSION = os.getenv('KAFKA_PRODUCER_COMPRESSION', 'lz4').lower()
+
+# Один consumer на все топики: события забираются пачками getmany() и
+# обрабатываются параллельно по ключам (chat_id / operator_id), offset'ы
+# фиксируются после обработки пачки. false - отдельный consumer на топик.
+# Пакетный режим читает группой support_chat_group, а не группами
+# support_chat_group_<топик>: у новой группы нет offset'ов, и при
+# auto_offset_reset='latest' события, пришедшие во время переключения, теряются.
+# Перед включением остановить consumer'ы и перенести offset'ы старых групп для
+# каждой партиции: kafka-consumer-groups --group support_chat_group --reset-offsets
+# --topic <топик>:<партиция> --to-offset <offset группы support_chat_group_<топик>> --execute
+KAFKA_CONSUMER_BATCHED = os.getenv('KAFKA_CONSUMER_BATCHED', 'false').lower() == 'true'
+
+# Максимум событий в пачке, ожидание пачки (мс) и число ключей, обрабатываемых одновременно
+KAFKA_CONSUMER_MAX_RECORDS = int(os.getenv('KAFKA_CONSUMER_MAX_RECORDS', '500'))
+KAFKA_CONSUMER_POLL_TIMEOUT_MS = int(os.getenv('KAFKA_CONSUMER_POLL_TIMEOUT_MS', '1000'))
+KAFKA_CONSUMER_WORKERS = int(os.getenv('KAFKA_CONSUMER_WORKERS', '32'))
+
+# Пауза перед повторным чтением после ошибки чтения или обработки пачки (секунды)
+KAFKA_CONSUMER_ERROR_BACKOFF = float(os.getenv('KAFKA_CONSUMER_ERROR_BACKOFF', '1.0'))
+
+# Повторы обработчика события до того, как событие будет пропущено, и пауза между ними (секунды)
+KAFKA_CONSUMER_HANDLER_ATTEMPTS = int(os.getenv('KAFKA_CONSUMER_HANDLER_ATTEMPTS', '3'))
+KAFKA_CONSUMER_RETRY_BACKOFF = float(os.getenv('KAFKA_CONSUMER_RETRY_BACKOFF', '0.2'))
+
+# Окно дедупликации по event_id: сколько последних обработанных событий
+# помнить и как долго (секунды) - повторно доставленные события пропускаются
+KAFKA_DEDUP_WINDOW_SIZE = int(os.getenv('KAFKA_DEDUP_WINDOW_SIZE', '100000'))
+KAFKA_DEDUP_TTL = int(os.getenv('KAFKA_DEDUP_TTL', '3600'))
+
+# Outbox: сколько событий отправляется одной пачкой и как часто таблица
+# проверяется без явного сигнала (секунды)
+KAFKA_OUTBOX_BATCH_SIZE = int(os.getenv('KAFKA_OUTBOX_BATCH_SIZE', '500'))
+KAFKA_OUTBOX_POLL_INTERVAL = float(os.getenv('KAFKA_OUTBOX_POLL_INTERVAL', '1.0'))
+
 # Конфигурация топиков
 TOPIC_CONFIG = {
     'num_partitions': 3,
@@ -1,13 +1,129 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import select, insert, update, delete, and_, or_, exists, tuple_, func, literal, literal_column, \
+    bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import selectinload
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict, Any, Callable, Awaitable
 from database.decorator import connection
 from database.models.support import Chat, ChatMessage, ChatAttachment, \
     ChatParticipant, SupportHistoryChat, SupportHistoryDate, \
-    MessageReadReceipt, ClientLawyerAssignment
+    MessageReadReceipt, ClientLawyerAssignment, ChatReadCursor, ChatSummary, KafkaOutbox
 from database.main_connection import DataBaseMainConnect
 
+# Длина превью последнего сообщения в сводке чата
+SUMMARY_PREVIEW_LENGTH = 200
+
+# Ключ advisory-блокировки разбора kafka_outbox (outbox разбирает один узел за раз)
+OUTBOX_LOCK_KEY = 7_284_031_553
+
+# Конфигурации полнотекстового поиска (те же, что в ChatMessage.search_vector)
+_SEARCH_RU = literal_column("'russian'::regconfig")
+_SEARCH_EN = literal_column("'english'::regconfig")
+# Подсветка совпадений во фрагментах результатов поиска
+SEARCH_HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5"
+
+
+def _chat_member(chat_id_column, user_id: int):
+    """Пользователь - клиент, текущий оператор или участник (в т.ч. бывший) чата"""
+    return or_(
+        exists().where(Chat.id == chat_id_column, or_(Chat.user_id == user_id, Chat.user_support_id == user_id)),
+        exists().where(ChatParticipant.chat_id == chat_id_column, ChatParticipant.user_id == user_id),
+    )
+
+
+def _summary_unread(reader_id):
+    """Непрочитанные читателем (колонка сводки) - чужие сообщения после его курсора чтения"""
+    last_read = select(ChatReadCursor.last_read_message_id).where(
+        ChatReadCursor.chat_id == ChatSummary.chat_id,
+        ChatReadCursor.user_id == reader_id,
+    ).correlate(ChatSummary).scalar_subquery()
+    return select(func.count(ChatMessage.id)).where(
+        ChatMessage.chat_id == ChatSummary.chat_id,
+        ChatMessage.id > func.coalesce(last_read, 0),
+        ChatMessage.sender_id.is_distinct_from(reader_id),
+    ).scalar_subquery()
+
+
+async def _refresh_summary_unread(session: AsyncSession, chat_ids: List[int]):
+    """Пересчет непрочитанных в сводках чатов (диапазон индекса после курсора)"""
+    q = update(ChatSummary).where(ChatSummary.chat_id.in_(chat_ids)).values(
+        unread_by_client=_summary_unread(ChatSummary.client_id),
+        unread_by_operator=_summary_unread(ChatSummary.operator_id),
+    )
+    await session.execute(q.execution_options(synchronize_session=False))
+
+
+async def _apply_summary_messages(session: AsyncSession, messages: List[ChatMessage]):
+    """
+    Инкрементальное обновление сводок чатов новыми сообщениями: последнее сообщение,
+    ожидание ответа и прибавка к непрочитанным. Строки сводок блокируются на время
+    транзакции, стоимость зависит только от числа новых сообщений, а не от истории
+    чата и не от числа непрочитанных.
+    """
+    by_chat: Dict[int, List[ChatMessage]] = {}
+    for message in sorted(messages, key=lambda m: m.id):
+        by_chat.setdefault(message.chat_id, []).append(message)
+    if not by_chat:
+        return
+
+    rows = await session.execute(
+        select(ChatSummary.chat_id, ChatSummary.client_id, ChatSummary.operator_id, ChatSummary.waiting_since)
+        .where(ChatSummary.chat_id.in_(list(by_chat)))
+        .order_by(ChatSummary.chat_id)
+        .with_for_update()
+    )
+    params = []
+    for chat_id, client_id, operator_id, waiting_since in rows:
+        chat_messages = by_chat[chat_id]
+        for message in chat_messages:
+            # Ответ не клиента закрывает ожидание, первое сообщение клиента после него - открывает
+            if message.sender_id != client_id:
+                waiting_since = None
+            elif waiting_since is None:
+                waiting_since = message.created_at
+        last = chat_messages[-1]
+        params.append({
+            'b_chat_id': chat_id,
+            'b_last_message_id': last.id,
+            'b_last_message_preview': last.message[:SUMMARY_PREVIEW_LENGTH] if last.message is not None else None,
+            'b_last_sender_id': last.sender_id,
+            'b_last_created_at': last.created_at,
+            'b_waiting_since': waiting_since,
+            # Непрочитанные читателем - чужие сообщения (новые сообщения всегда после курсора чтения)
+            'b_unread_by_client': sum(message.sender_id != client_id for message in chat_messages),
+            'b_unread_by_operator': sum(message.sender_id != operator_id for message in chat_messages),
+        })
+    if not params:
+        return
+
+    summary = ChatSummary.__table__
+    q = update(summary).where(summary.c.chat_id == bindparam('b_chat_id')).values(
+        last_message_id=bindparam('b_last_message_id'),
+        last_message_preview=bindparam('b_last_message_preview'),
+        last_sender_id=bindparam('b_last_sender_id'),
+        last_activity_at=func.greatest(summary.c.last_activity_at, bindparam('b_last_created_at')),
+        waiting_since=bindparam('b_waiting_since'),
+        unread_by_client=summary.c.unread_by_client + bindparam('b_unread_by_client'),
+        unread_by_operator=summary.c.unread_by_operator + bindparam('b_unread_by_operator'),
+    )
+    await session.execute(q, params)
+
+
+async def _assign_summary_operators(session: AsyncSession, operators: Dict[int, Optional[int]]):
+    """Смена оператора в сводках чатов {chat_id: operator_id} с пересчетом его непрочитанных"""
+    await session.execute(
+        update(ChatSummary),
+        [{'chat_id': chat_id, 'operator_id': operator_id} for chat_id, operator_id in operators.items()]
+    )
+    await _refresh_summary_unread(session, list(operators))
+
+
+def _add_outbox(session: AsyncSession, events: Optional[List[Dict[str, Any]]]):
+    """События Kafka в outbox текущей транзакции (порядок списка - порядок отправки)"""
+    if events:
+        session.add_all([KafkaOutbox(**event) for event in events])
+
 
 class ChatSupport(DataBaseMainConnect):
 
@@ -25,6 +141,8 @@ class ChatSupport(DataBaseMainConnect):
         await session.flush()
         part = ChatParticipant(chat_id=chat.id, user_id=user_id, role="client")
         session.add(part)
+        session.add(ChatSummary(chat_id=chat.id, client_id=user_id, operator_id=initial_support_id,
+                                last_activity_at=chat.date_created))
         await session.commit()
         await session.refresh(chat)
         return chat
@@ -35,10 +153,26 @@ class ChatSupport(DataBaseMainConnect):
         msg = ChatMessage(chat_id=chat_id, sender_id=sender_id, sender_type=sender_type, message=text)
         session.add(msg)
         await session.flush()
+        await _apply_summary_messages(session, [msg])
         await session.commit()
         await session.refresh(msg)
         return msg
 
+    @connection()
+    async def add_messages_bulk(self, messages: List[Dict[str, Any]], session: AsyncSession = None) -> List[ChatMessage]:
+        """
+        Сохранение нескольких сообщений (словари с полями ChatMessage) одним многострочным
+        INSERT ... RETURNING и одним commit. Сообщения возвращаются в порядке входного
+        списка, id выдаются в том же порядке. Сводки затронутых чатов обновляются
+        в той же транзакции.
+        """
+        if not messages:
+            return []
+        q = insert(ChatMessage).returning(ChatMessage, sort_by_parameter_order=True)
+        saved = list((await session.scalars(q, messages)).all())
+        await _apply_summary_messages(session, saved)
+        return saved
+
     @connection
     async def add_attachment(self, session: AsyncSession, message_id: int, filename: str,
                              file_path: str, content_type: str, size: int) -> ChatAttachment:
@@ -49,27 +183,58 @@ class ChatSupport(DataBaseMainConnect):
         await session.refresh(att)
         return att
 
-    @connection
-    async def mark_messages_read(self, session: AsyncSession, chat_id: int, reader_user_id: int,
-                                 upto_message_id: Optional[int] = None):
+    @connection()
+    async def mark_messages_read(self, chat_id: int, reader_user_id: int, upto_message_id: Optional[int] = None,
+                                 session: AsyncSession = None) -> int:
         """
-        Добавляет записи MessageReadReceipt для непрочитанных сообщений.
-        Простая реализация: для всех сообщений в чате, где нет receipt от reader_user_id -> добавляем.
+        Отметка сообщений чата прочитанными до upto_message_id включительно (по умолчанию - до последнего).
+        Курсор чтения ChatReadCursor двигается только вперед. Отметки MessageReadReceipt пишутся
+        одним INSERT ... SELECT ... ON CONFLICT DO NOTHING только для сообщений между старым и новым
+        курсором - без загрузки сообщений и проверки каждой отметки. Возвращает новый курсор.
+        upto_message_id должен быть id сообщения этого чата, иначе ValueError - чужой или
+        несуществующий id сдвинул бы курсор за последнее сообщение чата и обнулил бы непрочитанные.
         """
-        q = select(ChatMessage).where(ChatMessage.chat_id == chat_id)
         if upto_message_id:
-            q = q.where(ChatMessage.id <= upto_message_id)
-        res = await session.execute(q)
-        messages = res.scalars().all()
-        for m in messages:
-            # проверяем, есть ли уже
-            q2 = select(MessageReadReceipt).where(MessageReadReceipt.message_id == m.id,
-                                                  MessageReadReceipt.user_id == reader_user_id)
-            has = (await session.execute(q2)).scalars().first()
-            if not has:
-                receipt = MessageReadReceipt(message_id=m.id, user_id=reader_user_id, read_at=datetime.utcnow())
-                session.add(receipt)
-        await session.commit()
+            # id сообщения этого чата не больше последнего id чата, так что проверка заодно ограничивает курсор
+            upto = (await session.execute(
+                select(ChatMessage.id).where(ChatMessage.id == upto_message_id, ChatMessage.chat_id == chat_id)
+            )).scalar_one_or_none()
+            if upto is None:
+                raise ValueError("Сообщение не принадлежит чату")
+        else:
+            upto = func.coalesce(
+                select(func.max(ChatMessage.id)).where(ChatMessage.chat_id == chat_id).scalar_subquery(), 0
+            )
+        last_read = select(ChatReadCursor.last_read_message_id).where(
+            ChatReadCursor.chat_id == chat_id,
+            ChatReadCursor.user_id == reader_user_id,
+        ).scalar_subquery()
+
+        newly_read = select(ChatMessage.id, literal(reader_user_id), func.now()).where(
+            ChatMessage.chat_id == chat_id,
+            ChatMessage.id > func.coalesce(last_read, 0),
+            ChatMessage.id <= upto,
+        )
+        await session.execute(
+            pg_insert(MessageReadReceipt)
+            .from_select(['message_id', 'user_id', 'read_at'], newly_read)
+            .on_conflict_do_nothing(index_elements=['message_id', 'user_id'])
+        )
+
+        cursor = pg_insert(ChatReadCursor).values(
+            chat_id=chat_id, user_id=reader_user_id, last_read_message_id=upto, updated_at=func.now()
+        )
+        cursor = cursor.on_conflict_do_update(
+            index_elements=['chat_id', 'user_id'],
+            set_={
+                'last_read_message_id': func.greatest(ChatReadCursor.last_read_message_id,
+                                                      cursor.excluded.last_read_message_id),
+                'updated_at': cursor.excluded.updated_at,
+            },
+        ).returning(ChatReadCursor.last_read_message_id)
+        last_read_message_id = (await session.execute(cursor)).scalar_one()
+        await _refresh_summary_unread(session, [chat_id])
+        return last_read_message_id
 
     @connection
     async def transfer_chat(self, session: AsyncSession, chat_id: int, new_support_id: int, from_support_id: int,
@@ -109,9 +274,10 @@ class ChatSupport(DataBaseMainConnect):
         new_part = ChatParticipant(chat_id=chat.id, user_id=new_support_id, role="support")
         session.add(new_part)
 
-        # обновляем chats
+        # обновляем chats и сводку
         chat.user_support_id = new_support_id
         session.add(chat)
+        await _assign_summary_operators(session, {chat.id: new_support_id})
         await session.commit()
         return chat
 
@@ -126,6 +292,10 @@ class ChatSupport(DataBaseMainConnect):
         chat.resolved = True
         chat.date_close = datetime.utcnow()
         session.add(chat)
+        await session.execute(
+            update(ChatSummary).where(ChatSummary.chat_id == chat.id).values(active=False)
+            .execution_options(synchronize_session=False)
+        )
 
         hist_date = SupportHistoryDate(date_join=datetime.utcnow(), date_leave=datetime.utcnow())
         session.add(hist_date)
@@ -156,8 +326,39 @@ class ChatSupport(DataBaseMainConnect):
         """Обновление оператора чата"""
         q = update(Chat).where(Chat.id == chat_id).values(user_support_id=operator_id)
         await session.execute(q)
+        await _assign_summary_operators(session, {chat_id: operator_id})
         await session.commit()
 
+    @connection()
+    async def assign_operator(self, chat_id: int, operator_id: int, operator_type: str,
+                              outbox: Optional[List[Dict[str, Any]]] = None, session: AsyncSession = None):
+        """Назначение оператора чату: чат, сводка, участник и события outbox одной транзакцией"""
+        await session.execute(update(Chat).where(Chat.id == chat_id).values(user_support_id=operator_id))
+        await _assign_summary_operators(session, {chat_id: operator_id})
+        session.add(ChatParticipant(chat_id=chat_id, user_id=operator_id, role=operator_type))
+        _add_outbox(session, outbox)
+
+    @connection()
+    async def assign_operators_bulk(self, assignments: List[Tuple[int, int, str]],
+                                    outbox: Optional[List[Dict[str, Any]]] = None, session: AsyncSession = None):
+        """
+        Пакетное назначение операторов чатам одной транзакцией.
+        assignments: список (chat_id, operator_id, operator_type)
+        outbox: события Kafka, записываемые в той же транзакции
+        """
+        if not assignments:
+            return
+        await session.execute(
+            update(Chat),
+            [{'id': chat_id, 'user_support_id': operator_id} for chat_id, operator_id, _ in assignments]
+        )
+        await _assign_summary_operators(session, {chat_id: operator_id for chat_id, operator_id, _ in assignments})
+        session.add_all([
+            ChatParticipant(chat_id=chat_id, user_id=operator_id, role=operator_type)
+            for chat_id, operator_id, operator_type in assignments
+        ])
+        _add_outbox(session, outbox)
+
     @connection
     async def add_chat_participant(self, session: AsyncSession, chat_id: int, user_id: int, role: str) -> ChatParticipant:
         """Добавление участника в чат"""
@@ -208,5 +409,178 @@ class ChatSupport(DataBaseMainConnect):
         res = await session.execute(q)
         return res.scalars().first()
 
+    @connection()
+    async def load_routing_state(self, session: AsyncSession) -> Tuple[List, List[ClientLawyerAssignment]]:
+        """
+        Снимок состояния маршрутизации для теплого рестарта.
+        Возвращает активные чаты (chat_id, client_id, support_id, date_created, роль текущего оператора
+        из открытой записи ChatParticipant) одним запросом и активные назначения юристов.
+        """
+        q = select(
+            Chat.id, Chat.user_id, Chat.user_support_id, Chat.date_created, ChatParticipant.role
+        ).outerjoin(
+            ChatParticipant,
+            and_(
+                ChatParticipant.chat_id == Chat.id,
+                ChatParticipant.user_id == Chat.user_support_id,
+                ChatParticipant.left_at.is_(None)
+            )
+        ).where(Chat.active == True).order_by(Chat.date_created)
+        chats = (await session.execute(q)).all()
+
+        q = select(ClientLawyerAssignment).where(ClientLawyerAssignment.unassigned_at.is_(None))
+        lawyer_assignments = (await session.execute(q)).scalars().all()
+        return chats, lawyer_assignments
+
+    @connection()
+    async def get_recent_messages(self, chat_id: int, limit: int, after_message_id: Optional[int] = None,
+                                  session: AsyncSession = None) -> Tuple[List[ChatMessage], bool]:
+        """
+        Последние limit сообщений чата (по возрастанию), новее after_message_id, если он задан.
+        Keyset по (created_at, id) через ix_chat_messages_chat_id_created_at - стоимость
+        не зависит от длины чата. Второй элемент - есть ли еще сообщения между
+        after_message_id и первым возвращенным (их можно дочитать постранично).
+        """
+        q = select(ChatMessage).where(ChatMessage.chat_id == chat_id)
+        if after_message_id:
+            anchor = select(ChatMessage.created_at).where(ChatMessage.id == after_message_id).scalar_subquery()
+            q = q.where(tuple_(ChatMessage.created_at, ChatMessage.id) > tuple_(anchor, after_message_id))
+        q = q.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit + 1)
+        messages = (await session.execute(q)).scalars().all()
+        has_more = len(messages) > limit
+        return list(reversed(messages[:limit])), has_more
+
+    @connection()
+    async def can_read_chat(self, chat_id: int, user_id: int, session: AsyncSession) -> bool:
+        """Может ли пользователь читать чат: клиент, текущий оператор или участник (в т.ч. бывший)"""
+        is_participant = exists().where(ChatParticipant.chat_id == chat_id, ChatParticipant.user_id == user_id)
+        q = select(Chat.id).where(
+            Chat.id == chat_id,
+            or_(Chat.user_id == user_id, Chat.user_support_id == user_id, is_participant)
+        )
+        return (await session.execute(q)).first() is not None
+
+    @connection()
+    async def get_messages_page(self, chat_id: int, limit: int, before: Optional[Tuple[datetime, int]] = None,
+                                session: AsyncSession = None) -> Tuple[List[ChatMessage], bool]:
+        """
+        Страница истории чата от новых к старым: limit сообщений строго старше
+        курсора before = (created_at, id) последнего сообщения предыдущей страницы.
+        Keyset по ix_chat_messages_chat_id_created_at: условие created_at <= ...
+        ограничивает диапазон индекса, поэтому стоимость страницы не зависит ни от
+        длины чата, ни от глубины прокрутки. Вложения загружаются одним запросом
+        на страницу. Второй элемент - есть ли сообщения старше страницы.
+        """
+        q = select(ChatMessage).where(ChatMessage.chat_id == chat_id)
+        if before:
+            before_created_at, before_id = before
+            q = q.where(
+                ChatMessage.created_at <= before_created_at,
+                or_(ChatMessage.created_at < before_created_at, ChatMessage.id < before_id)
+            )
+        q = q.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit + 1)
+        q = q.options(selectinload(ChatMessage.attachments))
+        messages = (await session.execute(q)).scalars().all()
+        return list(messages[:limit]), len(messages) > limit
+
+    @connection()
+    async def search_messages(self, query: str, limit: int, chat_id: Optional[int] = None,
+                              participant_id: Optional[int] = None, date_from: Optional[datetime] = None,
+                              date_to: Optional[datetime] = None, reader_id: Optional[int] = None,
+                              after: Optional[Tuple[float, int]] = None,
+                              session: AsyncSession = None) -> Tuple[List[Any], bool]:
+        """
+        Полнотекстовый поиск по сообщениям через GIN-индекс ix_chat_messages_search_vector.
+        query в синтаксисе websearch ("точная фраза", -исключение, or) разбирается
+        русской и английской конфигурацией. Фильтры: чат, участник чата, интервал
+        created_at [date_from, date_to); reader_id - только доступные ему чаты.
+        Результаты по убыванию релевантности, страница - limit строк после курсора
+        after = (rank, id) последней строки предыдущей страницы. Фрагменты с подсветкой
+        (ts_headline) строятся только для строк страницы. Второй элемент - есть ли еще.
+        """
+        ts_query = func.websearch_to_tsquery(_SEARCH_RU, query).op('||')(
+            func.websearch_to_tsquery(_SEARCH_EN, query)
+        )
+        rank = func.ts_rank_cd(ChatMessage.search_vector, ts_query)
+
+        page = select(ChatMessage.id, rank.label('rank')).where(ChatMessage.search_vector.op('@@')(ts_query))
+        if chat_id:
+            page = page.where(ChatMessage.chat_id == chat_id)
+        if participant_id:
+            page = page.where(_chat_member(ChatMessage.chat_id, participant_id))
+        if reader_id:
+            page = page.where(_chat_member(ChatMessage.chat_id, reader_id))
+        if date_from:
+            page = page.where(ChatMessage.created_at >= date_from)
+        if date_to:
+            page = page.where(ChatMessage.created_at < date_to)
+        if after:
+            page = page.where(tuple_(rank, ChatMessage.id) < tuple_(*after))
+        page = page.order_by(rank.desc(), ChatMessage.id.desc()).limit(limit + 1).subquery()
+
+        headline = func.ts_headline(_SEARCH_RU, ChatMessage.message, ts_query, SEARCH_HEADLINE_OPTIONS)
+        q = (
+            select(ChatMessage.id, ChatMessage.chat_id, ChatMessage.sender_id, ChatMessage.created_at,
+                   page.c.rank, headline.label('headline'))
+            .join(page, page.c.id == ChatMessage.id)
+            .order_by(page.c.rank.desc(), ChatMessage.id.desc())
+        )
+        rows = (await session.execute(q)).all()
+        return list(rows[:limit]), len(rows) > limit
+
+    @connection()
+    async def get_unread_counts(self, user_id: int, session: AsyncSession = None) -> Dict[int, int]:
+        """
+        Число непрочитанных сообщений в активных чатах пользователя (клиент или оператор):
+        {chat_id: count}. Один запрос - сообщения с id больше курсора чтения
+        по ix_chat_messages_chat_id_id, свои сообщения не считаются.
+        """
+        q = (
+            select(Chat.id, func.count(ChatMessage.id))
+            .outerjoin(ChatReadCursor, and_(ChatReadCursor.chat_id == Chat.id, ChatReadCursor.user_id == user_id))
+            .outerjoin(ChatMessage, and_(
+                ChatMessage.chat_id == Chat.id,
+                ChatMessage.id > func.coalesce(ChatReadCursor.last_read_message_id, 0),
+                ChatMessage.sender_id.is_distinct_from(user_id),
+            ))
+            .where(Chat.active == True, or_(Chat.user_id == user_id, Chat.user_support_id == user_id))
+            .group_by(Chat.id)
+        )
+        return {chat_id: count for chat_id, count in (await session.execute(q)).all()}
+
+
+    @connection()
+    async def get_operator_chat_summaries(self, operator_id: int, limit: int,
+                                          session: AsyncSession = None) -> List[ChatSummary]:
+        """Сводки активных чатов оператора от последней активности к более ранней"""
+        q = select(ChatSummary).where(
+            ChatSummary.operator_id == operator_id,
+            ChatSummary.active == True,
+        ).order_by(ChatSummary.last_activity_at.desc()).limit(limit)
+        return list((await session.execute(q)).scalars().all())
+
+    @connection()
+    async def drain_outbox(self, limit: int, publish: Callable[[List[KafkaOutbox]], Awaitable[Any]],
+                           session: AsyncSession = None) -> int:
+        """
+        Отправка пачки событий outbox в порядке id.
+
+        Разбирает outbox только узел, получивший advisory-блокировку транзакции:
+        параллельные пачки разных узлов публиковали бы события одного чата не по
+        порядку. Остальные узлы сразу получают 0 и повторяют попытку позже.
+        После publish() события удаляются в той же транзакции; если publish()
+        упал, транзакция откатывается и пачка будет отправлена повторно.
+        """
+        locked = (await session.execute(select(func.pg_try_advisory_xact_lock(OUTBOX_LOCK_KEY)))).scalar()
+        if not locked:
+            return 0
+        q = select(KafkaOutbox).order_by(KafkaOutbox.id).limit(limit)
+        events = (await session.execute(q)).scalars().all()
+        if not events:
+            return 0
+        await publish(events)
+        await session.execute(delete(KafkaOutbox).where(KafkaOutbox.id.in_([event.id for event in events])))
+        return len(events)
+
 
 chat_db = ChatSupport()
@@ -6,7 +6,8 @@ from sqlalchemy import (
     Integer, String, Boolean, DateTime, ForeignKey, Text, Enum, BigInteger
 )
 import enum
-from sqlalchemy import Index, desc
+from sqlalchemy import Index, UniqueConstraint, desc, Computed
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB
 
 
 class SenderType(str, enum.Enum):
@@ -90,6 +91,13 @@ class Chat(Base):
     rating = relationship("ChatRating", back_populates="chat", uselist=False)
 
 
+# Поисковый вектор сообщения: одновременно русская и английская морфология
+CHAT_MESSAGE_SEARCH_VECTOR = (
+    "to_tsvector('russian'::regconfig, coalesce(message, '')) || "
+    "to_tsvector('english'::regconfig, coalesce(message, ''))"
+)
+
+
 class ChatMessage(Base):
     """
     Хранит историю переписки.
@@ -101,10 +109,14 @@ class ChatMessage(Base):
         Добавляется каждое сообщение пользователя или оператора.
         При редактировании обновляется edited_at и status.
         Можно быстро сортировать по времени (есть индекс).
+        Полнотекстовый поиск по search_vector (русская и английская
+        морфология, GIN-индекс).
     """
     __tablename__ = "chat_messages"
     __table_args__ = (
         Index('ix_chat_messages_chat_id_created_at', 'chat_id', desc('created_at')),
+        Index('ix_chat_messages_chat_id_id', 'chat_id', 'id'),
+        Index('ix_chat_messages_search_vector', 'search_vector', postgresql_using='gin'),
         {'schema': 'public'}
     )
     id: Mapped[intpk]
@@ -115,6 +127,11 @@ class ChatMessage(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
     status: Mapped[MessageStatus] = mapped_column(Enum(MessageStatus), nullable=False, default=MessageStatus.SENT)
     edited_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    search_vector = mapped_column(
+        TSVECTOR,
+        Computed(CHAT_MESSAGE_SEARCH_VECTOR, persisted=True),
+        deferred=True
+    )  # вычисляется БД, в ORM-объект не загружается
     # связи
     chat = relationship("Chat", back_populates="messages")
     attachments = relationship("ChatAttachment", back_populates="message", cascade="all, delete-orphan")
@@ -149,9 +166,13 @@ class MessageReadReceipt(Base):
     Как будет использоваться:
 
         Создаётся при открытии чата пользователем или оператором.
+        Не более одной записи на (сообщение, пользователь).
     """
     __tablename__ = "message_read_receipt"
-    __table_args__ = {'schema': 'public'}
+    __table_args__ = (
+        UniqueConstraint('message_id', 'user_id', name='uq_message_read_receipt_message_user'),
+        {'schema': 'public'}
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     message_id: Mapped[int] = mapped_column(Integer, ForeignKey("public.chat_messages.id", ondelete="CASCADE"), nullable=False)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("public.users.id"), nullable=False)
@@ -179,6 +200,76 @@ class ChatParticipant(Base):
     chat = relationship("Chat", back_populates="participants")
 
 
+class ChatReadCursor(Base):
+    """
+    Докуда пользователь прочитал чат - id последнего прочитанного сообщения.
+
+    Как будет использоваться:
+
+        Обновляется (только вперед) при отметке сообщений прочитанными.
+        Непрочитанные - сообщения чата с id больше курсора, считаются одним
+        запросом по ix_chat_messages_chat_id_id.
+    """
+    __tablename__ = "chat_read_cursor"
+    __table_args__ = {'schema': 'public'}
+    chat_id: Mapped[int] = mapped_column(Integer, ForeignKey("public.chats.id", ondelete="CASCADE"), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("public.users.id"), primary_key=True)
+    last_read_message_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+
+
+class ChatSummary(Base):
+    """
+    Сводка по чату для панели оператора: последнее сообщение, непрочитанные,
+    с какого момента клиент ждет ответа и текущий оператор.
+
+    Как будет использоваться:
+
+        Обновляется в тех же транзакциях, что и сообщения, отметки о прочтении,
+        назначение, перевод и закрытие чата (только затронутые чаты).
+        Список чатов оператора по последней активности - один запрос
+        по ix_chat_summary_operator_activity.
+    """
+    __tablename__ = "chat_summary"
+    __table_args__ = (
+        Index('ix_chat_summary_operator_activity', 'operator_id', 'active', desc('last_activity_at')),
+        {'schema': 'public'}
+    )
+    chat_id: Mapped[int] = mapped_column(Integer, ForeignKey("public.chats.id", ondelete="CASCADE"), primary_key=True)
+    client_id: Mapped[int] = mapped_column(Integer, ForeignKey("public.users.id"), nullable=False)
+    operator_id: Mapped[int | None] = mapped_column(
+        Integer, ForeignKey("public.users.id", ondelete="SET NULL"), nullable=True
+    )
+    active: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
+    last_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    last_message_preview: Mapped[str | None] = mapped_column(Text, nullable=True)
+    last_sender_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    last_activity_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+    waiting_since: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)  # первое неотвеченное сообщение клиента
+    unread_by_client: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    unread_by_operator: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class KafkaOutbox(Base):
+    """
+    Исходящие события Kafka (transactional outbox).
+
+    Как будет использоваться:
+
+        Событие записывается в той же транзакции, что и изменения чата, поэтому
+        не теряется при падении между commit и отправкой в Kafka. Фоновая задача
+        забирает события пачками в порядке id (FOR UPDATE SKIP LOCKED),
+        отправляет и удаляет доставленные.
+    """
+    __tablename__ = "kafka_outbox"
+    __table_args__ = {'schema': 'public'}
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    topic: Mapped[str] = mapped_column(String(255), nullable=False)
+    key: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow, nullable=False)
+
+
 
 
 class SupportHistoryChat(Base):
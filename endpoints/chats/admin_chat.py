@@ -212,7 +212,7 @@ async def update_queue_priority(
 ):
     """Изменение приоритета клиента в очереди"""
     
-    if request.client_id not in queue_manager.waiting_clients:
+    if not await queue_manager.is_client_waiting(request.client_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Клиент не найден в очереди"
@@ -235,27 +235,26 @@ async def update_queue_priority(
 async def get_detailed_queue(admin_user: Users = Depends(check_admin_permissions)):
     """Получение детальной информации об очереди"""
     
+    # Очередь уже упорядочена - позиция равна порядковому номеру при обходе
     queue_clients = []
-    for client_id, queued_client in queue_manager.waiting_clients.items():
-        position = await queue_manager.get_queue_position(client_id)
+    for position, queued_client in enumerate(await queue_manager.list_waiting_clients(), 1):
         queue_clients.append({
-            "client_id": client_id,
+            "client_id": queued_client.client_id,
             "chat_id": queued_client.chat_id,
             "wait_time": queued_client.wait_time,
             "priority": queued_client.priority,
             "position": position,
             "timestamp": queued_client.timestamp.isoformat(),
-            "metadata": queued_client.metadata
+            "metadata": queued_client.metadata or {}
         })
     
-    # Сортируем по позиции в очереди
-    queue_clients.sort(key=lambda x: x["position"])
+    queue_stats = await queue_manager.fetch_queue_status()
     
     return {
         "queue": queue_clients,
         "total_waiting": len(queue_clients),
-        "available_operators": len(queue_manager.get_available_operators()),
-        "queue_stats": queue_manager.get_queue_status()
+        "available_operators": queue_stats["available_operators"],
+        "queue_stats": queue_stats
     }
 
 
@@ -264,11 +263,9 @@ async def get_detailed_operators(admin_user: Users = Depends(check_admin_permiss
     """Получение детальной информации об операторах"""
     
     operators = []
-    for operator_id, operator in queue_manager.operators.items():
-        operator_chats = await assignment_manager.get_operator_chats(operator_id)
-        
+    for operator in await queue_manager.list_operators():
         operators.append({
-            "operator_id": operator_id,
+            "operator_id": operator.operator_id,
             "operator_type": operator.operator_type,
             "is_online": operator.is_online,
             "is_available": operator.is_available,
@@ -293,7 +290,7 @@ async def get_active_chats(admin_user: Users = Depends(check_admin_permissions))
     """Получение информации об активных чатах"""
     
     active_chats = []
-    for chat_id, operator_id in queue_manager.chat_assignments.items():
+    for chat_id, operator_id in (await queue_manager.list_chat_assignments()).items():
         try:
             # Получаем информацию о чате из БД
             chat = await chat_db.get_chat_by_id(chat_id)
@@ -324,15 +321,17 @@ async def get_active_chats(admin_user: Users = Depends(check_admin_permissions))
 async def get_admin_stats(admin_user: Users = Depends(check_admin_permissions)):
     """Получение общей статистики для администратора"""
     
+    operators = await queue_manager.list_operators()
+    
     return {
-        "queue": queue_manager.get_queue_status(),
-        "assignments": assignment_manager.get_assignment_stats(),
+        "queue": await queue_manager.fetch_queue_status(),
+        "assignments": await assignment_manager.get_assignment_stats(),
         "connections": websocket_manager.get_connection_stats(),
         "operators_summary": {
-            "total": len(queue_manager.operators),
-            "online": len([op for op in queue_manager.operators.values() if op.is_online]),
-            "available": len(queue_manager.get_available_operators()),
-            "busy": len([op for op in queue_manager.operators.values() if op.is_online and not op.is_available])
+            "total": len(operators),
+            "online": len([op for op in operators if op.is_online]),
+            "available": len([op for op in operators if op.can_accept_chat]),
+            "busy": len([op for op in operators if op.is_online and not op.is_available])
         }
     }
 
@@ -3,17 +3,23 @@ WebSocket эндпоинт для чата поддержки с использ
 """
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
 from fastapi import status, Query
-from typing import Optional
+from typing import Optional, Tuple
+from datetime import datetime, timezone
+import base64
 import json
 import asyncio
 import logging
 
+from config.chat_config import CHAT_REPLAY_DB_LIMIT
 from utils.auth import get_current_user
 from utils.websocket_manager import websocket_manager
+from utils.chat_fanout import chat_fanout
+from utils.message_writer import chat_message_writer
 from utils.kafka_producer import kafka_producer
 from utils.queue_manager import queue_manager
 from utils.assignment_manager import create_assignment_manager
 from database.logic.chats.chat import chat_db
+from database.models.users import Users
 
 logger = logging.getLogger(__name__)
 
@@ -24,13 +30,18 @@ assignment_manager = create_assignment_manager(queue_manager, websocket_manager)
 
 
 @router.websocket("/ws/chat")
-async def ws_chat_endpoint(websocket: WebSocket, token: str = Query(...), chat_id: Optional[int] = Query(None)):
+async def ws_chat_endpoint(websocket: WebSocket, token: str = Query(...), chat_id: Optional[int] = Query(None),
+                           last_seq: Optional[int] = Query(None), last_message_id: Optional[int] = Query(None)):
     """
     WebSocket эндпоинт для чата поддержки с Kafka
     
     Клиент подключается к /ws/chat?token=...&chat_id=123
     Если chat_id не передан для клиента - сервер создаст новый чат.
     Для операторов chat_id может быть None - они видят доступные чаты.
+    
+    При переподключении клиент передает last_seq - номер последнего полученного
+    события чата (и last_message_id - последнего сообщения) и получает только
+    пропущенные события.
     """
     user = None
     user_id = None
@@ -98,6 +109,10 @@ async def ws_chat_endpoint(websocket: WebSocket, token: str = Query(...), chat_i
         }
         await websocket_manager.send_to_user(user_id, welcome_message)
         
+        # 7.1) Досылаем события, пропущенные за время разрыва соединения
+        if chat_id and last_seq is not None:
+            await send_missed_events(user_id, websocket, chat_id, last_seq, last_message_id)
+        
         # 8) Если это клиент и чат только что создан - добавляем в очередь
         if is_client and chat_id:
             # Проверяем, есть ли уже назначенный оператор
@@ -126,16 +141,59 @@ async def ws_chat_endpoint(websocket: WebSocket, token: str = Query(...), chat_i
     except Exception as e:
         logger.error(f"Ошибка в WebSocket соединении пользователя {user_id}: {e}")
     finally:
-        # Очистка при отключении
+        # Очистка при отключении: закрываем только этот сокет. Из чатов и ролей
+        # пользователь удаляется при закрытии последнего сокета
         if user_id:
-            if chat_id:
-                await websocket_manager.leave_chat(user_id, chat_id)
+            remaining_sockets = await websocket_manager.disconnect_user(user_id, websocket)
             
-            # Если это оператор - переводим в оффлайн
-            if user_role in ['support', 'lawyer', 'salesman']:
+            # Если это оператор и сокетов больше нет - переводим в оффлайн
+            if remaining_sockets == 0 and user_role in ['support', 'lawyer', 'salesman']:
                 await assignment_manager.set_operator_offline(user_id)
-            
-            await websocket_manager.disconnect_user(user_id)
+
+
+async def send_missed_events(user_id: int, websocket: WebSocket, chat_id: int, last_seq: int,
+                             last_message_id: Optional[int] = None):
+    """
+    Досылка в переподключившийся сокет событий чата с номером больше last_seq.
+    
+    События берутся из буфера журнала. Если буфер уже перезаписан, клиент
+    получает последние сообщения из БД (новее last_message_id) и текущий seq,
+    с которого продолжает; has_more - между ними и last_message_id есть еще
+    сообщения, их можно дочитать через историю чата с before=next_cursor. Соединение уже в чате, поэтому новые события не теряются
+    (возможны дубли - клиент отбрасывает их по seq и message_id).
+    """
+    event_log = chat_fanout.event_log
+    events = await event_log.since(chat_id, last_seq)
+    if events is not None:
+        if events:
+            await websocket_manager.send_to_user(user_id, {
+                'type': 'replay',
+                'payload': {'chat_id': chat_id, 'events': events}
+            }, websocket)
+        return
+    
+    seq = await event_log.current_seq(chat_id)
+    messages, has_more = await chat_db.get_recent_messages(chat_id, CHAT_REPLAY_DB_LIMIT, last_message_id)
+    await websocket_manager.send_to_user(user_id, {
+        'type': 'history',
+        'payload': {
+            'chat_id': chat_id,
+            'seq': seq,
+            'messages': [
+                {
+                    'chat_id': chat_id,
+                    'message_id': message.id,
+                    'sender_id': message.sender_id,
+                    'message': message.message,
+                    'timestamp': message.created_at.isoformat()
+                }
+                for message in messages
+            ],
+            'has_more': has_more,
+            # более старые сообщения дочитываются через историю чата с before=next_cursor
+            'next_cursor': _encode_history_cursor(messages[0]) if has_more and messages else None
+        }
+    }, websocket)
 
 
 async def handle_websocket_message(user_id: int, user_role: str, chat_id: Optional[int], message_data: dict):
@@ -193,8 +251,8 @@ async def handle_chat_message(user_id: int, user_role: str, chat_id: Optional[in
     if not text:
         raise ValueError("Сообщение не может быть пустым")
     
-    # Сохраняем сообщение в БД
-    message = await chat_db.add_message(chat_id, user_id, user_role, text)
+    # Сохраняем сообщение в БД (в составе ближайшего батча групповой записи)
+    message = await chat_message_writer.add_message(chat_id, user_id, user_role, text)
     
     # Отправляем событие в Kafka
     await kafka_producer.send_message_sent(
@@ -214,7 +272,7 @@ async def handle_accept_chat(user_id: int, user_role: str, payload: dict):
         raise ValueError("Не указаны client_id или chat_id")
     
     # Проверяем, что клиент все еще в очереди
-    if client_id not in queue_manager.waiting_clients:
+    if not await queue_manager.is_client_waiting(client_id):
         error_message = {
             'type': 'error',
             'payload': {'message': 'Клиент уже принят другим оператором'}
@@ -332,7 +390,7 @@ async def handle_typing(user_id: int, chat_id: Optional[int], payload: dict):
     }
     
     # Отправляем всем участникам чата кроме отправителя
-    await websocket_manager.broadcast_to_chat(chat_id, typing_message, exclude_user=user_id)
+    await chat_fanout.broadcast_to_chat(chat_id, typing_message, exclude_user=user_id)
 
 
 async def handle_read_messages(user_id: int, chat_id: Optional[int], payload: dict):
@@ -342,8 +400,8 @@ async def handle_read_messages(user_id: int, chat_id: Optional[int], payload: di
     
     upto_message_id = payload.get('upto_message_id')
     
-    # Отмечаем сообщения как прочитанные
-    await chat_db.mark_messages_read(chat_id, user_id, upto_message_id)
+    # Отмечаем сообщения как прочитанные, курсор чтения двигается только вперед
+    last_read_message_id = await chat_db.mark_messages_read(chat_id, user_id, upto_message_id)
     
     # Уведомляем других участников
     read_message = {
@@ -351,11 +409,12 @@ async def handle_read_messages(user_id: int, chat_id: Optional[int], payload: di
         'payload': {
             'chat_id': chat_id,
             'user_id': user_id,
-            'upto_message_id': upto_message_id
+            'upto_message_id': upto_message_id,
+            'last_read_message_id': last_read_message_id
         }
     }
     
-    await websocket_manager.broadcast_to_chat(chat_id, read_message, exclude_user=user_id)
+    await chat_fanout.broadcast_to_chat(chat_id, read_message, exclude_user=user_id)
 
 
 async def handle_operator_status(user_id: int, user_role: str, payload: dict):
@@ -381,16 +440,16 @@ async def handle_operator_status(user_id: int, user_role: str, payload: dict):
 @router.get("/chats/queue")
 async def get_queue_status():
     """Получение статуса очереди"""
-    return queue_manager.get_queue_status()
+    return await queue_manager.fetch_queue_status()
 
 
 @router.get("/chats/operators")
 async def get_operators_status():
     """Получение статуса операторов"""
     operators = []
-    for operator_id, operator in queue_manager.operators.items():
+    for operator in await queue_manager.list_operators():
         operators.append({
-            'operator_id': operator_id,
+            'operator_id': operator.operator_id,
             'operator_type': operator.operator_type,
             'is_online': operator.is_online,
             'is_available': operator.is_available,
@@ -404,7 +463,180 @@ async def get_operators_status():
 async def get_chat_stats():
     """Получение общей статистики чатов"""
     return {
-        'queue': queue_manager.get_queue_status(),
-        'assignments': assignment_manager.get_assignment_stats(),
+        'queue': await queue_manager.fetch_queue_status(),
+        'assignments': await assignment_manager.get_assignment_stats(),
         'connections': websocket_manager.get_connection_stats()
     }
+
+
+@router.get("/chats/unread")
+async def get_unread_counts(current_user: Users = Depends(get_current_user)):
+    """Число непрочитанных сообщений в активных чатах текущего пользователя"""
+    counts = await chat_db.get_unread_counts(current_user.id)
+    return {
+        'chats': [{'chat_id': chat_id, 'unread': unread} for chat_id, unread in counts.items()],
+        'total': sum(counts.values())
+    }
+
+
+@router.get("/chats/summary")
+async def get_operator_chats(
+    operator_id: Optional[int] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: Users = Depends(get_current_user)
+):
+    """
+    Активные чаты оператора для панели: последнее сообщение, непрочитанные оператором,
+    время ожидания ответа клиентом. Отсортированы по последней активности.
+    Чужие чаты (operator_id) доступны только администратору.
+    """
+    if operator_id is None:
+        operator_id = current_user.id
+    elif operator_id != current_user.id and not current_user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нет доступа к чатам оператора")
+    
+    summaries = await chat_db.get_operator_chat_summaries(operator_id, limit)
+    now = datetime.now(timezone.utc)
+    return {
+        'operator_id': operator_id,
+        'chats': [
+            {
+                'chat_id': summary.chat_id,
+                'client_id': summary.client_id,
+                'operator_id': summary.operator_id,
+                'last_message': {
+                    'message_id': summary.last_message_id,
+                    'sender_id': summary.last_sender_id,
+                    'preview': summary.last_message_preview
+                } if summary.last_message_id else None,
+                'last_activity_at': summary.last_activity_at.isoformat(),
+                'unread': summary.unread_by_operator,
+                'waiting_seconds': (
+                    int((now - _as_utc(summary.waiting_since)).total_seconds()) if summary.waiting_since else 0
+                )
+            }
+            for summary in summaries
+        ]
+    }
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _encode_history_cursor(message) -> str:
+    """Курсор страницы истории: (created_at, id) последнего сообщения страницы"""
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неверный курсор истории")
+
+
+def _encode_search_cursor(row) -> str:
+    """Курсор страницы поиска: (rank, id) последнего результата страницы"""
+    raw = f"{row.rank!r}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return float(rank), int(message_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неверный курсор поиска")
+
+
+@router.get("/search")
+async def search_chat_messages(
+    q: str = Query(..., min_length=2, max_length=200),
+    chat_id: Optional[int] = Query(None),
+    participant_id: Optional[int] = Query(None),
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    current_user: Users = Depends(get_current_user)
+):
+    """
+    Полнотекстовый поиск по сообщениям чатов (русская и английская морфология).
+    
+    q - поисковая строка ("точная фраза", -исключение, or). Результаты по убыванию
+    релевантности с фрагментами, где совпадения выделены <mark>; следующая страница -
+    cursor=next_cursor. Администратор ищет по всем чатам, остальные - только по своим.
+    """
+    after = _decode_search_cursor(cursor) if cursor else None
+    hits, has_more = await chat_db.search_messages(
+        q, limit,
+        chat_id=chat_id,
+        participant_id=participant_id,
+        date_from=date_from,
+        date_to=date_to,
+        reader_id=None if current_user.is_admin else current_user.id,
+        after=after
+    )
+    return {
+        'hits': [
+            {
+                'message_id': hit.id,
+                'chat_id': hit.chat_id,
+                'sender_id': hit.sender_id,
+                'created_at': hit.created_at.isoformat(),
+                'rank': hit.rank,
+                'headline': hit.headline
+            }
+            for hit in hits
+        ],
+        'next_cursor': _encode_search_cursor(hits[-1]) if has_more else None
+    }
+
+
+@router.get("/chats/{chat_id}/messages")
+async def get_chat_history(
+    chat_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None),
+    current_user: Users = Depends(get_current_user)
+):
+    """
+    История сообщений чата постранично.
+    
+    Без before - последние limit сообщений, далее - страницы старше с before=next_cursor
+    (next_cursor = None, когда сообщения закончились). Внутри страницы сообщения
+    идут по возрастанию времени.
+    """
+    cursor = _decode_history_cursor(before) if before else None
+    if not current_user.is_admin and not await chat_db.can_read_chat(chat_id, current_user.id):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нет доступа к чату")
+    
+    messages, has_more = await chat_db.get_messages_page(chat_id, limit, cursor)
+    return {
+        'chat_id': chat_id,
+        'messages': [
+            {
+                'message_id': message.id,
+                'sender_id': message.sender_id,
+                'sender_type': message.sender_type.value,
+                'message': message.message,
+                'status': message.status.value,
+                'created_at': message.created_at.isoformat(),
+                'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+                'attachments': [
+                    {
+                        'id': attachment.id,
+                        'filename': attachment.filename,
+                        'content_type': attachment.content_type,
+                        'size': attachment.size
+                    }
+                    for attachment in message.attachments
+                ]
+            }
+            for message in reversed(messages)
+        ],
+        'next_cursor': _encode_history_cursor(messages[-1]) if has_more else None
+    }
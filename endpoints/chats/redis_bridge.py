@@ -1,7 +1,12 @@
 import asyncio
 import json
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+
 import redis.asyncio as redis
-from typing import Callable, Awaitable
+
+logger = logging.getLogger(__name__)
 
 
 class RedisPubSub:
@@ -9,15 +14,42 @@ class RedisPubSub:
     Простая обёртка над redis.asyncio PubSub.
     Подписываемся на каналы динамически.
     Запускает слушающий таск, который вызывает callback(channel, message_dict).
+
+    Чтение блокирующее (listen): без сообщений таск спит и не просыпается
+    по таймеру. Callback'и выполняются конкурентно, не больше max_concurrency
+    одновременно, при этом сообщения одного канала доставляются по порядку.
+    Если необработанных сообщений больше max_pending, чтение приостанавливается.
+
+    Подписки, запрошенные в одной итерации event loop, уходят в Redis одной
+    командой. С pattern (например 'chat:*') узел один раз подписывается
+    на шаблон, а subscribe/unsubscribe отдельных каналов ничего не делают -
+    удобно, когда на узле тысячи чатов.
     """
-    def __init__(self, redis_url: str):
+    def __init__(self, redis_url: str, pattern: Optional[str] = None,
+                 max_concurrency: int = 64, max_pending: int = 10_000):
         self.redis_url = redis_url
         self.redis = redis.from_url(redis_url, decode_responses=True)
         self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pattern = pattern
         self._task = None
         self._callback: Callable[[str, dict], Awaitable[None]] | None = None
         self._running = False
 
+        # Подписки, ожидающие отправки одной командой
+        self._to_subscribe: Set[str] = set()
+        self._to_unsubscribe: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._has_subscriptions = asyncio.Event()
+
+        # Диспетчеризация: очередь сообщений на канал и общий лимит callback'ов
+        self._channel_queues: Dict[str, Deque[dict]] = {}
+        self._workers: Set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._max_pending = max_pending
+        self._pending = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+
     async def start(self, message_callback: Callable[[str, dict], Awaitable[None]]):
         """
         Запускаем слушатель. Должно быть вызвано один раз при старте приложения.
@@ -26,39 +58,109 @@ class RedisPubSub:
             return
         self._callback = message_callback
         self._running = True
+        if self.pattern:
+            await self.pubsub.psubscribe(self.pattern)
+            self._has_subscriptions.set()
         self._task = asyncio.create_task(self._reader_loop())
 
     async def subscribe(self, channel: str):
-        await self.pubsub.subscribe(channel)
+        if self.pattern:
+            return
+        self._to_unsubscribe.discard(channel)
+        self._to_subscribe.add(channel)
+        await self._flush()
 
     async def unsubscribe(self, channel: str):
-        await self.pubsub.unsubscribe(channel)
+        if self.pattern:
+            return
+        self._to_subscribe.discard(channel)
+        self._to_unsubscribe.add(channel)
+        await self._flush()
 
     async def publish(self, channel: str, message: dict):
         await self.redis.publish(channel, json.dumps(message, default=str))
 
+    async def _flush(self):
+        """Ожидание отправки накопленных подписок (одна задача на пачку)"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_subscriptions())
+        await asyncio.shield(self._flush_task)
+
+    async def _flush_subscriptions(self):
+        # Даем остальным задачам этой итерации добавить свои каналы в пачку
+        await asyncio.sleep(0)
+        while self._to_subscribe or self._to_unsubscribe:
+            to_subscribe, self._to_subscribe = self._to_subscribe, set()
+            to_unsubscribe, self._to_unsubscribe = self._to_unsubscribe, set()
+            if to_unsubscribe:
+                await self.pubsub.unsubscribe(*to_unsubscribe)
+            if to_subscribe:
+                await self.pubsub.subscribe(*to_subscribe)
+                self._has_subscriptions.set()
+
     async def _reader_loop(self):
         try:
             while self._running:
-                msg = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                if msg is None:
-                    await asyncio.sleep(0.01)
+                if not self.pubsub.subscribed:
+                    # пока нет ни одной подписки, читать нечего - ждем первую
+                    self._has_subscriptions.clear()
+                    await self._has_subscriptions.wait()
                     continue
-                # msg example: {'type': 'message', 'pattern': None, 'channel': 'chats:123', 'data': '{"type":"message",...}'}
-                channel = msg.get("channel")
-                data = msg.get("data")
                 try:
-                    payload = json.loads(data)
-                except Exception:
-                    payload = {"raw": data}
-                if self._callback:
-                    # callback должен быть async
-                    await self._callback(channel, payload)
+                    # listen() завершается, когда отписались от всех каналов
+                    async for msg in self.pubsub.listen():
+                        # msg example: {'type': 'message', 'pattern': None, 'channel': 'chats:123', 'data': '{"type":"message",...}'}
+                        if msg.get("type") not in ("message", "pmessage"):
+                            continue
+                        self._dispatch(msg.get("channel"), msg.get("data"))
+                        if self._pending >= self._max_pending:
+                            self._drained.clear()
+                            await self._drained.wait()
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    logger.error(f"Redis pub/sub connection error: {e}")
+                    await asyncio.sleep(1.0)
         except asyncio.CancelledError:
             pass
         finally:
             await self.pubsub.close()
 
+    def _dispatch(self, channel: str, data):
+        """Постановка сообщения в очередь канала; обработчик канала - один на канал"""
+        try:
+            payload = json.loads(data)
+        except Exception:
+            payload = {"raw": data}
+        self._pending += 1
+        queue = self._channel_queues.get(channel)
+        if queue is not None:
+            queue.append(payload)
+            return
+        self._channel_queues[channel] = deque((payload,))
+        worker = asyncio.create_task(self._drain_channel(channel))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    async def _drain_channel(self, channel: str):
+        queue = self._channel_queues[channel]
+        try:
+            while queue:
+                payload = queue.popleft()
+                try:
+                    async with self._slots:
+                        if self._callback:
+                            # callback должен быть async
+                            await self._callback(channel, payload)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error handling pub/sub message from {channel}: {e}")
+                finally:
+                    self._pending -= 1
+                    if self._pending < self._max_pending:
+                        self._drained.set()
+        finally:
+            del self._channel_queues[channel]
+
     async def stop(self):
         self._running = False
         if self._task:
@@ -68,5 +170,9 @@ class RedisPubSub:
             except asyncio.CancelledError:
                 pass
             self._task = None
+            for worker in list(self._workers):
+                worker.cancel()
+            if self._workers:
+                await asyncio.gather(*self._workers, return_exceptions=True)
             await self.pubsub.close()
             await self.redis.close()
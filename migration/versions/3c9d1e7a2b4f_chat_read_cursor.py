@@ -0,0 +1,58 @@
+"""chat read cursor
+
+Revision ID: 3c9d1e7a2b4f
+Revises: f7be4aad30ad
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c9d1e7a2b4f'
+down_revision: Union[str, Sequence[str], None] = 'f7be4aad30ad'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chat_read_cursor',
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['public.chats.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['public.users.id'], ),
+    sa.PrimaryKeyConstraint('chat_id', 'user_id'),
+    schema='public'
+    )
+    op.create_index('ix_chat_messages_chat_id_id', 'chat_messages', ['chat_id', 'id'], unique=False, schema='public')
+
+    # Курсоры по уже записанным отметкам о прочтении
+    op.execute("""
+        INSERT INTO public.chat_read_cursor (chat_id, user_id, last_read_message_id, updated_at)
+        SELECT m.chat_id, r.user_id, max(m.id), coalesce(max(r.read_at), now())
+        FROM public.message_read_receipt r
+        JOIN public.chat_messages m ON m.id = r.message_id
+        GROUP BY m.chat_id, r.user_id
+    """)
+
+    # Дубли отметок мешают уникальному ограничению для INSERT ... ON CONFLICT DO NOTHING
+    op.execute("""
+        DELETE FROM public.message_read_receipt a
+        USING public.message_read_receipt b
+        WHERE a.message_id = b.message_id AND a.user_id = b.user_id AND a.id > b.id
+    """)
+    op.create_unique_constraint('uq_message_read_receipt_message_user', 'message_read_receipt',
+                                ['message_id', 'user_id'], schema='public')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_message_read_receipt_message_user', 'message_read_receipt', schema='public', type_='unique')
+    op.drop_index('ix_chat_messages_chat_id_id', table_name='chat_messages', schema='public')
+    op.drop_table('chat_read_cursor', schema='public')
@@ -0,0 +1,88 @@
+"""chat summary
+
+Revision ID: 8e4f2a6c1d93
+Revises: 3c9d1e7a2b4f
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e4f2a6c1d93'
+down_revision: Union[str, Sequence[str], None] = '3c9d1e7a2b4f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chat_summary',
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('client_id', sa.Integer(), nullable=False),
+    sa.Column('operator_id', sa.Integer(), nullable=True),
+    sa.Column('active', sa.Boolean(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_preview', sa.Text(), nullable=True),
+    sa.Column('last_sender_id', sa.Integer(), nullable=True),
+    sa.Column('last_activity_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('waiting_since', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('unread_by_client', sa.Integer(), nullable=False),
+    sa.Column('unread_by_operator', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['public.chats.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['client_id'], ['public.users.id'], ),
+    sa.ForeignKeyConstraint(['operator_id'], ['public.users.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('chat_id'),
+    schema='public'
+    )
+    op.create_index('ix_chat_summary_operator_activity', 'chat_summary',
+                    ['operator_id', 'active', sa.text('last_activity_at DESC')], unique=False, schema='public')
+
+    # Сводки по существующим чатам
+    op.execute("""
+        INSERT INTO public.chat_summary (chat_id, client_id, operator_id, active, last_activity_at,
+                                         unread_by_client, unread_by_operator)
+        SELECT id, user_id, user_support_id, active, date_created, 0, 0
+        FROM public.chats
+    """)
+    op.execute("""
+        UPDATE public.chat_summary s
+        SET last_message_id = m.id,
+            last_message_preview = left(m.message, 200),
+            last_sender_id = m.sender_id,
+            last_activity_at = greatest(s.last_activity_at, m.created_at),
+            waiting_since = (
+                SELECT w.created_at FROM public.chat_messages w
+                WHERE w.chat_id = s.chat_id AND w.id > coalesce((
+                    SELECT max(a.id) FROM public.chat_messages a
+                    WHERE a.chat_id = s.chat_id AND a.sender_id IS DISTINCT FROM s.client_id
+                ), 0)
+                ORDER BY w.id LIMIT 1
+            )
+        FROM public.chat_messages m
+        WHERE m.id = (SELECT max(l.id) FROM public.chat_messages l WHERE l.chat_id = s.chat_id)
+    """)
+    op.execute("""
+        UPDATE public.chat_summary s
+        SET unread_by_client = (
+                SELECT count(*) FROM public.chat_messages m
+                LEFT JOIN public.chat_read_cursor c ON c.chat_id = s.chat_id AND c.user_id = s.client_id
+                WHERE m.chat_id = s.chat_id AND m.id > coalesce(c.last_read_message_id, 0)
+                  AND m.sender_id IS DISTINCT FROM s.client_id
+            ),
+            unread_by_operator = (
+                SELECT count(*) FROM public.chat_messages m
+                LEFT JOIN public.chat_read_cursor c ON c.chat_id = s.chat_id AND c.user_id = s.operator_id
+                WHERE m.chat_id = s.chat_id AND m.id > coalesce(c.last_read_message_id, 0)
+                  AND m.sender_id IS DISTINCT FROM s.operator_id
+            )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_summary_operator_activity', table_name='chat_summary', schema='public')
+    op.drop_table('chat_summary', schema='public')
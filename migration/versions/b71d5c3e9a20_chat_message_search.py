@@ -0,0 +1,42 @@
+"""chat message full-text search
+
+Revision ID: b71d5c3e9a20
+Revises: 8e4f2a6c1d93
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b71d5c3e9a20'
+down_revision: Union[str, Sequence[str], None] = '8e4f2a6c1d93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_messages', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed(
+            "to_tsvector('russian'::regconfig, coalesce(message, '')) || "
+            "to_tsvector('english'::regconfig, coalesce(message, ''))",
+            persisted=True
+        ),
+        nullable=True
+    ), schema='public')
+    op.create_index('ix_chat_messages_search_vector', 'chat_messages', ['search_vector'], unique=False,
+                    schema='public', postgresql_using='gin')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_messages_search_vector', table_name='chat_messages', schema='public',
+                  postgresql_using='gin')
+    op.drop_column('chat_messages', 'search_vector', schema='public')
@@ -0,0 +1,37 @@
+"""kafka outbox
+
+Revision ID: d4a8f1c6e357
+Revises: b71d5c3e9a20
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a8f1c6e357'
+down_revision: Union[str, Sequence[str], None] = 'b71d5c3e9a20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('kafka_outbox',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('topic', sa.String(length=255), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=True),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    schema='public'
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('kafka_outbox', schema='public')
@@ -403,9 +403,8 @@ class TestUpdateQueuePriority:
         """Создает моки для зависимостей"""
         with patch('endpoints.chats.admin_chat.queue_manager') as mock_queue:
             # Добавляем клиента в очередь
-            mock_client = MagicMock()
-            mock_queue.waiting_clients = {TEST_CLIENT_ID: mock_client}
-            mock_queue.update_queue_position.return_value = 3
+            mock_queue.is_client_waiting = AsyncMock(return_value=True)
+            mock_queue.update_queue_position = AsyncMock(return_value=3)
             yield mock_queue
     
     async def test_update_queue_priority_success(self, mock_admin_user, mock_dependencies):
@@ -433,7 +432,7 @@ class TestUpdateQueuePriority:
         from endpoints.chats.admin_chat import QueuePriorityRequest
         
         # Настраиваем пустую очередь
-        mock_dependencies.waiting_clients = {}
+        mock_dependencies.is_client_waiting.return_value = False
         
         request = QueuePriorityRequest(
             client_id=999,
@@ -481,10 +480,9 @@ class TestGetDetailedQueue:
             mock_client2.timestamp.isoformat.return_value = "2023-01-01T12:01:00Z"
             mock_client2.metadata = {}
             
-            mock_queue.waiting_clients = {1: mock_client1, 2: mock_client2}
-            mock_queue.get_queue_position = AsyncMock(side_effect=lambda x: 1 if x == 1 else 2)
-            mock_queue.get_available_operators.return_value = []  # 0 операторов
-            mock_queue.get_queue_status.return_value = {"test": "data"}
+            # Очередь отдает клиентов уже в порядке позиций
+            mock_queue.list_waiting_clients = AsyncMock(return_value=[mock_client1, mock_client2])
+            mock_queue.fetch_queue_status = AsyncMock(return_value={"available_operators": 0, "test": "data"})
             
             yield mock_queue
     
@@ -559,8 +557,7 @@ class TestGetDetailedOperators:
             mock_operator2.last_activity = MagicMock()
             mock_operator2.last_activity.isoformat.return_value = "2023-01-01T11:00:00Z"
             
-            mock_queue.operators = {1: mock_operator1, 2: mock_operator2}
-            mock_assignment.get_operator_chats.return_value = [101, 102]
+            mock_queue.list_operators = AsyncMock(return_value=[mock_operator1, mock_operator2])
             
             yield {'queue': mock_queue, 'assignment': mock_assignment}
     
@@ -614,7 +611,7 @@ class TestGetActiveChats:
              patch('endpoints.chats.admin_chat.websocket_manager') as mock_ws_manager:
             
             # Настраиваем назначения чатов
-            mock_queue.chat_assignments = {101: 1, 102: 2}
+            mock_queue.list_chat_assignments = AsyncMock(return_value={101: 1, 102: 2})
             
             # Настраиваем чаты в БД
             mock_chat1 = MagicMock()
@@ -730,20 +727,22 @@ class TestGetAdminStats:
             mock_operator1 = MagicMock()
             mock_operator1.is_online = True
             mock_operator1.is_available = True
+            mock_operator1.can_accept_chat = True
             
             mock_operator2 = MagicMock()
             mock_operator2.is_online = True
             mock_operator2.is_available = False
+            mock_operator2.can_accept_chat = False
             
             mock_operator3 = MagicMock()
             mock_operator3.is_online = False
             mock_operator3.is_available = False
+            mock_operator3.can_accept_chat = False
             
-            mock_queue.operators = {1: mock_operator1, 2: mock_operator2, 3: mock_operator3}
-            mock_queue.get_available_operators.return_value = [mock_operator1]
-            mock_queue.get_queue_status.return_value = {"queue": "stats"}
+            mock_queue.list_operators = AsyncMock(return_value=[mock_operator1, mock_operator2, mock_operator3])
+            mock_queue.fetch_queue_status = AsyncMock(return_value={"queue": "stats"})
             
-            mock_assignment.get_assignment_stats.return_value = {"assignment": "stats"}
+            mock_assignment.get_assignment_stats = AsyncMock(return_value={"assignment": "stats"})
             mock_ws_manager.get_connection_stats.return_value = {"connection": "stats"}
             
             yield {
@@ -4,12 +4,16 @@
 import pytest
 import pytest_asyncio
 import json
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
 from unittest.mock import AsyncMock, patch, MagicMock
 from fastapi import status
 from fastapi.testclient import TestClient
 
-from endpoints.chats.chat_kafka import ws_chat_endpoint, handle_websocket_message
-from tests.conftest import MockWebSocket, TEST_USER_ID, TEST_CLIENT_ID, TEST_OPERATOR_ID, TEST_CHAT_ID
+from endpoints.chats.chat_kafka import ws_chat_endpoint, handle_websocket_message, send_missed_events, get_chat_history, \
+    get_unread_counts, get_operator_chats, search_chat_messages
+from utils.chat_event_log import ChatEventLog
+from tests.conftest import MockWebSocket, TEST_USER_ID, TEST_CLIENT_ID, TEST_OPERATOR_ID, TEST_CHAT_ID, TEST_ADMIN_ID
 
 
 class TestWebSocketChatEndpoint:
@@ -36,7 +40,7 @@ class TestWebSocketChatEndpoint:
             mock_ws_manager.connect_user = AsyncMock()
             mock_ws_manager.join_chat = AsyncMock()
             mock_ws_manager.leave_chat = AsyncMock()
-            mock_ws_manager.disconnect_user = AsyncMock()
+            mock_ws_manager.disconnect_user = AsyncMock(return_value=0)
             mock_ws_manager.send_to_user = AsyncMock()
             
             mock_assignment.get_operator_type = AsyncMock(return_value="client")
@@ -191,10 +195,249 @@ class TestWebSocketChatEndpoint:
         except Exception:
             pass
         
-        # Проверяем очистку при отключении
-        mock_dependencies['ws_manager'].leave_chat.assert_called_once_with(TEST_USER_ID, TEST_CHAT_ID)
+        # Проверяем очистку при отключении (последний сокет - оператор уходит в оффлайн)
+        mock_dependencies['ws_manager'].disconnect_user.assert_called_once_with(TEST_USER_ID, websocket)
         mock_dependencies['assignment'].set_operator_offline.assert_called_once_with(TEST_USER_ID)
-        mock_dependencies['ws_manager'].disconnect_user.assert_called_once_with(TEST_USER_ID)
+    
+    async def test_operator_stays_online_while_other_socket_open(self, mock_dependencies):
+        """Тест: закрытие одной вкладки оператора не переводит его в оффлайн"""
+        websocket = MockWebSocket()
+        token = "test_token"
+        
+        mock_dependencies['user'].is_client = False
+        mock_dependencies['assignment'].get_operator_type.return_value = "support"
+        mock_dependencies['ws_manager'].disconnect_user.return_value = 1
+        
+        websocket.add_received_message('{"type": "disconnect"}')
+        
+        try:
+            await ws_chat_endpoint(websocket, token, chat_id=TEST_CHAT_ID)
+        except Exception:
+            pass
+        
+        mock_dependencies['ws_manager'].disconnect_user.assert_called_once_with(TEST_USER_ID, websocket)
+        mock_dependencies['assignment'].set_operator_offline.assert_not_called()
+
+
+class TestSessionResume:
+    """Тесты досылки пропущенных событий при переподключении"""
+    
+    @pytest_asyncio.fixture
+    async def resume_mocks(self):
+        """Журнал событий в памяти, моки менеджера соединений и БД"""
+        with patch('endpoints.chats.chat_kafka.chat_fanout') as mock_fanout, \
+             patch('endpoints.chats.chat_kafka.websocket_manager') as mock_ws_manager, \
+             patch('endpoints.chats.chat_kafka.chat_db') as mock_chat_db:
+            mock_fanout.event_log = ChatEventLog(capacity=3)
+            mock_ws_manager.send_to_user = AsyncMock()
+            mock_chat_db.get_recent_messages = AsyncMock(return_value=([], False))
+            yield {
+                'event_log': mock_fanout.event_log,
+                'ws_manager': mock_ws_manager,
+                'chat_db': mock_chat_db
+            }
+    
+    async def test_replays_missing_events_from_buffer(self, resume_mocks):
+        """Пропущенные события досылаются из буфера только в переподключившийся сокет"""
+        websocket = MockWebSocket()
+        for n in range(3):
+            await resume_mocks['event_log'].append(TEST_CHAT_ID, {'type': 'message', 'payload': {'n': n}})
+        
+        await send_missed_events(TEST_USER_ID, websocket, TEST_CHAT_ID, last_seq=1)
+        
+        resume_mocks['ws_manager'].send_to_user.assert_called_once()
+        user_id, frame, target = resume_mocks['ws_manager'].send_to_user.call_args[0]
+        assert (user_id, target) == (TEST_USER_ID, websocket)
+        assert frame['type'] == 'replay'
+        assert [event['seq'] for event in frame['payload']['events']] == [2, 3]
+        resume_mocks['chat_db'].get_recent_messages.assert_not_called()
+    
+    async def test_nothing_sent_when_up_to_date(self, resume_mocks):
+        """Клиент видел все события - ничего не досылается"""
+        await resume_mocks['event_log'].append(TEST_CHAT_ID, {'type': 'message'})
+        
+        await send_missed_events(TEST_USER_ID, MockWebSocket(), TEST_CHAT_ID, last_seq=1)
+        
+        resume_mocks['ws_manager'].send_to_user.assert_not_called()
+    
+    async def test_falls_back_to_db_after_rollover(self, resume_mocks):
+        """Буфер перезаписан - последние сообщения из БД и текущий seq"""
+        for _ in range(5):
+            await resume_mocks['event_log'].append(TEST_CHAT_ID, {'type': 'message'})
+        message = MagicMock(id=42, sender_id=TEST_CLIENT_ID, message="Привет")
+        message.created_at.isoformat.return_value = "2024-01-01T12:00:00+00:00"
+        resume_mocks['chat_db'].get_recent_messages.return_value = ([message], True)
+        
+        await send_missed_events(TEST_USER_ID, MockWebSocket(), TEST_CHAT_ID, last_seq=1, last_message_id=40)
+        
+        resume_mocks['chat_db'].get_recent_messages.assert_called_once_with(TEST_CHAT_ID, 50, 40)
+        frame = resume_mocks['ws_manager'].send_to_user.call_args[0][1]
+        assert frame['type'] == 'history'
+        assert frame['payload']['seq'] == 5
+        assert frame['payload']['has_more'] is True
+        assert frame['payload']['messages'][0]['message_id'] == 42
+        assert frame['payload']['next_cursor'] is not None
+
+
+def _history_message(message_id: int, created_at: datetime) -> MagicMock:
+    """Сообщение чата для тестов истории"""
+    message = MagicMock(id=message_id, sender_id=TEST_CLIENT_ID, message=f"msg {message_id}",
+                        created_at=created_at, edited_at=None, attachments=[])
+    message.sender_type.value = "client"
+    message.status.value = "sent"
+    return message
+
+
+class TestChatHistory:
+    """Тесты для постраничной истории чата"""
+    
+    @pytest_asyncio.fixture
+    async def history_mocks(self):
+        """Мок БД и пользователь-участник чата"""
+        with patch('endpoints.chats.chat_kafka.chat_db') as mock_chat_db:
+            mock_chat_db.can_read_chat = AsyncMock(return_value=True)
+            mock_chat_db.get_messages_page = AsyncMock()
+            user = MagicMock(id=TEST_USER_ID, is_admin=False)
+            yield mock_chat_db, user
+    
+    async def test_first_page_and_cursor(self, history_mocks):
+        """Первая страница - последние сообщения по возрастанию; курсор ведет к более старым"""
+        mock_chat_db, user = history_mocks
+        now = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        page = [_history_message(10 - i, now - timedelta(minutes=i)) for i in range(3)]
+        mock_chat_db.get_messages_page.return_value = (page, True)
+        
+        result = await get_chat_history(TEST_CHAT_ID, limit=3, before=None, current_user=user)
+        
+        mock_chat_db.get_messages_page.assert_called_once_with(TEST_CHAT_ID, 3, None)
+        assert [message['message_id'] for message in result['messages']] == [8, 9, 10]
+        assert result['messages'][0]['sender_type'] == "client"
+        
+        mock_chat_db.get_messages_page.return_value = ([], False)
+        result = await get_chat_history(TEST_CHAT_ID, limit=3, before=result['next_cursor'], current_user=user)
+        
+        assert mock_chat_db.get_messages_page.call_args[0][2] == (now - timedelta(minutes=2), 8)
+        assert result == {'chat_id': TEST_CHAT_ID, 'messages': [], 'next_cursor': None}
+    
+    async def test_forbidden_for_outsider(self, history_mocks):
+        """Пользователь вне чата получает 403"""
+        mock_chat_db, user = history_mocks
+        mock_chat_db.can_read_chat.return_value = False
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await get_chat_history(TEST_CHAT_ID, limit=50, before=None, current_user=user)
+        
+        assert exc_info.value.status_code == status.HTTP_403_FORBIDDEN
+        mock_chat_db.get_messages_page.assert_not_called()
+    
+    async def test_invalid_cursor(self, history_mocks):
+        """Испорченный курсор - 400"""
+        mock_chat_db, user = history_mocks
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await get_chat_history(TEST_CHAT_ID, limit=50, before="not-a-cursor", current_user=user)
+        
+        assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
+    
+    async def test_unread_counts(self, history_mocks):
+        """Непрочитанные по чатам пользователя и общее число"""
+        mock_chat_db, user = history_mocks
+        mock_chat_db.get_unread_counts = AsyncMock(return_value={TEST_CHAT_ID: 3, TEST_CHAT_ID + 1: 0})
+        
+        result = await get_unread_counts(current_user=user)
+        
+        mock_chat_db.get_unread_counts.assert_called_once_with(TEST_USER_ID)
+        assert result == {
+            'chats': [{'chat_id': TEST_CHAT_ID, 'unread': 3}, {'chat_id': TEST_CHAT_ID + 1, 'unread': 0}],
+            'total': 3
+        }
+
+
+class TestOperatorChats:
+    """Тесты для списка чатов оператора из сводок"""
+    
+    @pytest_asyncio.fixture
+    async def mock_chat_db(self):
+        with patch('endpoints.chats.chat_kafka.chat_db') as mock_chat_db:
+            mock_chat_db.get_operator_chat_summaries = AsyncMock(return_value=[])
+            yield mock_chat_db
+    
+    async def test_lists_own_chats(self, mock_chat_db):
+        """Оператор получает свои чаты с непрочитанными и временем ожидания"""
+        waiting_since = datetime.now(timezone.utc) - timedelta(minutes=2)
+        mock_chat_db.get_operator_chat_summaries.return_value = [
+            MagicMock(chat_id=TEST_CHAT_ID, client_id=TEST_CLIENT_ID, operator_id=TEST_OPERATOR_ID,
+                      last_message_id=5, last_sender_id=TEST_CLIENT_ID, last_message_preview="Здравствуйте",
+                      last_activity_at=waiting_since, unread_by_operator=2, waiting_since=waiting_since)
+        ]
+        user = MagicMock(id=TEST_OPERATOR_ID, is_admin=False)
+        
+        result = await get_operator_chats(operator_id=None, limit=20, current_user=user)
+        
+        mock_chat_db.get_operator_chat_summaries.assert_called_once_with(TEST_OPERATOR_ID, 20)
+        chat = result['chats'][0]
+        assert chat['last_message'] == {'message_id': 5, 'sender_id': TEST_CLIENT_ID, 'preview': "Здравствуйте"}
+        assert chat['unread'] == 2
+        assert 115 <= chat['waiting_seconds'] <= 125
+    
+    async def test_other_operator_requires_admin(self, mock_chat_db):
+        """Чаты другого оператора доступны только администратору"""
+        user = MagicMock(id=TEST_OPERATOR_ID, is_admin=False)
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await get_operator_chats(operator_id=TEST_OPERATOR_ID + 1, limit=20, current_user=user)
+        assert exc_info.value.status_code == status.HTTP_403_FORBIDDEN
+        
+        user.is_admin = True
+        await get_operator_chats(operator_id=TEST_OPERATOR_ID + 1, limit=20, current_user=user)
+        mock_chat_db.get_operator_chat_summaries.assert_called_once_with(TEST_OPERATOR_ID + 1, 20)
+
+
+class TestMessageSearch:
+    """Тесты для полнотекстового поиска по сообщениям"""
+    
+    @pytest_asyncio.fixture
+    async def mock_chat_db(self):
+        with patch('endpoints.chats.chat_kafka.chat_db') as mock_chat_db:
+            mock_chat_db.search_messages = AsyncMock(return_value=([], False))
+            yield mock_chat_db
+    
+    async def test_hits_and_cursor(self, mock_chat_db):
+        """Результаты с подсветкой; курсор следующей страницы - (rank, id) последнего результата"""
+        created_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        hit = MagicMock(id=42, chat_id=TEST_CHAT_ID, sender_id=TEST_CLIENT_ID, created_at=created_at,
+                        rank=0.10000000149011612, headline="проект <mark>договора</mark> аренды")
+        mock_chat_db.search_messages.return_value = ([hit], True)
+        admin = MagicMock(id=TEST_ADMIN_ID, is_admin=True)
+        
+        result = await search_chat_messages(q="договор", chat_id=TEST_CHAT_ID, participant_id=None, date_from=None,
+                                            date_to=None, limit=1, cursor=None, current_user=admin)
+        
+        assert result['hits'][0]['headline'] == "проект <mark>договора</mark> аренды"
+        assert mock_chat_db.search_messages.call_args.kwargs['reader_id'] is None
+        
+        await search_chat_messages(q="договор", chat_id=TEST_CHAT_ID, participant_id=None, date_from=None,
+                                   date_to=None, limit=1, cursor=result['next_cursor'], current_user=admin)
+        assert mock_chat_db.search_messages.call_args.kwargs['after'] == (0.10000000149011612, 42)
+    
+    async def test_non_admin_searches_own_chats(self, mock_chat_db):
+        """Не администратор ищет только по доступным ему чатам"""
+        lawyer = MagicMock(id=TEST_OPERATOR_ID, is_admin=False)
+        
+        result = await search_chat_messages(q="договор", chat_id=None, participant_id=TEST_CLIENT_ID, date_from=None,
+                                            date_to=None, limit=20, cursor=None, current_user=lawyer)
+        
+        assert result == {'hits': [], 'next_cursor': None}
+        kwargs = mock_chat_db.search_messages.call_args.kwargs
+        assert kwargs['reader_id'] == TEST_OPERATOR_ID
+        assert kwargs['participant_id'] == TEST_CLIENT_ID
+    
+    async def test_invalid_cursor(self, mock_chat_db):
+        """Испорченный курсор - 400"""
+        with pytest.raises(HTTPException) as exc_info:
+            await search_chat_messages(q="договор", chat_id=None, participant_id=None, date_from=None,
+                                       date_to=None, limit=20, cursor="bad", current_user=MagicMock(is_admin=True))
+        assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
 
 
 class TestWebSocketMessageHandlers:
@@ -207,12 +450,14 @@ class TestWebSocketMessageHandlers:
              patch('endpoints.chats.chat_kafka.kafka_producer') as mock_producer, \
              patch('endpoints.chats.chat_kafka.queue_manager') as mock_queue, \
              patch('endpoints.chats.chat_kafka.assignment_manager') as mock_assignment, \
-             patch('endpoints.chats.chat_kafka.websocket_manager') as mock_ws_manager:
+             patch('endpoints.chats.chat_kafka.websocket_manager') as mock_ws_manager, \
+             patch('endpoints.chats.chat_kafka.chat_fanout') as mock_fanout, \
+             patch('endpoints.chats.chat_kafka.chat_message_writer') as mock_writer:
             
             # Настройка моков
             mock_message = MagicMock()
             mock_message.id = 123
-            mock_chat_db.add_message.return_value = mock_message
+            mock_writer.add_message = AsyncMock(return_value=mock_message)
             
             yield {
                 'chat_db': mock_chat_db,
@@ -220,6 +465,8 @@ class TestWebSocketMessageHandlers:
                 'queue': mock_queue,
                 'assignment': mock_assignment,
                 'ws_manager': mock_ws_manager,
+                'fanout': mock_fanout,
+                'writer': mock_writer,
                 'message': mock_message
             }
     
@@ -236,7 +483,7 @@ class TestWebSocketMessageHandlers:
         await handle_websocket_message(user_id, user_role, chat_id, message_data)
         
         # Проверяем сохранение в БД
-        mock_handlers['chat_db'].add_message.assert_called_once_with(
+        mock_handlers['writer'].add_message.assert_called_once_with(
             chat_id, user_id, user_role, "Тестовое сообщение"
         )
         
@@ -285,7 +532,7 @@ class TestWebSocketMessageHandlers:
         }
         
         # Настраиваем клиента в очереди
-        mock_handlers['queue'].waiting_clients = {TEST_CLIENT_ID: MagicMock()}
+        mock_handlers['queue'].is_client_waiting = AsyncMock(return_value=True)
         mock_handlers['assignment'].assign_chat_to_operator.return_value = True
         
         await handle_websocket_message(user_id, user_role, chat_id, message_data)
@@ -325,7 +572,7 @@ class TestWebSocketMessageHandlers:
         }
         
         # Настраиваем что клиента нет в очереди
-        mock_handlers['queue'].waiting_clients = {}
+        mock_handlers['queue'].is_client_waiting = AsyncMock(return_value=False)
         
         # Мокаем WebSocket менеджер для отправки ошибки
         mock_handlers['ws_manager'].send_to_user = AsyncMock()
@@ -495,8 +742,8 @@ class TestWebSocketMessageHandlers:
         await handle_websocket_message(user_id, user_role, chat_id, message_data)
         
         # Проверяем рассылку индикатора печати
-        mock_handlers['ws_manager'].broadcast_to_chat.assert_called_once()
-        call_args = mock_handlers['ws_manager'].broadcast_to_chat.call_args
+        mock_handlers['fanout'].broadcast_to_chat.assert_called_once()
+        call_args = mock_handlers['fanout'].broadcast_to_chat.call_args
         
         assert call_args[0][0] == TEST_CHAT_ID  # chat_id
         assert call_args[1]['exclude_user'] == TEST_USER_ID  # исключить отправителя
@@ -517,6 +764,8 @@ class TestWebSocketMessageHandlers:
             }
         }
         
+        mock_handlers['chat_db'].mark_messages_read = AsyncMock(return_value=123)
+        
         await handle_websocket_message(user_id, user_role, chat_id, message_data)
         
         # Проверяем отметку сообщений как прочитанных
@@ -525,12 +774,13 @@ class TestWebSocketMessageHandlers:
         )
         
         # Проверяем уведомление других участников
-        mock_handlers['ws_manager'].broadcast_to_chat.assert_called_once()
-        call_args = mock_handlers['ws_manager'].broadcast_to_chat.call_args
+        mock_handlers['fanout'].broadcast_to_chat.assert_called_once()
+        call_args = mock_handlers['fanout'].broadcast_to_chat.call_args
         
         message_payload = call_args[0][1]
         assert message_payload['type'] == 'messages_read'
         assert message_payload['payload']['upto_message_id'] == 123
+        assert message_payload['payload']['last_read_message_id'] == 123
     
     async def test_handle_operator_status(self, mock_handlers):
         """Тест обработки изменения статуса оператора"""
@@ -0,0 +1,133 @@
+"""
+Тесты для RedisPubSub - чтение pub/sub и диспетчеризация callback'ов (на fakeredis)
+"""
+import asyncio
+import json
+
+import pytest
+import pytest_asyncio
+
+from endpoints.chats.redis_bridge import RedisPubSub
+
+
+async def _wait_for(condition, timeout: float = 2.0):
+    """Ожидание условия без привязки к точному времени доставки"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "условие не выполнено вовремя"
+        await asyncio.sleep(0.01)
+
+
+class TestRedisPubSub:
+    """Тесты для RedisPubSub"""
+
+    @pytest_asyncio.fixture
+    async def server(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        return fakeredis.FakeServer()
+
+    @pytest_asyncio.fixture
+    async def publisher(self, server):
+        import fakeredis
+        client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        yield client
+        await client.aclose()
+
+    def _bridge(self, server, **kwargs) -> RedisPubSub:
+        import fakeredis
+        bridge = RedisPubSub("redis://localhost:6379/0", **kwargs)
+        bridge.redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        bridge.pubsub = bridge.redis.pubsub(ignore_subscribe_messages=True)
+        return bridge
+
+    async def test_delivers_and_resumes_after_full_unsubscribe(self, server, publisher):
+        """Сообщения доставляются, а после отписки от всех каналов чтение возобновляется"""
+        bridge = self._bridge(server)
+        received = []
+
+        async def callback(channel, payload):
+            received.append((channel, payload))
+
+        await bridge.start(callback)
+        try:
+            await bridge.subscribe("chat:1")
+            await publisher.publish("chat:1", json.dumps({"n": 1}))
+            await _wait_for(lambda: len(received) == 1)
+
+            await bridge.unsubscribe("chat:1")
+            await _wait_for(lambda: not bridge.pubsub.subscribed)
+
+            await bridge.subscribe("chat:2")
+            await publisher.publish("chat:2", json.dumps({"n": 2}))
+            await _wait_for(lambda: len(received) == 2)
+            assert received == [("chat:1", {"n": 1}), ("chat:2", {"n": 2})]
+        finally:
+            await bridge.stop()
+
+    async def test_subscriptions_are_batched(self, server):
+        """Подписки одной итерации event loop уходят одной командой"""
+        bridge = self._bridge(server)
+        commands = []
+        subscribe = bridge.pubsub.subscribe
+
+        async def spy(*channels):
+            commands.append(set(channels))
+            await subscribe(*channels)
+
+        bridge.pubsub.subscribe = spy
+        await bridge.start(lambda channel, payload: None)
+        try:
+            await asyncio.gather(*(bridge.subscribe(f"chat:{i}") for i in range(50)))
+            assert commands == [{f"chat:{i}" for i in range(50)}]
+            assert len(bridge.pubsub.channels) == 50
+        finally:
+            await bridge.stop()
+
+    async def test_slow_channel_does_not_block_others(self, server, publisher):
+        """Медленный callback одного канала не задерживает другие, порядок в канале сохраняется"""
+        bridge = self._bridge(server, max_concurrency=4)
+        slow_release = asyncio.Event()
+        received = []
+
+        async def callback(channel, payload):
+            if payload["n"] == 0:
+                await slow_release.wait()
+            received.append((channel, payload["n"]))
+
+        await bridge.start(callback)
+        try:
+            await bridge.subscribe("chat:1")
+            await bridge.subscribe("chat:2")
+            for n in range(3):
+                await publisher.publish("chat:1", json.dumps({"n": n}))
+            await publisher.publish("chat:2", json.dumps({"n": 10}))
+
+            await _wait_for(lambda: ("chat:2", 10) in received)
+            assert [n for channel, n in received if channel == "chat:1"] == []
+
+            slow_release.set()
+            await _wait_for(lambda: len(received) == 4)
+            assert [n for channel, n in received if channel == "chat:1"] == [0, 1, 2]
+        finally:
+            await bridge.stop()
+
+    async def test_pattern_subscription(self, server, publisher):
+        """В режиме шаблона узел получает все каналы чатов без подписки на каждый"""
+        bridge = self._bridge(server, pattern="chat:*")
+        received = []
+
+        async def callback(channel, payload):
+            received.append(channel)
+
+        await bridge.start(callback)
+        try:
+            await bridge.subscribe("chat:1")
+            assert bridge.pubsub.channels == {}
+
+            await publisher.publish("chat:1", json.dumps({}))
+            await publisher.publish("chat:2", json.dumps({}))
+            await _wait_for(lambda: len(received) == 2)
+            assert sorted(received) == ["chat:1", "chat:2"]
+        finally:
+            await bridge.stop()
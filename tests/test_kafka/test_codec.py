@@ -0,0 +1,129 @@
+"""
+Тесты для кодека событий Kafka и микробенчмарк сериализации: схемы-словари
+с orjson против прежнего пути pydantic model_dump + json.dumps(default=str)
+"""
+import json
+import time
+import uuid
+from datetime import datetime, UTC
+
+import pytest
+
+from config.kafka_config import (
+    KafkaTopics, ChatEvent, ChatEventType, OperatorEventType, AdminActionType
+)
+from utils.kafka_codec import (
+    CHAT_EVENT, OPERATOR_EVENT, ADMIN_ACTION_EVENT, encode_event, decode_event, topic_decoder
+)
+
+
+BENCHMARK_EVENTS = 20_000
+
+# Измеренное ускорение полного цикла (сборка + сериализация + чтение) -
+# ~3-5x с orjson (CPython 3.11); порог с запасом против шума машины.
+# Без orjson кодек идет через json и ускорение не гарантируется
+MIN_SPEEDUP = 2.0
+
+
+def _chat_event_fields() -> dict:
+    return dict(
+        event_id=str(uuid.uuid4()),
+        event_type=ChatEventType.MESSAGE_SENT,
+        timestamp=datetime.now(UTC),
+        chat_id=100,
+        sender_id=1,
+        sender_type="client",
+        message_id=42,
+        message_text="Здравствуйте, нужна консультация",
+    )
+
+
+class TestEventCodec:
+    """Тесты для схем и сериализации событий"""
+
+    def test_build_matches_pydantic_model(self):
+        """Событие по схеме совпадает с model_dump() pydantic-модели"""
+        fields = _chat_event_fields()
+
+        assert CHAT_EVENT.build(**fields) == ChatEvent(**fields).model_dump()
+
+    def test_build_requires_mandatory_fields(self):
+        """Без обязательного поля событие не собирается"""
+        with pytest.raises(ValueError, match="event_id"):
+            CHAT_EVENT.build(event_type=ChatEventType.CHAT_CREATED, timestamp=datetime.now(UTC))
+
+    def test_round_trip_restores_types(self):
+        """Прочитанное событие содержит datetime и Enum, как при отправке"""
+        event = OPERATOR_EVENT.build(
+            event_id="e1",
+            event_type=OperatorEventType.OPERATOR_ONLINE,
+            timestamp=datetime(2024, 5, 1, 12, 30, tzinfo=UTC),
+            operator_id=7,
+            operator_type="support",
+        )
+
+        decoded = topic_decoder(KafkaTopics.OPERATOR_EVENTS)(encode_event(event))
+
+        assert decoded == event
+        assert decoded['event_type'] is OperatorEventType.OPERATOR_ONLINE
+        assert decoded['timestamp'] == datetime(2024, 5, 1, 12, 30, tzinfo=UTC)
+
+    def test_reads_events_of_previous_format(self):
+        """События, записанные прежним json.dumps(default=str), читаются кодеком"""
+        event = ChatEvent(**_chat_event_fields()).model_dump()
+        legacy = json.dumps(event, default=str).encode('utf-8')
+
+        decoded = decode_event(legacy, CHAT_EVENT)
+
+        assert decoded['timestamp'] == event['timestamp']
+        assert decoded['event_type'] is ChatEventType.MESSAGE_SENT
+
+    def test_unknown_values_are_kept(self):
+        """Неизвестный тип события и некорректная дата остаются строками"""
+        raw = b'{"event_id":"e1","event_type":"future_action","timestamp":"yesterday"}'
+
+        decoded = decode_event(raw, ADMIN_ACTION_EVENT)
+
+        assert decoded['event_type'] == "future_action"
+        assert decoded['timestamp'] == "yesterday"
+        assert AdminActionType.FORCE_TRANSFER.value != decoded['event_type']
+
+
+@pytest.mark.slow
+class TestCodecBenchmark:
+    """Микробенчмарк сериализации событий (медленный, зависит от загрузки машины: pytest -m slow)"""
+
+    @staticmethod
+    def _legacy_cycle():
+        event = ChatEvent(**_chat_event_fields())
+        raw = json.dumps(event.model_dump(), default=str).encode('utf-8')
+        return json.loads(raw.decode('utf-8'))
+
+    @staticmethod
+    def _codec_cycle(decode):
+        return decode(encode_event(CHAT_EVENT.build(**_chat_event_fields())))
+
+    def test_codec_is_faster_than_pydantic_path(self):
+        """Сборка, сериализация и чтение события через кодек быстрее прежнего пути"""
+        pytest.importorskip("orjson")
+        decode = topic_decoder(KafkaTopics.CHAT_EVENTS)
+
+        def measure(cycle, *args) -> float:
+            best = float('inf')
+            for _ in range(3):
+                started = time.perf_counter()
+                for _ in range(BENCHMARK_EVENTS):
+                    cycle(*args)
+                best = min(best, time.perf_counter() - started)
+            return best / BENCHMARK_EVENTS
+
+        legacy = measure(self._legacy_cycle)
+        codec = measure(self._codec_cycle, decode)
+        # Общая часть обоих путей - uuid4 и datetime.now; вычитаем ее, чтобы сравнить сами кодеки
+        baseline = measure(_chat_event_fields)
+
+        speedup = (legacy - baseline) / (codec - baseline)
+        assert speedup >= MIN_SPEEDUP, (
+            f"legacy {legacy * 1e6:.2f} us/event, codec {codec * 1e6:.2f} us/event, "
+            f"common {baseline * 1e6:.2f} us/event, speedup {speedup:.1f}x"
+        )
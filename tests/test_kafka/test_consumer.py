@@ -4,9 +4,12 @@
 import pytest
 import pytest_asyncio
 import asyncio
+import json
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, patch, MagicMock
 
 from utils.kafka_consumer import SupportChatKafkaConsumer, MockSupportChatKafkaConsumer, SupportChatEventHandlers
+from utils.kafka_dedup import EventDeduplicator
 from config.kafka_config import KafkaTopics, ChatEventType, SupportQueueEventType, OperatorEventType
 
 
@@ -83,7 +86,7 @@ class TestSupportChatKafkaConsumer:
             
             mock_kafka_consumer.side_effect = create_consumer_mock
             
-            consumer = SupportChatKafkaConsumer()
+            consumer = SupportChatKafkaConsumer(batched=False)
             await consumer.start()
             yield consumer, consumer_instances
             await consumer.stop()
@@ -91,6 +94,8 @@ class TestSupportChatKafkaConsumer:
     async def test_real_consumer_initialization(self):
         """Тест инициализации реального Consumer"""
         consumer = SupportChatKafkaConsumer()
+        # По умолчанию - consumer на топик (пакетный режим требует переноса offset'ов)
+        assert not consumer.batched
         assert consumer.consumers == {}
         assert consumer.handlers == {}
         assert consumer.running_tasks == set()
@@ -159,7 +164,7 @@ class TestSupportChatKafkaConsumer:
             consumer_instance.__aiter__ = lambda self: async_messages()
             mock_kafka_consumer.return_value = consumer_instance
             
-            consumer = SupportChatKafkaConsumer()
+            consumer = SupportChatKafkaConsumer(batched=False)
             
             # Регистрируем обработчики
             chat_handler = AsyncMock()
@@ -210,7 +215,7 @@ class TestSupportChatKafkaConsumer:
             consumer_instance.__aiter__ = lambda self: async_messages()
             mock_kafka_consumer.return_value = consumer_instance
             
-            consumer = SupportChatKafkaConsumer()
+            consumer = SupportChatKafkaConsumer(batched=False)
             
             # Регистрируем обработчик который вызывает ошибку
             error_handler = AsyncMock(side_effect=Exception("Handler error"))
@@ -243,7 +248,7 @@ class TestSupportChatKafkaConsumer:
             consumer_instance.__aiter__ = lambda self: async_messages()
             mock_kafka_consumer.return_value = consumer_instance
             
-            consumer = SupportChatKafkaConsumer()
+            consumer = SupportChatKafkaConsumer(batched=False)
             await consumer.start()
             await asyncio.sleep(0.1)
             await consumer.stop()
@@ -423,7 +428,9 @@ class TestSupportChatEventHandlers:
         
         await event_handlers.handle_chat_assigned(event_data)
         
-        websocket_manager.notify_chat_assigned.assert_called_once_with(123, 456, 789)
+        websocket_manager.notify_chat_assigned.assert_called_once_with(
+            123, 456, 789, chat_fanout=event_handlers.chat_fanout
+        )
     
     async def test_handle_chat_transferred(self, event_handlers, websocket_manager):
         """Тест обработки события перевода чата"""
@@ -439,7 +446,7 @@ class TestSupportChatEventHandlers:
         await event_handlers.handle_chat_transferred(event_data)
         
         websocket_manager.notify_chat_transferred.assert_called_once_with(
-            123, 456, 789, "test transfer"
+            123, 456, 789, "test transfer", chat_fanout=event_handlers.chat_fanout
         )
     
     async def test_handle_lawyer_assigned(self, event_handlers, assignment_manager, websocket_manager):
@@ -477,6 +484,194 @@ class TestSupportChatEventHandlers:
         )
 
 
+def _record(topic: str, offset: int, event: dict, partition: int = 0):
+    """Сообщение Kafka, как его возвращает getmany() без value_deserializer"""
+    return SimpleNamespace(topic=topic, partition=partition, offset=offset, value=json.dumps(event).encode('utf-8'))
+
+
+class _FakeBatchConsumer:
+    """AIOKafkaConsumer для пакетного режима: выдает заданные пачки и запоминает commit()"""
+    
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.commits = []
+        self.seeks = []
+        self.processed = asyncio.Event()
+    
+    async def start(self):
+        pass
+    
+    async def stop(self):
+        pass
+    
+    async def getmany(self, timeout_ms=0, max_records=None):
+        if not self.batches:
+            self.processed.set()
+            await asyncio.sleep(3600)
+        batch = self.batches.pop(0)
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+    
+    def seek(self, tp, offset):
+        self.seeks.append((tp, offset))
+    
+    async def commit(self, offsets):
+        self.commits.append(offsets)
+
+
+class TestBatchedConsumer:
+    """Тесты для пакетного режима Consumer (getmany, обработка по ключам)"""
+    
+    async def test_orders_within_key_and_runs_keys_in_parallel(self):
+        """События одного чата идут по порядку, другие чаты обрабатываются параллельно"""
+        consumer = SupportChatKafkaConsumer(batched=True)
+        calls = []
+        release_chat_1 = asyncio.Event()
+        
+        async def handler(event_data):
+            calls.append(("start", event_data['chat_id'], event_data['message_id']))
+            if event_data['message_id'] == 1:
+                await release_chat_1.wait()
+            calls.append(("end", event_data['chat_id'], event_data['message_id']))
+        
+        consumer.register_handler(KafkaTopics.CHAT_EVENTS, ChatEventType.MESSAGE_SENT.value, handler)
+        messages = [
+            _record(KafkaTopics.CHAT_EVENTS, n, {"event_type": "message_sent", "chat_id": chat_id, "message_id": n})
+            for n, chat_id in enumerate([1, 1, 2], start=1)
+        ]
+        
+        processing = asyncio.create_task(consumer.process_batch(messages))
+        for _ in range(5):
+            await asyncio.sleep(0)
+        
+        # Чат 2 обработан, пока первое событие чата 1 еще выполняется; второе событие чата 1 ждет
+        assert ("end", 2, 3) in calls
+        assert ("start", 1, 2) not in calls
+        
+        release_chat_1.set()
+        await processing
+        assert [call for call in calls if call[1] == 1] == [
+            ("start", 1, 1), ("end", 1, 1), ("start", 1, 2), ("end", 1, 2)
+        ]
+    
+    async def test_events_are_decoded_by_topic(self):
+        """Событие декодируется по схеме своего топика и попадает к обработчику этого топика"""
+        consumer = SupportChatKafkaConsumer(batched=True)
+        handler = AsyncMock()
+        consumer.register_handler(KafkaTopics.OPERATOR_EVENTS, OperatorEventType.OPERATOR_ONLINE.value, handler)
+        
+        await consumer.process_batch([
+            _record(KafkaTopics.OPERATOR_EVENTS, 0, {"event_type": "operator_online", "operator_id": 5}),
+            SimpleNamespace(topic=KafkaTopics.CHAT_EVENTS, partition=0, offset=1, value=b"not json"),
+        ])
+        
+        handler.assert_called_once()
+        assert handler.call_args.args[0]['event_type'] is OperatorEventType.OPERATOR_ONLINE
+        assert consumer.get_stats()['failed_events'] == 1
+    
+    async def test_commits_after_batch_is_handled(self):
+        """Один клиент на все топики; offset'ы фиксируются после обработки пачки"""
+        handled = []
+        
+        async def handler(event_data):
+            await asyncio.sleep(0)
+            handled.append(event_data['chat_id'])
+        
+        tp_chat, tp_queue = ("chat_events", 0), ("support_queue", 1)
+        fake = _FakeBatchConsumer([{
+            tp_chat: [_record(KafkaTopics.CHAT_EVENTS, 10, {"event_type": "chat_created", "chat_id": 1}),
+                      _record(KafkaTopics.CHAT_EVENTS, 11, {"event_type": "chat_created", "chat_id": 2})],
+            tp_queue: [_record(KafkaTopics.SUPPORT_QUEUE, 7, {"event_type": "client_waiting", "client_id": 3},
+                               partition=1)],
+        }])
+        consumer = SupportChatKafkaConsumer(batched=True)
+        consumer.register_handler(KafkaTopics.CHAT_EVENTS, ChatEventType.CHAT_CREATED.value, handler)
+        
+        with patch('utils.kafka_consumer.AIOKafkaConsumer', return_value=fake) as consumer_class:
+            await consumer.start()
+            await asyncio.wait_for(fake.processed.wait(), timeout=1)
+            await consumer.stop()
+        
+        assert consumer_class.call_args.args == tuple([
+            KafkaTopics.CHAT_EVENTS, KafkaTopics.SUPPORT_QUEUE, KafkaTopics.OPERATOR_EVENTS,
+            KafkaTopics.CHAT_ASSIGNMENTS, KafkaTopics.ADMIN_ACTIONS
+        ])
+        assert consumer_class.call_args.kwargs['enable_auto_commit'] is False
+        assert sorted(handled) == [1, 2]
+        assert fake.commits == [{tp_chat: 12, tp_queue: 8}]
+        assert consumer.get_stats()['events'] == 3
+    
+    async def test_errors_do_not_stop_consumption(self):
+        """Ошибка чтения или обработки пачки не останавливает consumer; необработанная пачка читается повторно"""
+        tp = ("chat_events", 0)
+        batch = {tp: [_record(KafkaTopics.CHAT_EVENTS, 5, {"event_id": "e1", "event_type": "chat_created", "chat_id": 1})]}
+        fake = _FakeBatchConsumer([RuntimeError("broker unavailable"), batch, batch])
+        consumer = SupportChatKafkaConsumer(batched=True, dedup=EventDeduplicator())
+        handler = AsyncMock()
+        consumer.register_handler(KafkaTopics.CHAT_EVENTS, ChatEventType.CHAT_CREATED.value, handler)
+        
+        process_batch = consumer.process_batch
+        failures = [RuntimeError("redis unavailable")]
+        
+        async def flaky_process_batch(messages):
+            if failures:
+                raise failures.pop()
+            await process_batch(messages)
+        
+        with patch.object(consumer, 'process_batch', flaky_process_batch), \
+                patch('utils.kafka_consumer.KAFKA_CONSUMER_ERROR_BACKOFF', 0), \
+                patch('utils.kafka_consumer.AIOKafkaConsumer', return_value=fake):
+            await consumer.start()
+            await asyncio.wait_for(fake.processed.wait(), timeout=1)
+            await consumer.stop()
+        
+        handler.assert_awaited_once()
+        assert fake.seeks == [(tp, 5)]
+        assert fake.commits == [{tp: 6}]
+        stats = consumer.get_stats()
+        assert stats['batch_errors'] == 2
+        assert stats['last_error'] == "redis unavailable"
+    
+    async def test_redelivered_events_are_skipped(self):
+        """Повторно доставленные события и копии внутри пачки не обрабатываются второй раз"""
+        consumer = SupportChatKafkaConsumer(batched=True, dedup=EventDeduplicator())
+        handler = AsyncMock()
+        consumer.register_handler(KafkaTopics.CHAT_EVENTS, ChatEventType.CHAT_CREATED.value, handler)
+        batch = [
+            _record(KafkaTopics.CHAT_EVENTS, 0, {"event_id": "e1", "event_type": "chat_created", "chat_id": 1}),
+            _record(KafkaTopics.CHAT_EVENTS, 1, {"event_id": "e1", "event_type": "chat_created", "chat_id": 1}),
+            _record(KafkaTopics.CHAT_EVENTS, 2, {"event_id": "e2", "event_type": "chat_created", "chat_id": 2}),
+        ]
+        
+        await consumer.process_batch(batch)
+        await consumer.process_batch(batch)
+        
+        assert handler.call_count == 2
+        stats = consumer.get_stats()
+        assert stats['duplicates'] == 4
+        assert stats['dedup']['window_size'] == 2
+    
+    async def test_failed_handler_is_retried_then_skipped(self):
+        """Упавший обработчик вызывается повторно; после всех попыток событие пропускается и не запоминается"""
+        consumer = SupportChatKafkaConsumer(batched=True, dedup=EventDeduplicator(),
+                                            handler_attempts=3, retry_backoff=0)
+        flaky = AsyncMock(side_effect=[RuntimeError("db"), None])
+        broken = AsyncMock(side_effect=RuntimeError("db"))
+        consumer.register_handler(KafkaTopics.CHAT_EVENTS, ChatEventType.CHAT_CREATED.value, flaky)
+        consumer.register_handler(KafkaTopics.CHAT_EVENTS, ChatEventType.CHAT_CLOSED.value, broken)
+        
+        await consumer.process_batch([
+            _record(KafkaTopics.CHAT_EVENTS, 0, {"event_id": "ok", "event_type": "chat_created", "chat_id": 1}),
+            _record(KafkaTopics.CHAT_EVENTS, 1, {"event_id": "bad", "event_type": "chat_closed", "chat_id": 2}),
+        ])
+        
+        assert flaky.call_count == 2
+        assert broken.call_count == 3
+        assert consumer.get_stats()['failed_events'] == 1
+        assert await consumer.dedup.filter_seen(["ok", "bad"]) == {"ok"}
+
+
 class TestConsumerIntegration:
     """Интеграционные тесты Consumer"""
     
@@ -0,0 +1,68 @@
+"""
+Тесты для окна дедупликации событий Kafka (EventDeduplicator, RedisEventDeduplicator на fakeredis)
+"""
+from unittest.mock import patch
+
+import pytest
+import pytest_asyncio
+
+from utils.kafka_dedup import EventDeduplicator, RedisEventDeduplicator
+
+
+class TestEventDeduplicator:
+    """Тесты для локального окна дедупликации"""
+
+    async def test_evicts_least_recent_over_limit(self):
+        """Сверх max_size вытесняются самые давние события"""
+        dedup = EventDeduplicator(max_size=2, ttl=60)
+
+        await dedup.mark_processed(["a", "b"])
+        await dedup.mark_processed(["c"])
+
+        assert await dedup.filter_seen(["a", "b", "c"]) == {"b", "c"}
+        assert dedup.get_stats()['window_size'] == 2
+
+    async def test_forgets_after_ttl(self):
+        """Событие помнится не дольше ttl"""
+        dedup = EventDeduplicator(max_size=10, ttl=5)
+        with patch('utils.kafka_dedup.time.monotonic', return_value=100.0):
+            await dedup.mark_processed(["a"])
+        with patch('utils.kafka_dedup.time.monotonic', return_value=104.0):
+            assert await dedup.filter_seen(["a"]) == {"a"}
+        with patch('utils.kafka_dedup.time.monotonic', return_value=106.0):
+            assert await dedup.filter_seen(["a"]) == set()
+        assert dedup.get_stats()['window_size'] == 0
+
+
+class TestRedisEventDeduplicator:
+    """Тесты для общего окна дедупликации в Redis"""
+
+    @pytest_asyncio.fixture
+    async def server(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        return fakeredis.FakeServer()
+
+    def _dedup(self, server) -> RedisEventDeduplicator:
+        import fakeredis
+        return RedisEventDeduplicator(fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+                                      key_prefix="test:kafka_event:", max_size=10, ttl=60)
+
+    async def test_window_is_shared_between_replicas(self, server):
+        """Событие, обработанное одним узлом, считается повтором на другом"""
+        first, second = self._dedup(server), self._dedup(server)
+
+        await first.mark_processed(["a"])
+
+        assert await second.filter_seen(["a", "b"]) == {"a"}
+        # Найденное в Redis запоминается локально
+        assert second.get_stats()['window_size'] == 1
+        assert await second._redis.ttl("test:kafka_event:a") > 0
+
+    async def test_redis_errors_fall_back_to_local_window(self, server):
+        """При недоступности Redis дедупликация продолжает работать локально"""
+        dedup = self._dedup(server)
+        server.connected = False
+
+        await dedup.mark_processed(["a"])
+
+        assert await dedup.filter_seen(["a", "b"]) == {"a"}
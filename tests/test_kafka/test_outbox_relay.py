@@ -0,0 +1,107 @@
+"""
+Тесты для отправки событий Kafka из outbox (KafkaOutboxRelay)
+"""
+import asyncio
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+from utils.kafka_producer import KafkaEventRecord, chat_assigned_event
+from utils.outbox_relay import KafkaOutboxRelay, outbox_rows
+
+
+class _FakeOutboxDb:
+    """kafka_outbox в памяти с семантикой chat_db.drain_outbox"""
+
+    def __init__(self):
+        self.rows: List[SimpleNamespace] = []
+        self._next_id = 1
+
+    def add(self, count: int):
+        for _ in range(count):
+            self.rows.append(SimpleNamespace(id=self._next_id, topic="chat_events",
+                                             key=f"chat_{self._next_id}", payload={"n": self._next_id}))
+            self._next_id += 1
+
+    async def drain_outbox(self, limit, publish):
+        events = self.rows[:limit]
+        if not events:
+            return 0
+        await publish(events)
+        # Удаление только после успешной отправки - иначе "откат"
+        self.rows = self.rows[len(events):]
+        return len(events)
+
+
+class _FakeProducer:
+    """Producer, запоминающий отправленные пачки"""
+
+    def __init__(self):
+        self.batches: List[List[KafkaEventRecord]] = []
+        self.fail = False
+
+    async def send_events(self, records):
+        if self.fail:
+            raise RuntimeError("broker unavailable")
+        self.batches.append(list(records))
+
+
+class TestKafkaOutboxRelay:
+    """Тесты для KafkaOutboxRelay"""
+
+    async def test_relays_in_order_and_prunes(self):
+        """События отправляются пачками в порядке записи, доставленные удаляются"""
+        db, producer = _FakeOutboxDb(), _FakeProducer()
+        db.add(5)
+        relay = KafkaOutboxRelay(db, producer, batch_size=3)
+
+        assert await relay.relay_once() == 3
+        assert await relay.relay_once() == 2
+        assert await relay.relay_once() == 0
+
+        assert [[record.event["n"] for record in batch] for batch in producer.batches] == [[1, 2, 3], [4, 5]]
+        assert producer.batches[0][0] == KafkaEventRecord("chat_events", "chat_1", {"n": 1})
+        assert db.rows == []
+        assert relay.get_stats()['relayed'] == 5
+
+    async def test_failed_batch_stays_in_outbox(self):
+        """Недоставленная пачка остается в outbox и отправляется повторно"""
+        db, producer = _FakeOutboxDb(), _FakeProducer()
+        db.add(2)
+        relay = KafkaOutboxRelay(db, producer, batch_size=10)
+
+        producer.fail = True
+        with pytest.raises(RuntimeError):
+            await relay.relay_once()
+        assert len(db.rows) == 2
+
+        producer.fail = False
+        assert await relay.relay_once() == 2
+        assert db.rows == []
+
+    async def test_notify_wakes_background_relay(self):
+        """notify() запускает отправку, не дожидаясь poll_interval; полные пачки идут подряд"""
+        db, producer = _FakeOutboxDb(), _FakeProducer()
+        relay = KafkaOutboxRelay(db, producer, batch_size=2, poll_interval=60)
+        await relay.start()
+        try:
+            await asyncio.sleep(0)
+            db.add(5)
+            relay.notify()
+            for _ in range(10):
+                await asyncio.sleep(0)
+
+            assert [len(batch) for batch in producer.batches] == [2, 2, 1]
+            assert db.rows == []
+        finally:
+            await asyncio.wait_for(relay.stop(), timeout=1)
+
+    async def test_outbox_rows_are_json(self):
+        """Строки outbox содержат JSON-совместимое событие с топиком и ключом"""
+        [row] = outbox_rows([chat_assigned_event(10, 20, "support", 30, "auto_assignment")])
+
+        assert (row['topic'], row['key']) == ("chat_assignments", "chat_10")
+        assert row['payload']['event_type'] == "chat_assigned"
+        assert isinstance(row['payload']['timestamp'], str)
+        assert row['payload']['operator_id'] == 20
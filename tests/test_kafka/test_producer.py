@@ -1,13 +1,19 @@
 """
 Тесты для Kafka Producer (включая Mock версию)
 """
+import asyncio
 import pytest
 import pytest_asyncio
 from unittest.mock import AsyncMock, patch, MagicMock
 from datetime import datetime
 
-from utils.kafka_producer import SupportChatKafkaProducer, MockSupportChatKafkaProducer
-from config.kafka_config import ChatEventType, SupportQueueEventType, OperatorEventType
+from utils.kafka_producer import (
+    SupportChatKafkaProducer, MockSupportChatKafkaProducer, KafkaEventRecord, _compression_type
+)
+from config.kafka_config import (
+    ChatEventType, SupportQueueEventType, OperatorEventType,
+    KAFKA_PRODUCER_LINGER_MS, KAFKA_PRODUCER_BATCH_SIZE
+)
 
 
 class TestMockSupportChatKafkaProducer:
@@ -123,7 +129,7 @@ class TestSupportChatKafkaProducer:
             kafka_instance = AsyncMock()
             mock_kafka_producer.return_value = kafka_instance
             
-            producer = SupportChatKafkaProducer()
+            producer = SupportChatKafkaProducer(pipelined=False)
             await producer.start()
             yield producer, kafka_instance
             await producer.stop()
@@ -239,7 +245,7 @@ class TestSupportChatKafkaProducer:
             kafka_instance.send_and_wait.side_effect = Exception("Kafka error")
             mock_kafka_producer.return_value = kafka_instance
             
-            producer = SupportChatKafkaProducer()
+            producer = SupportChatKafkaProducer(pipelined=False)
             await producer.start()
             
             # Должно вызвать исключение
@@ -267,6 +273,110 @@ class TestSupportChatKafkaProducer:
             await producer.stop()
 
 
+class _FakeKafkaProducer:
+    """AIOKafkaProducer без брокера: send() возвращает future доставки, которым управляет тест"""
+    
+    def __init__(self, **config):
+        self.config = config
+        self.deliveries = []
+        self.sent = []
+    
+    async def start(self):
+        pass
+    
+    async def stop(self):
+        pass
+    
+    async def flush(self):
+        pass
+    
+    async def send(self, topic, value=None, key=None):
+        self.sent.append((topic, value, key))
+        delivery = asyncio.get_running_loop().create_future()
+        self.deliveries.append(delivery)
+        return delivery
+    
+    async def send_and_wait(self, topic, value=None, key=None):
+        self.sent.append((topic, value, key))
+
+
+class TestPipelinedProducer:
+    """Тесты для конвейерного режима Producer"""
+    
+    @pytest_asyncio.fixture
+    async def pipelined(self):
+        with patch('utils.kafka_producer.AIOKafkaProducer', _FakeKafkaProducer):
+            producer = SupportChatKafkaProducer(pipelined=True)
+            await producer.start()
+            yield producer
+            producer._in_flight.clear()
+            await producer.stop()
+    
+    async def test_send_does_not_wait_for_broker(self, pipelined):
+        """Отправка возвращается до подтверждения брокера, доставка учитывается в фоне"""
+        await pipelined.send_message_sent(1, 2, "client", 3, "текст")
+        
+        assert pipelined.get_stats()['in_flight'] == 1
+        assert pipelined.producer.sent[0][2] == b"chat_1"
+        
+        pipelined.producer.deliveries[0].set_result(None)
+        await asyncio.sleep(0)
+        
+        stats = pipelined.get_stats()
+        assert stats['in_flight'] == 0
+        assert stats['delivered'] == 1
+        assert stats['failed'] == 0
+    
+    async def test_delivery_error_handler(self, pipelined):
+        """Неудачная фоновая доставка передается обработчику ошибок"""
+        failures = []
+        pipelined.set_delivery_error_handler(lambda topic, event, error: failures.append((topic, event, error)))
+        
+        await pipelined.send_chat_closed(1, 2, "done")
+        error = RuntimeError("broker unavailable")
+        pipelined.producer.deliveries[0].set_exception(error)
+        await asyncio.sleep(0)
+        
+        assert failures == [("chat_events", pipelined.producer.sent[0][1], error)]
+        assert pipelined.get_stats()['failed'] == 1
+    
+    async def test_wait_uses_awaited_path(self, pipelined):
+        """wait=True - ожидание подтверждения брокера"""
+        await pipelined.send_force_transfer(1, 2, 3, 4, "manual", wait=True)
+        
+        assert pipelined.producer.deliveries == []
+        assert pipelined.get_stats()['delivered'] == 1
+    
+    async def test_send_events_waits_for_whole_batch(self, pipelined):
+        """Пачка событий уходит по порядку, ошибка любой доставки поднимается"""
+        records = [KafkaEventRecord("chat_events", f"chat_{n}", {"event_id": str(n)}) for n in range(3)]
+        
+        sending = asyncio.create_task(pipelined.send_events(records))
+        await asyncio.sleep(0)
+        assert [key for _, _, key in pipelined.producer.sent] == [b"chat_0", b"chat_1", b"chat_2"]
+        assert not sending.done()
+        
+        pipelined.producer.deliveries[0].set_result(None)
+        pipelined.producer.deliveries[1].set_exception(RuntimeError("broker unavailable"))
+        pipelined.producer.deliveries[2].set_result(None)
+        with pytest.raises(RuntimeError):
+            await sending
+        
+        stats = pipelined.get_stats()
+        assert (stats['delivered'], stats['failed']) == (2, 1)
+    
+    async def test_batching_and_compression_config(self, pipelined):
+        """linger_ms, размер батча и сжатие передаются producer'у; недоступное сжатие отключается"""
+        config = pipelined.producer.config
+        assert config['linger_ms'] == KAFKA_PRODUCER_LINGER_MS
+        assert config['max_batch_size'] == KAFKA_PRODUCER_BATCH_SIZE
+        
+        with patch.dict('utils.kafka_producer._COMPRESSION_AVAILABLE', {'zstd': lambda: False, 'lz4': lambda: True}):
+            assert _compression_type('zstd') is None
+            assert _compression_type('lz4') == 'lz4'
+            assert _compression_type('none') is None
+
+
 class TestProducerIntegration:
     """Интеграционные тесты Producer"""
     
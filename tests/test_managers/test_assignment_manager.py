@@ -36,6 +36,8 @@ class TestChatAssignmentManager:
         """Создает мок базы данных чатов"""
         with patch('utils.assignment_manager.chat_db') as mock_db:
             mock_db.update_chat_operator = AsyncMock()
+            mock_db.assign_operator = AsyncMock()
+            mock_db.assign_operators_bulk = AsyncMock()
             mock_db.add_chat_participant = AsyncMock()
             mock_db.mark_chat_participant_left = AsyncMock()
             mock_db.transfer_chat = AsyncMock()
@@ -156,13 +158,18 @@ class TestChatAssignmentManager:
         assert chat_id in assignment_manager.queue_manager.chat_assignments
         assert assignment_manager.queue_manager.chat_assignments[chat_id] == operator_id
         
-        # Проверяем вызовы БД
-        mock_chat_db.update_chat_operator.assert_called_once()
-        mock_chat_db.add_chat_participant.assert_called_once()
+        # Проверяем вызов БД: назначение и события Kafka пишутся одной транзакцией
+        mock_chat_db.assign_operator.assert_called_once()
+        args, kwargs = mock_chat_db.assign_operator.call_args
+        assert args == (chat_id, operator_id, "support")
+        assert [(row['topic'], row['payload']['event_type']) for row in kwargs['outbox']] == [
+            ("chat_assignments", "chat_assigned"),
+            ("operator_events", "operator_accept_chat"),
+        ]
         
-        # Проверяем отправку Kafka событий
-        mock_kafka_producer.send_chat_assigned.assert_called_once()
-        mock_kafka_producer.send_operator_accept_chat.assert_called_once()
+        # События уходят в Kafka через outbox, а не напрямую
+        mock_kafka_producer.send_chat_assigned.assert_not_called()
+        mock_kafka_producer.send_operator_accept_chat.assert_not_called()
     
     async def test_assign_chat_to_operator_unavailable(self, assignment_manager):
         """Тест назначения чата недоступному оператору"""
@@ -184,7 +191,7 @@ class TestChatAssignmentManager:
         await assignment_manager.set_operator_online(operator_id, "support")
         
         # Настраиваем ошибку БД
-        mock_chat_db.update_chat_operator.side_effect = Exception("Database error")
+        mock_chat_db.assign_operator.side_effect = Exception("Database error")
         
         success = await assignment_manager.assign_chat_to_operator(chat_id, operator_id, client_id)
         
@@ -249,6 +256,30 @@ class TestChatAssignmentManager:
         # Проверяем отправку Kafka события
         mock_kafka_producer.send_chat_transferred.assert_called_once()
     
+    async def test_transfer_chat_db_error_reverts_transfer(self, assignment_manager, mock_chat_db, mock_kafka_producer):
+        """Тест отката перевода в менеджере очереди при ошибке БД"""
+        chat_id = 456
+        old_operator_id = 123
+        new_operator_id = 789
+        
+        await assignment_manager.set_operator_online(old_operator_id, "support")
+        await assignment_manager.set_operator_online(new_operator_id, "support")
+        await assignment_manager.assign_chat_to_operator(chat_id, old_operator_id, 999)
+        # Прежний оператор занят - откат не зависит от его доступности
+        await assignment_manager.queue_manager.set_operator_busy(old_operator_id, True)
+        mock_chat_db.transfer_chat.side_effect = Exception("db down")
+        
+        success = await assignment_manager.transfer_chat_to_operator(
+            chat_id, new_operator_id, old_operator_id, "test_transfer"
+        )
+        
+        assert success is False
+        queue_manager = assignment_manager.queue_manager
+        assert queue_manager.chat_assignments[chat_id] == old_operator_id
+        assert queue_manager.operators[old_operator_id].current_chats == {chat_id}
+        assert queue_manager.operators[new_operator_id].current_chats == set()
+        mock_kafka_producer.send_chat_transferred.assert_not_called()
+    
     async def test_transfer_chat_to_unavailable_operator(self, assignment_manager):
         """Тест перевода чата недоступному оператору"""
         chat_id = 456
@@ -524,7 +555,7 @@ class TestChatAssignmentManager:
         # Добавляем назначения юристов
         assignment_manager.lawyer_assignments[201] = 2
         
-        stats = assignment_manager.get_assignment_stats()
+        stats = await assignment_manager.get_assignment_stats()
         
         assert stats['total_active_chats'] == 2
         assert stats['total_lawyer_assignments'] == 1
@@ -563,6 +594,36 @@ class TestChatAssignmentManager:
         result = await assignment_manager._get_client_id_from_chat(999)
         assert result is None
     
+    async def test_restore_routing_state(self, assignment_manager, mock_chat_db):
+        """Тест теплого рестарта: очередь, назначения и юристы из одного снимка БД"""
+        from datetime import datetime, timedelta, UTC
+        
+        now = datetime.now(UTC)
+        mock_chat_db.load_routing_state = AsyncMock(return_value=(
+            [
+                (101, 11, None, now - timedelta(minutes=5), None),      # ожидает оператора
+                (102, 12, None, now - timedelta(minutes=1), None),      # ожидает оператора
+                (103, 13, 7, now - timedelta(minutes=10), "support"),   # ведет оператор 7
+                (103, 13, 7, now - timedelta(minutes=10), "support"),   # дубль из join
+                (104, 14, 8, now - timedelta(minutes=3), None),         # личный чат с юристом
+            ],
+            [MagicMock(client_id=14, lawyer_id=8)]
+        ))
+        
+        await assignment_manager.restore_routing_state()
+        
+        queue_manager = assignment_manager.queue_manager
+        assert [client.client_id for client in await queue_manager.list_waiting_clients()] == [11, 12]
+        assert queue_manager.waiting_clients[11].wait_time >= 299
+        assert await queue_manager.list_chat_assignments() == {103: 7}
+        
+        # Оператор восстановлен оффлайн с учетом уже открытого чата
+        operator = await queue_manager.get_operator(7)
+        assert operator.current_chats == {103}
+        assert operator.is_online is False
+        
+        assert assignment_manager.lawyer_assignments == {14: 8}
+    
     async def test_concurrent_assignment_operations(self, assignment_manager):
         """Тест одновременных операций назначения с блокировками"""
         import asyncio
@@ -585,8 +646,7 @@ class TestChatAssignmentManager:
         
         # Мокаем БД операции
         with patch('utils.assignment_manager.chat_db') as mock_db:
-            mock_db.update_chat_operator = AsyncMock()
-            mock_db.add_chat_participant = AsyncMock()
+            mock_db.assign_operator = AsyncMock()
             
             results = await asyncio.gather(assign_chat1(), assign_chat2())
         
@@ -596,3 +656,43 @@ class TestChatAssignmentManager:
         
         # Проверяем что оба чата назначены
         assert len(assignment_manager.queue_manager.operators[operator_id].current_chats) == 2
+    
+    async def test_concurrent_assignment_respects_capacity(self, assignment_manager, mock_chat_db, mock_kafka_producer):
+        """Тест: параллельные назначения не превышают лимит чатов оператора"""
+        import asyncio
+        
+        operator_id = 123
+        await assignment_manager.set_operator_online(operator_id, "support", max_concurrent_chats=1)
+        
+        results = await asyncio.gather(
+            assignment_manager.assign_chat_to_operator(456, operator_id, 111),
+            assignment_manager.assign_chat_to_operator(789, operator_id, 222),
+        )
+        
+        assert sorted(results) == [False, True]
+        assert len(assignment_manager.queue_manager.operators[operator_id].current_chats) == 1
+    
+    async def test_slow_assignment_does_not_block_other_chats(self, assignment_manager, mock_chat_db, mock_kafka_producer):
+        """Тест: долгая запись в БД по одному чату не блокирует назначение другого чата"""
+        import asyncio
+        
+        release_db = asyncio.Event()
+        
+        async def slow_update(chat_id, operator_id, operator_type, outbox=None):
+            if chat_id == 456:
+                await release_db.wait()
+        
+        mock_chat_db.assign_operator = AsyncMock(side_effect=slow_update)
+        await assignment_manager.set_operator_online(123, "support", max_concurrent_chats=5)
+        
+        slow_task = asyncio.create_task(assignment_manager.assign_chat_to_operator(456, 123, 111))
+        await asyncio.sleep(0)
+        
+        # Второй чат назначается, пока первый ждет БД
+        assert await asyncio.wait_for(
+            assignment_manager.assign_chat_to_operator(789, 123, 222), timeout=1
+        ) is True
+        assert not slow_task.done()
+        
+        release_db.set()
+        assert await slow_task is True
@@ -0,0 +1,120 @@
+"""
+Тесты для журнала событий чатов (номера событий и досылка после переподключения)
+"""
+import os
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from utils.chat_event_log import ChatEventLog, RedisChatEventLog
+
+
+class TestChatEventLog:
+    """Тесты для ChatEventLog (в памяти)"""
+
+    async def test_sequence_per_chat(self):
+        """Номера растут независимо в каждом чате, исходное событие не изменяется"""
+        event_log = ChatEventLog()
+        message = {"type": "message", "payload": {"text": "a"}}
+
+        assert (await event_log.append(1, message))["seq"] == 1
+        assert (await event_log.append(1, message))["seq"] == 2
+        assert (await event_log.append(2, message))["seq"] == 1
+        assert "seq" not in message
+        assert await event_log.current_seq(1) == 2
+        assert await event_log.current_seq(3) == 0
+
+    async def test_since_returns_missing_events(self):
+        """Досылаются только события после last_seq"""
+        event_log = ChatEventLog(capacity=10)
+        for n in range(5):
+            await event_log.append(1, {"type": "message", "payload": {"n": n}})
+
+        events = await event_log.since(1, 3)
+        assert [event["seq"] for event in events] == [4, 5]
+        assert await event_log.since(1, 5) == []
+
+    async def test_since_detects_rollover(self):
+        """Если часть пропущенного вытеснена из буфера - None (нужна БД)"""
+        event_log = ChatEventLog(capacity=3)
+        for n in range(5):
+            await event_log.append(1, {"type": "message"})
+
+        assert await event_log.since(1, 1) is None
+        assert [event["seq"] for event in await event_log.since(1, 2)] == [3, 4, 5]
+
+    async def test_since_unknown_position(self):
+        """Номер больше текущего (например после рестарта) - None"""
+        event_log = ChatEventLog()
+        await event_log.append(1, {"type": "message"})
+
+        assert await event_log.since(1, 7) is None
+        assert await event_log.since(2, 3) is None
+
+    async def test_evicted_chat_keeps_sequence(self):
+        """Вытесненный чат забывается целиком, но номера не повторяются"""
+        event_log = ChatEventLog(capacity=10, max_chats=2)
+        await event_log.append(1, {"type": "message"})
+        await event_log.append(1, {"type": "message"})
+        await event_log.append(2, {"type": "message"})
+        await event_log.append(3, {"type": "message"})
+
+        assert await event_log.since(1, 2) is None
+        assert len(event_log._events) == 2
+        # Нумерация новых буферов начинается после вытесненных номеров
+        assert await event_log.current_seq(1) == 2
+        assert (await event_log.append(1, {"type": "message"}))["seq"] == 3
+        assert await event_log.since(2, 1) is None
+        assert [event["seq"] for event in await event_log.since(1, 2)] == [3]
+        assert await event_log.since(1, 1) is None
+        assert [event["seq"] for event in await event_log.since(3, 2)] == [3]
+
+
+class TestRedisChatEventLog:
+    """Тесты для RedisChatEventLog (fakeredis или CHAT_STATE_TEST_REDIS_URL)"""
+
+    @pytest_asyncio.fixture
+    async def redis_client(self):
+        redis_url = os.getenv('CHAT_STATE_TEST_REDIS_URL')
+        if redis_url:
+            import redis.asyncio as aioredis
+            client = aioredis.from_url(redis_url, decode_responses=True)
+        else:
+            fakeredis = pytest.importorskip("fakeredis")
+            pytest.importorskip("lupa")
+            client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        prefix = f"test_support_chat:{uuid.uuid4().hex}:"
+        yield client, prefix
+        keys = [key async for key in client.scan_iter(match=prefix + '*')]
+        if keys:
+            await client.delete(*keys)
+        await client.aclose()
+
+    async def test_append_and_since(self, redis_client):
+        """Номера и досылка через Redis Stream"""
+        client, prefix = redis_client
+        event_log = RedisChatEventLog(client, key_prefix=prefix, capacity=10)
+        for n in range(4):
+            event = await event_log.append(1, {"type": "message", "payload": {"n": n}})
+            assert event["seq"] == n + 1
+
+        events = await event_log.since(1, 2)
+        assert events == [
+            {"type": "message", "payload": {"n": 2}, "seq": 3},
+            {"type": "message", "payload": {"n": 3}, "seq": 4},
+        ]
+        assert await event_log.since(1, 4) == []
+        assert await event_log.current_seq(1) == 4
+
+    async def test_rollover_and_unknown_position(self, redis_client):
+        """Вытесненные из стрима и неизвестные номера - None"""
+        client, prefix = redis_client
+        event_log = RedisChatEventLog(client, key_prefix=prefix, capacity=3)
+        for _ in range(5):
+            await event_log.append(1, {"type": "message"})
+
+        assert await event_log.since(1, 1) is None
+        assert [event["seq"] for event in await event_log.since(1, 2)] == [3, 4, 5]
+        assert await event_log.since(1, 9) is None
+        assert await event_log.since(2, 1) is None
@@ -0,0 +1,206 @@
+"""
+Тесты для доставки событий чатов между узлами (ChatFanout)
+"""
+import asyncio
+import json
+from typing import Dict, List, Set
+from unittest.mock import AsyncMock
+
+import pytest_asyncio
+
+from utils.chat_event_log import ChatEventLog
+from utils.chat_fanout import ChatFanout
+from utils.websocket_manager import WebSocketConnectionManager
+
+
+class _FakeHub:
+    """Redis pub/sub в памяти, общий для нескольких узлов"""
+
+    def __init__(self):
+        self.nodes: List["_FakePubSub"] = []
+        self.published: List[str] = []
+
+
+class _FakePubSub:
+    """Интерфейс RedisPubSub поверх _FakeHub"""
+
+    def __init__(self, hub: _FakeHub):
+        self.hub = hub
+        self.channels: Set[str] = set()
+        self.subscribe_calls = 0
+        self._callback = None
+        hub.nodes.append(self)
+
+    async def start(self, callback):
+        self._callback = callback
+
+    async def stop(self):
+        self.channels.clear()
+
+    async def subscribe(self, channel: str):
+        self.subscribe_calls += 1
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    async def publish(self, channel: str, message: Dict):
+        self.hub.published.append(channel)
+        data = json.loads(json.dumps(message))
+        for node in self.hub.nodes:
+            if channel in node.channels:
+                await node._callback(channel, data)
+
+
+def _websocket() -> AsyncMock:
+    websocket = AsyncMock()
+    websocket.send_text = AsyncMock()
+    return websocket
+
+
+def _received(websocket) -> list:
+    return [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+
+
+async def _settle(*fanouts: ChatFanout):
+    """Дожидается фоновой синхронизации подписок"""
+    for fanout in fanouts:
+        if fanout._sync_tasks:
+            await asyncio.gather(*fanout._sync_tasks)
+
+
+class TestChatFanout:
+    """Тесты для ChatFanout"""
+
+    @pytest_asyncio.fixture
+    async def nodes(self):
+        """Два узла с собственными менеджерами соединений и общим Redis"""
+        hub = _FakeHub()
+        node_a = ChatFanout(WebSocketConnectionManager(), _FakePubSub(hub), node_id="a", channel_prefix="chat:")
+        node_b = ChatFanout(WebSocketConnectionManager(), _FakePubSub(hub), node_id="b", channel_prefix="chat:")
+        await node_a.start()
+        await node_b.start()
+        yield node_a, node_b, hub
+        await node_a.stop()
+        await node_b.stop()
+
+    async def test_delivers_to_remote_node_once(self, nodes):
+        """Событие доходит до участников на обоих узлах ровно один раз"""
+        node_a, node_b, hub = nodes
+        client_ws, operator_ws = _websocket(), _websocket()
+        await node_a.websocket_manager.connect_user(1, client_ws, "client")
+        await node_a.websocket_manager.join_chat(1, 100)
+        await node_b.websocket_manager.connect_user(2, operator_ws, "support")
+        await node_b.websocket_manager.join_chat(2, 100)
+        await _settle(node_a, node_b)
+
+        await node_a.broadcast_to_chat(100, {"type": "message", "payload": {"text": "hi"}})
+        await node_a.websocket_manager.flush()
+        await node_b.websocket_manager.flush()
+
+        assert _received(client_ws) == [{"type": "message", "payload": {"text": "hi"}}]
+        assert _received(operator_ws) == [{"type": "message", "payload": {"text": "hi"}}]
+
+    async def test_exclude_user_applies_on_remote_node(self, nodes):
+        """Исключенный отправитель не получает событие и на другом узле"""
+        node_a, node_b, hub = nodes
+        sender_ws = _websocket()
+        await node_b.websocket_manager.connect_user(1, sender_ws, "client")
+        await node_b.websocket_manager.join_chat(1, 100)
+        await _settle(node_a, node_b)
+
+        await node_a.broadcast_to_chat(100, {"type": "typing", "payload": {"chat_id": 100, "user_id": 1}},
+                                       exclude_user=1)
+        await node_b.websocket_manager.flush()
+
+        sender_ws.send_text.assert_not_called()
+
+    async def test_subscribes_only_to_chats_with_local_participants(self, nodes):
+        """Узел подписан только на чаты со своими участниками"""
+        node_a, node_b, hub = nodes
+        await node_a.websocket_manager.connect_user(1, _websocket(), "client")
+        await node_a.websocket_manager.join_chat(1, 100)
+        await node_a.websocket_manager.connect_user(2, _websocket(), "support")
+        await node_a.websocket_manager.join_chat(2, 100)
+        await _settle(node_a, node_b)
+
+        assert node_a.pubsub.channels == {"chat:100"}
+        assert node_a.pubsub.subscribe_calls == 1
+        assert node_b.pubsub.channels == set()
+
+    async def test_unsubscribes_after_last_participant_leaves(self, nodes):
+        """Подписка снимается, когда уходит последний локальный участник"""
+        node_a, node_b, hub = nodes
+        await node_a.websocket_manager.connect_user(1, _websocket(), "client")
+        await node_a.websocket_manager.join_chat(1, 100)
+        await node_a.websocket_manager.connect_user(2, _websocket(), "support")
+        await node_a.websocket_manager.join_chat(2, 100)
+        await _settle(node_a)
+
+        await node_a.websocket_manager.leave_chat(1, 100)
+        await _settle(node_a)
+        assert node_a.pubsub.channels == {"chat:100"}
+
+        await node_a.websocket_manager.disconnect_user(2)
+        await _settle(node_a)
+        assert node_a.pubsub.channels == set()
+        assert node_a.get_stats()["subscribed_chats"] == 0
+
+    async def test_without_pubsub_delivers_locally(self):
+        """Без Redis событие доставляется только локальным участникам"""
+        fanout = ChatFanout(WebSocketConnectionManager())
+        websocket = _websocket()
+        await fanout.start()
+        await fanout.websocket_manager.connect_user(1, websocket, "client")
+        await fanout.websocket_manager.join_chat(1, 100)
+
+        await fanout.broadcast_to_chat(100, {"type": "message"})
+        await fanout.websocket_manager.flush()
+
+        assert _received(websocket) == [{"type": "message"}]
+        assert fanout.get_stats()["enabled"] is False
+
+    async def test_events_are_sequenced_except_typing(self):
+        """События чата получают seq, индикатор печати - нет"""
+        fanout = ChatFanout(WebSocketConnectionManager(), event_log=ChatEventLog())
+        websocket = _websocket()
+        await fanout.websocket_manager.connect_user(1, websocket, "client")
+        await fanout.websocket_manager.join_chat(1, 100)
+
+        await fanout.broadcast_to_chat(100, {"type": "message"})
+        await fanout.broadcast_to_chat(100, {"type": "typing", "payload": {"chat_id": 100, "user_id": 2}})
+        await fanout.broadcast_to_chat(100, {"type": "chat_closed"})
+        await fanout.websocket_manager.flush()
+
+        assert [frame.get("seq") for frame in _received(websocket)] == [1, None, 2]
+        assert [event["type"] for event in await fanout.event_log.since(100, 0)] == ["message", "chat_closed"]
+
+    async def test_remote_node_receives_origin_sequence(self, nodes):
+        """Номер присваивается на узле-источнике и доходит до других узлов"""
+        node_a, node_b, hub = nodes
+        node_a.event_log = ChatEventLog()
+        websocket = _websocket()
+        await node_b.websocket_manager.connect_user(2, websocket, "support")
+        await node_b.websocket_manager.join_chat(2, 100)
+        await _settle(node_a, node_b)
+
+        await node_a.broadcast_to_chat(100, {"type": "message"})
+        await node_b.websocket_manager.flush()
+
+        assert _received(websocket) == [{"type": "message", "seq": 1}]
+
+    async def test_transfer_notice_reaches_remote_participants(self, nodes):
+        """Уведомление о переводе чата рассылается через fanout и получает seq"""
+        node_a, node_b, hub = nodes
+        node_a.event_log = ChatEventLog()
+        client_ws = _websocket()
+        await node_b.websocket_manager.connect_user(1, client_ws, "client")
+        await node_b.websocket_manager.join_chat(1, 100)
+        await _settle(node_a, node_b)
+
+        await node_a.websocket_manager.notify_chat_transferred(100, 3, 2, "load", chat_fanout=node_a)
+        await node_b.websocket_manager.flush()
+
+        (frame,) = _received(client_ws)
+        assert frame["type"] == "chat_transferred"
+        assert frame["seq"] == 1
@@ -0,0 +1,79 @@
+"""
+Бенчмарк памяти для состояния очереди и соединений: байт на ожидающего клиента
+и на подключенного пользователя. Бюджеты ловят регрессии компактных записей.
+"""
+import gc
+import logging
+import tracemalloc
+
+from utils.queue_manager import SupportQueueManager
+from utils.websocket_manager import WebSocketConnectionManager
+
+
+SAMPLE_SIZE = 10_000
+
+# Бюджеты с запасом ~15% над измеренными значениями (CPython 3.11, 64 бит):
+# ~610 байт на клиента в очереди (запись + узел skip-списка + индексы),
+# ~110 байт на подключенного пользователя без метаданных (запись + кортеж сокетов)
+WAITING_CLIENT_BUDGET = 700
+CONNECTED_USER_BUDGET = 128
+
+
+class _IdleWebSocket:
+    """Минимальный WebSocket без состояния - чтобы не учитывать память моков"""
+    __slots__ = ()
+
+    async def accept(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+async def _measure(action) -> float:
+    """Прирост памяти в байтах на один элемент выборки"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(SAMPLE_SIZE):
+            await action(i)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / SAMPLE_SIZE
+
+
+class TestMemoryBudget:
+    """Бюджеты памяти на клиента в очереди и на соединение"""
+
+    async def test_bytes_per_waiting_client(self):
+        """Тест: память на клиента в очереди в пределах бюджета"""
+        queue_manager = SupportQueueManager()
+        logging.disable(logging.INFO)
+        try:
+            per_client = await _measure(
+                lambda i: queue_manager.add_client_to_queue(i, SAMPLE_SIZE + i)
+            )
+        finally:
+            logging.disable(logging.NOTSET)
+
+        assert len(queue_manager.waiting_clients) == SAMPLE_SIZE
+        assert per_client < WAITING_CLIENT_BUDGET, f"{per_client:.0f} байт на клиента в очереди"
+
+    async def test_bytes_per_connected_user(self):
+        """Тест: память на подключенного пользователя в пределах бюджета"""
+        websocket_manager = WebSocketConnectionManager()
+        websockets = [_IdleWebSocket() for _ in range(SAMPLE_SIZE)]
+        logging.disable(logging.INFO)
+        try:
+            per_user = await _measure(
+                lambda i: websocket_manager.connect_user(i, websockets[i], "client")
+            )
+        finally:
+            logging.disable(logging.NOTSET)
+
+        assert len(websocket_manager.user_connections) == SAMPLE_SIZE
+        assert websocket_manager.connection_metadata == {}
+        assert per_user < CONNECTED_USER_BUDGET, f"{per_user:.0f} байт на подключенного пользователя"
@@ -0,0 +1,97 @@
+"""
+Тесты для групповой записи сообщений чатов (ChatMessageWriter)
+"""
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List
+
+from utils.message_writer import ChatMessageWriter
+
+
+class _FakeChatDb:
+    """БД в памяти: запоминает батчи и выдает id по порядку"""
+
+    def __init__(self, delay: float = 0.0):
+        self.batches: List[List[Dict]] = []
+        self.delay = delay
+        self.fail = False
+        self._next_id = 1
+
+    async def add_messages_bulk(self, messages: List[Dict]):
+        self.batches.append(messages)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("db is down")
+        saved = []
+        for row in messages:
+            saved.append(SimpleNamespace(id=self._next_id, **row))
+            self._next_id += 1
+        return saved
+
+
+class TestChatMessageWriter:
+    """Тесты для ChatMessageWriter"""
+
+    async def test_concurrent_messages_share_one_batch(self):
+        """Сообщения разных чатов за окно ожидания пишутся одним батчем, каждый получает свой id"""
+        db = _FakeChatDb()
+        writer = ChatMessageWriter(db, max_batch=100, max_delay=0.01)
+
+        messages = await asyncio.gather(*(
+            writer.add_message(chat_id % 3, chat_id, "client", f"text {chat_id}") for chat_id in range(10)
+        ))
+
+        assert len(db.batches) == 1
+        assert [message.id for message in messages] == list(range(1, 11))
+        assert [message.message for message in messages] == [f"text {n}" for n in range(10)]
+        assert writer.get_stats()['avg_batch_size'] == 10
+
+    async def test_full_batch_is_written_without_delay(self):
+        """При накоплении max_batch сообщений батч пишется сразу"""
+        db = _FakeChatDb()
+        writer = ChatMessageWriter(db, max_batch=4, max_delay=60)
+
+        messages = await asyncio.wait_for(asyncio.gather(*(
+            writer.add_message(1, 1, "client", str(n)) for n in range(8)
+        )), timeout=1)
+
+        assert [len(batch) for batch in db.batches] == [4, 4]
+        assert [message.id for message in messages] == list(range(1, 9))
+
+    async def test_batches_keep_call_order(self):
+        """Пока пишется батч, следующий накапливается и записывается после него"""
+        db = _FakeChatDb(delay=0.02)
+        writer = ChatMessageWriter(db, max_batch=100, max_delay=0.001)
+
+        first = asyncio.create_task(writer.add_message(1, 1, "client", "a"))
+        await asyncio.sleep(0.005)
+        rest = [asyncio.create_task(writer.add_message(1, 2, "support", text)) for text in "bcd"]
+        messages = await asyncio.gather(first, *rest)
+
+        assert [[row['message'] for row in batch] for batch in db.batches] == [["a"], ["b", "c", "d"]]
+        assert [message.id for message in messages] == [1, 2, 3, 4]
+        assert [message.created_at for message in messages] == sorted(message.created_at for message in messages)
+
+    async def test_failed_batch_raises_for_every_caller(self):
+        """Ошибка записи батча возвращается всем его отправителям"""
+        db = _FakeChatDb()
+        db.fail = True
+        writer = ChatMessageWriter(db, max_batch=100, max_delay=0.001)
+
+        results = await asyncio.gather(*(writer.add_message(1, 1, "client", "x") for _ in range(3)),
+                                       return_exceptions=True)
+
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert writer.get_stats()['failed_batches'] == 1
+
+    async def test_flush_writes_pending(self):
+        """flush() записывает накопленное, не дожидаясь таймера"""
+        db = _FakeChatDb()
+        writer = ChatMessageWriter(db, max_batch=100, max_delay=60)
+
+        pending = asyncio.create_task(writer.add_message(1, 1, "client", "bye"))
+        await asyncio.sleep(0)
+        await writer.flush()
+
+        assert (await pending).id == 1
+        assert writer.get_stats()['pending'] == 0
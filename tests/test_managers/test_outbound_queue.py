@@ -0,0 +1,71 @@
+"""
+Тесты для исходящих очередей WebSocket-соединений
+"""
+from unittest.mock import MagicMock, patch
+
+from utils.outbound_queue import Delivery, OutboundQueue, coalesce_key
+
+
+class TestOutboundQueue:
+    """Тесты для OutboundQueue"""
+
+    def test_coalesce_key_by_message_class(self):
+        """Ключ объединения есть только у необязательных сообщений"""
+        assert coalesce_key({"type": "typing", "payload": {"chat_id": 1, "user_id": 2}}) == ("typing", 1, 2)
+        assert coalesce_key({"type": "queue_update", "payload": {"client_id": 3}}) == ("queue_update", 3)
+        assert coalesce_key({"type": "new_message", "payload": {"chat_id": 1}}) is None
+
+    def test_optional_frames_are_coalesced(self):
+        """Повторное необязательное сообщение заменяет неотправленное, сохраняя место в очереди"""
+        queue = OutboundQueue(MagicMock(), limit=10)
+        key = ("queue_update", 3)
+
+        assert queue.put("position-5", key) == Delivery.QUEUED
+        assert queue.put("message") == Delivery.QUEUED
+        assert queue.put("position-4", key) == Delivery.COALESCED
+
+        assert len(queue) == 2
+        assert queue.pop()[0] == "position-4"
+        assert queue.put("position-3", key) == Delivery.QUEUED
+        assert [queue.pop()[0] for _ in range(len(queue))] == ["message", "position-3"]
+
+    def test_optional_frames_dropped_when_full(self):
+        """При заполненной очереди необязательные сообщения отбрасываются, обязательные - нет"""
+        queue = OutboundQueue(MagicMock(), limit=2)
+        queue.put("a")
+        queue.put("b")
+
+        assert queue.put("typing", ("typing", 1, 2)) == Delivery.DROPPED
+        assert queue.put("c") == Delivery.QUEUED
+        assert len(queue) == 3
+
+    def test_overflow_after_timeout(self):
+        """Соединение, переполненное дольше таймаута, должно быть закрыто"""
+        queue = OutboundQueue(MagicMock(), limit=3)
+        for frame in ("a", "b", "c"):
+            queue.put(frame)
+
+        with patch('utils.outbound_queue.time.monotonic', side_effect=[100.0, 100.0, 105.0, 105.0, 111.0]):
+            assert queue.put("d") == Delivery.QUEUED
+            assert queue.put("e") == Delivery.QUEUED
+            assert queue.put("f") == Delivery.OVERFLOW
+
+    def test_overflow_at_hard_limit(self):
+        """Буфер не растет больше двойного лимита"""
+        queue = OutboundQueue(MagicMock(), limit=2)
+        for frame in ("a", "b", "c", "d"):
+            assert queue.put(frame) == Delivery.QUEUED
+
+        assert queue.put("e") == Delivery.OVERFLOW
+
+    def test_overflow_resets_after_drain(self):
+        """Счетчик переполнения сбрасывается, когда писатель разгружает очередь"""
+        queue = OutboundQueue(MagicMock(), limit=2)
+        for frame in ("a", "b", "c"):
+            queue.put(frame)
+
+        queue.pop()
+        queue.pop()
+
+        for frame in ("d", "e"):
+            assert queue.put(frame) == Delivery.QUEUED
@@ -4,10 +4,12 @@
 import pytest
 import pytest_asyncio
 import asyncio
+import time
 from datetime import datetime, timedelta, UTC
 from unittest.mock import patch, AsyncMock
 
 from utils.queue_manager import SupportQueueManager, QueuedClient, OperatorStatus
+from utils.queue_index import IndexedClientQueue, OperatorLoadIndex
 
 
 class TestQueuedClient:
@@ -17,40 +19,57 @@ class TestQueuedClient:
         """Тест создания клиента в очереди"""
         client_id = 123
         chat_id = 456
-        timestamp = datetime.now(UTC)
+        before = datetime.now(UTC)
         priority = 1
         metadata = {"urgency": "high"}
         
         queued_client = QueuedClient(
             client_id=client_id,
             chat_id=chat_id,
-            timestamp=timestamp,
             priority=priority,
             metadata=metadata
         )
         
         assert queued_client.client_id == client_id
         assert queued_client.chat_id == chat_id
-        assert queued_client.timestamp == timestamp
+        assert abs(queued_client.timestamp - before) < timedelta(seconds=1)
         assert queued_client.priority == priority
         assert queued_client.wait_time == 0
         assert queued_client.metadata == metadata
+        assert queued_client.enqueued_at <= time.monotonic()
+    
+    def test_wait_time_computed_on_read(self):
+        """Время ожидания вычисляется из монотонного времени постановки"""
+        queued_client = QueuedClient(
+            client_id=1,
+            chat_id=2,
+            enqueued_at=time.monotonic() - 42.5
+        )
+        
+        assert queued_client.wait_time == 42
+        assert datetime.now(UTC) - queued_client.timestamp >= timedelta(seconds=42)
     
     def test_queued_client_defaults(self):
         """Тест значений по умолчанию для QueuedClient"""
         client_id = 123
         chat_id = 456
-        timestamp = datetime.now(UTC)
         
         queued_client = QueuedClient(
             client_id=client_id,
-            chat_id=chat_id,
-            timestamp=timestamp
+            chat_id=chat_id
         )
         
         assert queued_client.priority == 0
         assert queued_client.wait_time == 0
-        assert queued_client.metadata == {}
+        assert queued_client.metadata is None
+    
+    def test_queued_client_is_slotted(self):
+        """Записи очереди компактные: без __dict__"""
+        queued_client = QueuedClient(client_id=1, chat_id=2)
+        
+        assert not hasattr(queued_client, '__dict__')
+        with pytest.raises(AttributeError):
+            queued_client.extra = 1
 
 
 class TestOperatorStatus:
@@ -75,6 +94,8 @@ class TestOperatorStatus:
         assert operator.max_concurrent_chats == max_chats
         assert len(operator.current_chats) == 0
         assert isinstance(operator.last_activity, datetime)
+        assert operator.last_active_at <= time.monotonic()
+        assert not hasattr(operator, '__dict__')
     
     def test_can_accept_chat_property(self):
         """Тест свойства can_accept_chat"""
@@ -105,6 +126,137 @@ class TestOperatorStatus:
         assert not operator.can_accept_chat
 
 
+class TestIndexedClientQueue:
+    """Тесты для индексированной очереди клиентов"""
+    
+    @staticmethod
+    def _client(client_id: int, priority: int = 0, offset: int = 0) -> QueuedClient:
+        return QueuedClient(
+            client_id=client_id,
+            chat_id=client_id + 1000,
+            priority=priority,
+            enqueued_at=1000.0 + offset
+        )
+    
+    def test_rank_matches_sorted_order(self):
+        """Позиции совпадают с сортировкой по (-priority, timestamp)"""
+        queue = IndexedClientQueue()
+        clients = [self._client(i, priority=i % 3, offset=i) for i in range(50)]
+        for client in clients:
+            queue.push(client)
+        
+        expected = sorted(clients, key=lambda c: (-c.priority, c.enqueued_at))
+        for position, client in enumerate(expected, 1):
+            assert queue.rank(client.client_id) == position
+        assert [c.client_id for c in queue.ordered()] == [c.client_id for c in expected]
+        assert queue.first().client_id == expected[0].client_id
+    
+    def test_remove_and_reprioritize(self):
+        """Удаление и смена приоритета пересчитывают позиции и агрегаты"""
+        queue = IndexedClientQueue()
+        for i in range(5):
+            queue.push(self._client(i, offset=i))
+        
+        assert queue.remove(2).client_id == 2
+        assert queue.remove(2) is None
+        assert 2 not in queue
+        assert queue.rank(3) == 3
+        
+        assert queue.reprioritize(4, 10)
+        assert queue.rank(4) == 1
+        assert queue[4].priority == 10
+        assert queue.priority_counts() == {0: 3, 10: 1}
+        assert not queue.reprioritize(999, 1)
+    
+    def test_mapping_interface(self):
+        """Очередь ведет себя как словарь client_id -> QueuedClient"""
+        queue = IndexedClientQueue()
+        assert queue == {}
+        assert queue.first() is None
+        assert queue.rank(1) == -1
+        
+        client = self._client(1)
+        queue.push(client)
+        assert queue == {1: client}
+        assert len(queue) == 1
+        assert queue.get(2) is None
+        with pytest.raises(KeyError):
+            queue.push(self._client(1))
+    
+    def test_wait_time_aggregates(self):
+        """Среднее и максимальное ожидание считаются по агрегатам очереди"""
+        queue = IndexedClientQueue()
+        assert queue.average_wait_time() == 0
+        assert queue.max_wait_time() == 0
+        
+        queue.push(self._client(1, offset=0))
+        queue.push(self._client(2, offset=10))
+        queue.push(self._client(3, priority=5, offset=20))
+        assert queue.average_wait_time(now=1030.0) == pytest.approx(20)
+        assert queue.max_wait_time(now=1030.0) == pytest.approx(30)
+        
+        # Самый давний клиент ушел - максимум пересчитывается
+        queue.remove(1)
+        assert queue.average_wait_time(now=1030.0) == pytest.approx(15)
+        assert queue.max_wait_time(now=1030.0) == pytest.approx(20)
+
+
+class TestOperatorLoadIndex:
+    """Тесты для индекса доступных операторов по загрузке"""
+    
+    @staticmethod
+    def _operator(operator_id: int, operator_type: str = "support", max_chats: int = 3) -> OperatorStatus:
+        return OperatorStatus(
+            operator_id=operator_id,
+            operator_type=operator_type,
+            is_online=True,
+            max_concurrent_chats=max_chats
+        )
+    
+    def test_least_loaded_by_type(self):
+        """Выбирается наименее загруженный оператор нужного типа"""
+        index = OperatorLoadIndex()
+        busy = self._operator(1)
+        busy.current_chats = {10, 11}
+        free = self._operator(2)
+        lawyer = self._operator(3, "lawyer")
+        for operator in (busy, free, lawyer):
+            index.update(operator)
+        
+        assert index.least_loaded("support") == 2
+        assert index.least_loaded("lawyer") == 3
+        assert index.least_loaded("salesman") is None
+        assert list(index.iter_available("support")) == [2, 1]
+        assert list(index.iter_available()) == [2, 3, 1]
+        assert index.count() == 3
+        assert index.count("support") == 2
+    
+    def test_update_removes_unavailable(self):
+        """Оператор, который не может принять чат, удаляется из индекса"""
+        index = OperatorLoadIndex()
+        operator = self._operator(1, max_chats=1)
+        index.update(operator)
+        assert 1 in index
+        
+        operator.current_chats.add(10)
+        index.update(operator)
+        assert 1 not in index
+        assert index.least_loaded("support") is None
+        
+        operator.current_chats.discard(10)
+        operator.is_available = False
+        index.update(operator)
+        assert 1 not in index
+        
+        operator.is_available = True
+        index.update(operator)
+        assert index.least_loaded("support") == 1
+        
+        index.discard(1)
+        index.discard(1)
+        assert len(index) == 0
+
+
 class TestSupportQueueManager:
     """Тесты для SupportQueueManager"""
     
@@ -124,7 +276,6 @@ class TestSupportQueueManager:
         assert manager.operators == {}
         assert manager.chat_assignments == {}
         assert not manager._running
-        assert manager._update_task is None
     
     async def test_start_stop_manager(self):
         """Тест запуска и остановки менеджера"""
@@ -133,7 +284,6 @@ class TestSupportQueueManager:
         # Запуск
         await manager.start()
         assert manager._running
-        assert manager._update_task is not None
         
         # Остановка
         await manager.stop()
@@ -237,8 +387,9 @@ class TestSupportQueueManager:
         await queue_manager.set_operator_online(1, "support", 5)
         await queue_manager.set_operator_online(2, "support", 5)
         
-        # Добавляем чаты первому оператору
-        queue_manager.operators[1].current_chats = {101, 102}
+        # Добавляем чаты первому оператору (через менеджер, чтобы обновился индекс загрузки)
+        await queue_manager.assign_chat_to_operator(101, 1, 901)
+        await queue_manager.assign_chat_to_operator(102, 1, 902)
         
         # Получаем доступных операторов
         available = queue_manager.get_available_operators()
@@ -254,7 +405,7 @@ class TestSupportQueueManager:
         priority = 1
         metadata = {"urgency": "high"}
         
-        with patch.object(queue_manager, '_try_assign_operator_to_client') as mock_assign:
+        with patch.object(queue_manager, '_try_auto_assign_clients') as mock_assign:
             await queue_manager.add_client_to_queue(client_id, chat_id, priority, metadata)
             
             # Проверяем что клиент добавлен в очередь
@@ -266,7 +417,19 @@ class TestSupportQueueManager:
             assert queued_client.metadata == metadata
             
             # Проверяем что была попытка назначения
-            mock_assign.assert_called_once_with(client_id)
+            mock_assign.assert_called_once_with()
+    
+    async def test_add_client_to_queue_assigns_through_batch_handler(self, queue_manager):
+        """Назначение при постановке в очередь проходит через обработчик пакета (БД, Kafka)"""
+        handler = AsyncMock()
+        queue_manager.set_batch_assignment_handler(handler)
+        await queue_manager.set_operator_online(201, "support")
+        
+        await queue_manager.add_client_to_queue(1, 101)
+        
+        assert queue_manager.chat_assignments == {101: 201}
+        handler.assert_awaited_once()
+        assert [(a.chat_id, a.client_id, a.operator_id) for a in handler.await_args.args[0]] == [(101, 1, 201)]
     
     async def test_add_client_to_queue_duplicate(self, queue_manager):
         """Тест добавления дублирующегося клиента в очередь"""
@@ -514,20 +677,80 @@ class TestSupportQueueManager:
         await queue_manager.add_client_to_queue(2, 102, priority=2)  # высокий приоритет
         await queue_manager.add_client_to_queue(3, 103, priority=1)
         
-        # Добавляем доступного оператора
+        handler = AsyncMock()
+        queue_manager.set_batch_assignment_handler(handler)
+        
+        # Оператор с одним свободным слотом получает клиента с наивысшим приоритетом
         operator_id = 201
         await queue_manager.set_operator_online(operator_id, "support", max_concurrent_chats=1)
         
-        with patch.object(queue_manager, '_try_assign_operator_to_client') as mock_assign:
-            mock_assign.return_value = operator_id
-            
-            await queue_manager._try_auto_assign_clients()
-            
-            # Должен быть вызван для клиента с наивысшим приоритетом
-            mock_assign.assert_called_once_with(2)  # клиент с приоритетом 2
+        assert queue_manager.chat_assignments == {102: operator_id}
+        assert list(queue_manager.waiting_clients) == [3, 1]
+        
+        handler.assert_called_once()
+        assignments = handler.call_args.args[0]
+        assert [a.client_id for a in assignments] == [2]
     
-    async def test_update_wait_times(self, queue_manager):
-        """Тест обновления времени ожидания клиентов"""
+    async def test_try_assign_operator_to_client_assignment_fails(self, queue_manager):
+        """Неудачное назначение не возвращает оператора, клиент остается в очереди"""
+        await queue_manager.set_operator_online(201, "support")
+        await queue_manager.set_operator_busy(201, True)
+        await queue_manager.add_client_to_queue(1, 101)
+        await queue_manager.set_operator_busy(201, False)
+        
+        with patch.object(queue_manager, '_assign', return_value=False) as mock_assign:
+            assert await queue_manager._try_assign_operator_to_client(1) is None
+        
+        mock_assign.assert_called_once()
+        assert list(queue_manager.waiting_clients) == [1]
+    
+    async def test_match_waiting_clients_batch(self, queue_manager):
+        """Тест пакетного распределения клиентов по свободной емкости операторов"""
+        await queue_manager.set_operator_online(201, "support", max_concurrent_chats=2)
+        await queue_manager.set_operator_online(202, "support", max_concurrent_chats=10)
+        await queue_manager.set_operator_online(203, "lawyer", max_concurrent_chats=10)
+        await queue_manager.set_operator_busy(201, True)
+        await queue_manager.set_operator_busy(202, True)
+        
+        for client_id in range(1, 6):
+            await queue_manager.add_client_to_queue(client_id, 100 + client_id)
+        
+        await queue_manager.set_operator_busy(201, False)
+        await queue_manager.set_operator_busy(202, False)
+        
+        assignments = await queue_manager.match_waiting_clients("support")
+        
+        # Все клиенты назначены за один проход в порядке очереди
+        assert [a.client_id for a in assignments] == [1, 2, 3, 4, 5]
+        assert len(queue_manager.waiting_clients) == 0
+        # Нагрузка распределяется по наименее загруженным, лимит соблюдается
+        assert len(queue_manager.operators[201].current_chats) == 2
+        assert len(queue_manager.operators[202].current_chats) == 3
+        assert all(a.operator_type == "support" for a in assignments)
+        # Индекс загрузки обновлен: оператор 201 заполнен
+        assert [op.operator_id for op in queue_manager.get_available_operators("support")] == [202]
+    
+    async def test_match_waiting_clients_limit_and_revert(self, queue_manager):
+        """Тест ограничения размера пакета и отката назначений"""
+        await queue_manager.set_operator_online(201, "support", max_concurrent_chats=5)
+        await queue_manager.set_operator_busy(201, True)
+        await queue_manager.add_client_to_queue(1, 101, priority=1)
+        await queue_manager.add_client_to_queue(2, 102)
+        await queue_manager.set_operator_busy(201, False)
+        
+        assignments = await queue_manager.match_waiting_clients("support", limit=1)
+        assert [a.client_id for a in assignments] == [1]
+        assert list(queue_manager.waiting_clients) == [2]
+        
+        # Откат возвращает клиента на прежнее место в очереди
+        await queue_manager.revert_assignments(assignments)
+        assert list(queue_manager.waiting_clients) == [1, 2]
+        assert 101 not in queue_manager.chat_assignments
+        assert queue_manager.operators[201].current_chats == set()
+        assert queue_manager.count_available_operators("support") == 1
+    
+    async def test_wait_times_computed_lazily(self, queue_manager):
+        """Тест вычисления времени ожидания при чтении без фоновой задачи"""
         client_id = 123
         chat_id = 456
         
@@ -537,17 +760,16 @@ class TestSupportQueueManager:
         # Изначально время ожидания равно 0
         assert queue_manager.waiting_clients[client_id].wait_time == 0
         
-        # Ждем немного и проверяем обновление времени
-        await asyncio.sleep(0.1)
+        # Сдвигаем момент постановки в прошлое - время ожидания видно сразу
+        queued_client = queue_manager.waiting_clients[client_id]
+        queue_manager.waiting_clients.remove(client_id)
+        queued_client.enqueued_at -= 90
+        queue_manager.waiting_clients.push(queued_client)
         
-        # Вызываем обновление времени вручную
-        current_time = datetime.now(UTC)
-        async with queue_manager._queue_lock:
-            for client in queue_manager.waiting_clients.values():
-                client.wait_time = int((current_time - client.timestamp).total_seconds())
-        
-        # Время ожидания должно быть больше 0
-        assert queue_manager.waiting_clients[client_id].wait_time >= 0
+        assert queued_client.wait_time == 90
+        status = queue_manager.get_queue_status()
+        assert status['average_wait_time'] == pytest.approx(90, abs=1)
+        assert status['max_wait_time'] == pytest.approx(90, abs=1)
     
     async def test_get_operator_stats(self, queue_manager):
         """Тест получения статистики оператора"""
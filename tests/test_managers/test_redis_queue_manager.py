@@ -0,0 +1,251 @@
+"""
+Тесты для RedisSupportQueueManager - состояние очереди поддержки в Redis
+
+По умолчанию тесты идут на fakeredis (нужен пакет fakeredis[lua]). Чтобы
+прогнать их на локальном Redis, задайте CHAT_STATE_TEST_REDIS_URL.
+"""
+import os
+import uuid
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+from utils.redis_queue_manager import RedisSupportQueueManager
+
+
+async def _create_redis_client():
+    """Клиент локального Redis или fakeredis"""
+    redis_url = os.getenv('CHAT_STATE_TEST_REDIS_URL')
+    if redis_url:
+        import redis.asyncio as aioredis
+        return aioredis.from_url(redis_url, decode_responses=True)
+
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+class TestRedisSupportQueueManager:
+    """Тесты для RedisSupportQueueManager"""
+
+    @pytest_asyncio.fixture
+    async def redis_client(self):
+        """Создает клиент Redis и очищает ключи теста после завершения"""
+        client = await _create_redis_client()
+        prefix = f"test_support_chat:{uuid.uuid4().hex}:"
+        yield client, prefix
+        keys = [key async for key in client.scan_iter(match=prefix + '*')]
+        if keys:
+            await client.delete(*keys)
+        await client.aclose()
+
+    @pytest_asyncio.fixture
+    async def queue_manager(self, redis_client):
+        """Создает менеджер очереди поверх Redis"""
+        client, prefix = redis_client
+        manager = RedisSupportQueueManager(client, key_prefix=prefix)
+        await manager.start()
+        yield manager
+        await manager.stop()
+
+    async def test_queue_order_and_priority(self, queue_manager):
+        """Тест порядка очереди: приоритет, затем время постановки"""
+        await queue_manager.add_client_to_queue(1, 101, priority=0)
+        await queue_manager.add_client_to_queue(2, 102, priority=1)
+        await queue_manager.add_client_to_queue(3, 103, priority=0, metadata={"source": "web"})
+
+        assert await queue_manager.get_queue_position(2) == 1
+        assert await queue_manager.get_queue_position(1) == 2
+        assert await queue_manager.get_queue_position(3) == 3
+        assert await queue_manager.get_queue_position(999) == -1
+
+        clients = await queue_manager.list_waiting_clients()
+        assert [client.client_id for client in clients] == [2, 1, 3]
+        assert clients[2].chat_id == 103
+        assert clients[2].metadata == {"source": "web"}
+
+        # Повышение приоритета сохраняет время постановки
+        assert await queue_manager.update_queue_position(3, 1) == 2
+
+        status = await queue_manager.fetch_queue_status()
+        assert status['total_waiting'] == 3
+        assert status['queue_by_priority'] == {0: 1, 1: 2}
+        assert status['max_wait_time'] >= 0
+
+    async def test_add_and_remove_client(self, queue_manager):
+        """Тест добавления и удаления клиента"""
+        await queue_manager.add_client_to_queue(1, 101)
+        await queue_manager.add_client_to_queue(1, 102)  # повторное добавление игнорируется
+
+        assert await queue_manager.is_client_waiting(1)
+        assert len(await queue_manager.list_waiting_clients()) == 1
+
+        assert await queue_manager.remove_client_from_queue(1) is True
+        assert await queue_manager.remove_client_from_queue(1) is False
+        assert not await queue_manager.is_client_waiting(1)
+
+        status = await queue_manager.fetch_queue_status()
+        assert status['total_waiting'] == 0
+        assert status['queue_by_priority'] == {}
+        assert status['average_wait_time'] == 0
+
+    async def test_assign_respects_capacity(self, queue_manager):
+        """Тест атомарного назначения с учетом лимита чатов оператора"""
+        handler = AsyncMock()
+        queue_manager.set_batch_assignment_handler(handler)
+        await queue_manager.set_operator_online(10, "support", max_concurrent_chats=1)
+
+        # Клиент сразу назначается свободному оператору через обработчик пакета (БД, Kafka)
+        await queue_manager.add_client_to_queue(1, 101)
+        assert not await queue_manager.is_client_waiting(1)
+        assert await queue_manager.get_chat_operator(101) == 10
+        handler.assert_awaited_once()
+        assert [(a.chat_id, a.client_id) for a in handler.await_args.args[0]] == [(101, 1)]
+
+        # Оператор заполнен - второй клиент остается в очереди
+        await queue_manager.add_client_to_queue(2, 102)
+        assert await queue_manager.is_client_waiting(2)
+        assert await queue_manager.assign_chat_to_operator(102, 10, 2) is False
+
+        operator = await queue_manager.get_operator(10)
+        assert operator.current_chats == {101}
+        assert operator.can_accept_chat is False
+        assert (await queue_manager.fetch_queue_status())['available_operators'] == 0
+
+    async def test_release_triggers_batch_assignment(self, queue_manager):
+        """Тест автоназначения ожидающего клиента после освобождения оператора"""
+        handler = AsyncMock()
+        queue_manager.set_batch_assignment_handler(handler)
+
+        await queue_manager.set_operator_online(10, "support", max_concurrent_chats=1)
+        await queue_manager.add_client_to_queue(1, 101)
+        await queue_manager.add_client_to_queue(2, 102)
+        # Первый клиент назначен сразу при постановке в очередь
+        handler.reset_mock()
+
+        assert await queue_manager.release_operator_from_chat(101) is True
+        assert await queue_manager.release_operator_from_chat(101) is False
+
+        handler.assert_awaited_once()
+        assignments = handler.await_args.args[0]
+        assert [(a.chat_id, a.client_id, a.operator_id) for a in assignments] == [(102, 2, 10)]
+        assert await queue_manager.list_chat_assignments() == {102: 10}
+
+    async def test_match_waiting_clients_batch(self, queue_manager):
+        """Тест пакетного сопоставления с наименее загруженными операторами"""
+        await queue_manager.register_operator(10, "support", 2)
+        await queue_manager.register_operator(20, "support", 2)
+        for client_id in range(1, 6):
+            await queue_manager.add_client_to_queue(client_id, 100 + client_id)
+
+        await queue_manager.set_operator_online(10, "support", 2)
+        await queue_manager.set_operator_online(20, "support", 2)
+
+        # set_operator_online уже разобрал очередь - проверяем распределение
+        assignments = await queue_manager.list_chat_assignments()
+        assert len(assignments) == 4
+        loads = {operator.operator_id: len(operator.current_chats) for operator in await queue_manager.list_operators()}
+        assert loads == {10: 2, 20: 2}
+        assert [client.client_id for client in await queue_manager.list_waiting_clients()] == [5]
+
+    async def test_match_skips_stale_queue_entries(self, redis_client, queue_manager):
+        """Тест пропуска клиента без записи (остался в очереди после сбоя)"""
+        client, prefix = redis_client
+        await queue_manager.register_operator(10, "support", 5)
+        await queue_manager.add_client_to_queue(1, 101, priority=1)
+        await queue_manager.add_client_to_queue(2, 102)
+        await client.delete(prefix + 'client:1')
+        handler = AsyncMock()
+        queue_manager.set_batch_assignment_handler(handler)
+
+        await queue_manager.set_operator_online(10, "support")
+
+        assignments = handler.await_args.args[0]
+        assert [(a.chat_id, a.client_id) for a in assignments] == [(102, 2)]
+        assert await queue_manager.list_chat_assignments() == {102: 10}
+        assert await client.zrange(prefix + 'queue', 0, -1) == []
+
+    async def test_match_limit_and_revert(self, queue_manager):
+        """Тест ограничения пакета и отката назначений"""
+        for client_id in range(1, 4):
+            await queue_manager.add_client_to_queue(client_id, 100 + client_id, priority=client_id % 2)
+        # Автоназначение при входе в онлайн работает только для поддержки
+        await queue_manager.set_operator_online(10, "lawyer", 5)
+
+        assignments = await queue_manager.match_waiting_clients("lawyer", limit=2)
+        assert [a.client_id for a in assignments] == [1, 3]
+        assert assignments[0].client.chat_id == 101
+        assert [client.client_id for client in await queue_manager.list_waiting_clients()] == [2]
+
+        await queue_manager.revert_assignments(assignments)
+
+        assert await queue_manager.list_chat_assignments() == {}
+        assert [client.client_id for client in await queue_manager.list_waiting_clients()] == [1, 3, 2]
+        assert (await queue_manager.get_operator(10)).current_chats == set()
+
+    async def test_operator_offline_transfers_chats(self, queue_manager):
+        """Тест перевода чатов при уходе оператора в оффлайн"""
+        await queue_manager.set_operator_online(10, "support", 5)
+        await queue_manager.add_client_to_queue(1, 101)
+        await queue_manager.set_operator_online(20, "support", 5)
+
+        await queue_manager.set_operator_offline(10)
+
+        assert await queue_manager.get_chat_operator(101) == 20
+        operator = await queue_manager.get_operator(10)
+        assert operator.is_online is False
+        assert operator.current_chats == set()
+
+        # Без доступных операторов чат освобождается
+        await queue_manager.set_operator_offline(20)
+        assert await queue_manager.get_chat_operator(101) is None
+
+    async def test_revert_transfer(self, queue_manager):
+        """Тест отката перевода чата прежнему оператору"""
+        await queue_manager.set_operator_online(10, "support", max_concurrent_chats=1)
+        await queue_manager.set_operator_online(20, "support", max_concurrent_chats=1)
+        await queue_manager.add_client_to_queue(1, 101)
+        assert await queue_manager.get_chat_operator(101) == 10
+
+        assert await queue_manager.transfer_chat(101, 20) is True
+        assert await queue_manager.revert_transfer(101, 10, 20) is True
+        # Повторный откат ничего не меняет
+        assert await queue_manager.revert_transfer(101, 10, 20) is False
+
+        assert await queue_manager.list_chat_assignments() == {101: 10}
+        assert (await queue_manager.get_operator(10)).current_chats == {101}
+        assert (await queue_manager.get_operator(20)).current_chats == set()
+        assert (await queue_manager.fetch_queue_status())['available_operators'] == 1
+
+    async def test_state_shared_between_instances(self, redis_client, queue_manager):
+        """Тест общего состояния для нескольких экземпляров приложения"""
+        client, prefix = redis_client
+        other_node = RedisSupportQueueManager(client, key_prefix=prefix)
+
+        await queue_manager.add_client_to_queue(1, 101)
+        assert await other_node.is_client_waiting(1)
+
+        await other_node.set_operator_online(10, "support", 5)
+        assert await queue_manager.get_chat_operator(101) == 10
+        assert not await queue_manager.is_client_waiting(1)
+
+    async def test_restore_state_keeps_existing_entries(self, queue_manager):
+        """Тест восстановления из снимка БД без перезаписи состояния в Redis"""
+        from utils.queue_manager import QueuedClient
+
+        await queue_manager.add_client_to_queue(1, 101, priority=2)
+        snapshot_clients = [
+            QueuedClient(client_id=1, chat_id=101),
+            QueuedClient(client_id=2, chat_id=102),
+        ]
+
+        await queue_manager.restore_state(snapshot_clients, [(103, 7, "support")])
+        await queue_manager.restore_state(snapshot_clients, [(103, 7, "support")])
+
+        clients = await queue_manager.list_waiting_clients()
+        assert [(client.client_id, client.priority) for client in clients] == [(1, 2), (2, 0)]
+        assert await queue_manager.list_chat_assignments() == {103: 7}
+
+        operator = await queue_manager.get_operator(7)
+        assert operator.current_chats == {103}
+        assert operator.is_online is False
@@ -4,11 +4,17 @@
 import pytest
 import pytest_asyncio
 import asyncio
-from unittest.mock import AsyncMock, MagicMock
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from utils.websocket_manager import WebSocketConnectionManager
 
 
+def _sent_frames(websocket) -> list:
+    """Сообщения, отправленные соединению рассылкой (текстовые кадры)"""
+    return [json.loads(call.args[0]) for call in websocket.send_text.call_args_list]
+
+
 class TestWebSocketConnectionManager:
     """Тесты для WebSocketConnectionManager"""
     
@@ -22,7 +28,7 @@ class TestWebSocketConnectionManager:
         """Создает мок WebSocket соединения"""
         websocket = AsyncMock()
         websocket.accept = AsyncMock()
-        websocket.send_json = AsyncMock()
+        websocket.send_text = AsyncMock()
         websocket.close = AsyncMock()
         return websocket
     
@@ -49,7 +55,7 @@ class TestWebSocketConnectionManager:
         
         # Проверяем что соединение установлено
         assert user_id in websocket_manager.user_connections
-        assert websocket_manager.user_connections[user_id] == mock_websocket
+        assert websocket_manager.user_connections[user_id] == (mock_websocket,)
         
         # Проверяем метаданные
         assert user_id in websocket_manager.connection_metadata
@@ -62,23 +68,80 @@ class TestWebSocketConnectionManager:
         # Проверяем что WebSocket был принят
         mock_websocket.accept.assert_called_once()
     
-    async def test_connect_user_replace_existing(self, websocket_manager, mock_websocket):
-        """Тест замены существующего соединения пользователя"""
+    async def test_connect_user_second_socket_keeps_first(self, websocket_manager, mock_websocket):
+        """Тест: второй сокет пользователя (вторая вкладка) не закрывает первый"""
         user_id = 123
         user_role = "support"
         
-        # Создаем старое соединение
-        old_websocket = AsyncMock()
-        websocket_manager.user_connections[user_id] = old_websocket
-        
-        # Подключаем нового
-        await websocket_manager.connect_user(user_id, mock_websocket, user_role)
+        first_websocket = AsyncMock()
+        assert await websocket_manager.connect_user(user_id, first_websocket, user_role) == 1
+        assert await websocket_manager.connect_user(user_id, mock_websocket, user_role) == 2
         
-        # Проверяем что старое соединение было закрыто
-        old_websocket.close.assert_called_once()
-        
-        # Проверяем что новое соединение установлено
-        assert websocket_manager.user_connections[user_id] == mock_websocket
+        first_websocket.close.assert_not_called()
+        assert websocket_manager.user_connections[user_id] == (first_websocket, mock_websocket)
+        assert websocket_manager.operator_connections[user_id] == (first_websocket, mock_websocket)
+    
+    async def test_send_to_user_reaches_all_sockets(self, websocket_manager):
+        """Тест: сообщения пользователю уходят во все его сокеты"""
+        phone, web = AsyncMock(), AsyncMock()
+        await websocket_manager.connect_user(1, phone, "client")
+        await websocket_manager.connect_user(1, web, "client")
+        await websocket_manager.join_chat(1, 10)
+        
+        assert await websocket_manager.send_to_user(1, {"type": "direct"}) is True
+        await websocket_manager.broadcast_to_chat(10, {"type": "chat"})
+        await websocket_manager.flush()
+        
+        assert _sent_frames(phone) == [{"type": "direct"}, {"type": "chat"}]
+        assert _sent_frames(web) == [{"type": "direct"}, {"type": "chat"}]
+    
+    async def test_send_to_user_single_socket(self, websocket_manager):
+        """Тест: сообщение можно отправить только в один сокет пользователя"""
+        phone, web = AsyncMock(), AsyncMock()
+        await websocket_manager.connect_user(1, phone, "client")
+        await websocket_manager.connect_user(1, web, "client")
+        
+        assert await websocket_manager.send_to_user(1, {"type": "replay"}, web) is True
+        assert await websocket_manager.send_to_user(1, {"type": "replay"}, AsyncMock()) is False
+        await websocket_manager.flush()
+        
+        assert _sent_frames(phone) == []
+        assert _sent_frames(web) == [{"type": "replay"}]
+    
+    async def test_presence_is_reference_counted(self, websocket_manager):
+        """Тест: пользователь остается в сети и в чатах, пока открыт хотя бы один сокет"""
+        first, second = AsyncMock(), AsyncMock()
+        await websocket_manager.connect_user(1, first, "support")
+        await websocket_manager.connect_user(1, second, "support")
+        await websocket_manager.join_chat(1, 10)
+        
+        assert await websocket_manager.disconnect_user(1, first) == 1
+        assert websocket_manager.is_user_online(1)
+        assert websocket_manager.user_connections[1] == (second,)
+        assert 1 in websocket_manager.role_connections["support"]
+        assert websocket_manager.chat_connections[10] == {1}
+        
+        # Повторное закрытие того же сокета ничего не меняет
+        assert await websocket_manager.disconnect_user(1, first) == 1
+        
+        assert await websocket_manager.disconnect_user(1, second) == 0
+        assert not websocket_manager.is_user_online(1)
+        assert 1 not in websocket_manager.operator_connections
+        assert 1 not in websocket_manager.role_connections["support"]
+        assert 10 not in websocket_manager.chat_connections
+    
+    async def test_failed_socket_does_not_disconnect_others(self, websocket_manager):
+        """Тест: ошибка отправки в один сокет закрывает только его"""
+        broken, healthy = AsyncMock(), AsyncMock()
+        broken.send_text.side_effect = Exception("Connection error")
+        await websocket_manager.connect_user(1, broken, "client")
+        await websocket_manager.connect_user(1, healthy, "client")
+        
+        await websocket_manager.send_to_user(1, {"type": "test"})
+        await websocket_manager.flush()
+        
+        assert websocket_manager.user_connections[1] == (healthy,)
+        assert _sent_frames(healthy) == [{"type": "test"}]
     
     async def test_connect_user_different_roles(self, websocket_manager, mock_websocket):
         """Тест подключения пользователей с разными ролями"""
@@ -125,6 +188,40 @@ class TestWebSocketConnectionManager:
         assert user_id not in websocket_manager.operator_connections
         assert user_id not in websocket_manager.role_connections[user_role]
         assert user_id not in websocket_manager.chat_connections.get(chat_id, set())
+        assert user_id not in websocket_manager.user_chats
+        assert user_id not in websocket_manager.user_roles
+    
+    async def test_disconnect_user_touches_only_own_chats(self, websocket_manager, mock_websocket):
+        """Тест: отключение затрагивает только чаты пользователя, пустые чаты удаляются"""
+        user_id = 123
+        other_user_id = 321
+        
+        await websocket_manager.connect_user(user_id, mock_websocket, "client")
+        await websocket_manager.join_chat(user_id, 1)
+        await websocket_manager.join_chat(user_id, 2)
+        await websocket_manager.join_chat(other_user_id, 2)
+        await websocket_manager.join_chat(other_user_id, 3)
+        
+        assert websocket_manager.user_chats[user_id] == {1, 2}
+        
+        await websocket_manager.disconnect_user(user_id)
+        
+        assert 1 not in websocket_manager.chat_connections
+        assert websocket_manager.chat_connections[2] == {other_user_id}
+        assert websocket_manager.chat_connections[3] == {other_user_id}
+        assert websocket_manager.user_chats == {other_user_id: {2, 3}}
+    
+    async def test_reconnect_with_different_role(self, websocket_manager, mock_websocket):
+        """Тест: при переподключении с другой ролью пользователь удаляется из прежней"""
+        user_id = 123
+        
+        await websocket_manager.connect_user(user_id, mock_websocket, "support")
+        await websocket_manager.connect_user(user_id, AsyncMock(), "admin")
+        
+        assert user_id not in websocket_manager.role_connections["support"]
+        assert user_id not in websocket_manager.operator_connections
+        assert user_id in websocket_manager.role_connections["admin"]
+        assert websocket_manager.user_roles[user_id] == "admin"
     
     async def test_join_chat(self, websocket_manager):
         """Тест присоединения к чату"""
@@ -187,9 +284,10 @@ class TestWebSocketConnectionManager:
         
         # Отправляем сообщение
         result = await websocket_manager.send_to_user(user_id, message)
+        await websocket_manager.flush()
         
         assert result is True
-        mock_websocket.send_json.assert_called_once_with(message)
+        assert _sent_frames(mock_websocket) == [message]
     
     async def test_send_to_user_connection_error(self, websocket_manager, mock_websocket):
         """Тест обработки ошибки соединения при отправке сообщения"""
@@ -200,12 +298,14 @@ class TestWebSocketConnectionManager:
         await websocket_manager.connect_user(user_id, mock_websocket, "client")
         
         # Настраиваем ошибку при отправке
-        mock_websocket.send_json.side_effect = Exception("Connection error")
+        mock_websocket.send_text.side_effect = Exception("Connection error")
         
         # Отправляем сообщение
         result = await websocket_manager.send_to_user(user_id, message)
+        await websocket_manager.flush()
         
-        assert result is False
+        # Сообщение принято в исходящую очередь, ошибку обнаруживает писатель
+        assert result is True
         # Проверяем что пользователь был отключен
         assert user_id not in websocket_manager.user_connections
     
@@ -233,10 +333,11 @@ class TestWebSocketConnectionManager:
         
         # Рассылаем сообщение
         await websocket_manager.broadcast_to_chat(chat_id, message)
+        await websocket_manager.flush()
         
         # Проверяем что всем отправлено
         for user_id in user_ids:
-            websockets[user_id].send_json.assert_called_once_with(message)
+            assert _sent_frames(websockets[user_id]) == [message]
     
     async def test_broadcast_to_chat_exclude_user(self, websocket_manager):
         """Тест рассылки сообщения с исключением пользователя"""
@@ -255,14 +356,15 @@ class TestWebSocketConnectionManager:
         
         # Рассылаем сообщение с исключением
         await websocket_manager.broadcast_to_chat(chat_id, message, exclude_user=exclude_user)
+        await websocket_manager.flush()
         
         # Проверяем что исключенному не отправлено
-        websockets[exclude_user].send_json.assert_not_called()
+        websockets[exclude_user].send_text.assert_not_called()
         
         # Проверяем что остальным отправлено
         for user_id in user_ids:
             if user_id != exclude_user:
-                websockets[user_id].send_json.assert_called_once_with(message)
+                assert _sent_frames(websockets[user_id]) == [message]
     
     async def test_broadcast_to_role(self, websocket_manager):
         """Тест рассылки сообщения по роли"""
@@ -279,10 +381,11 @@ class TestWebSocketConnectionManager:
         
         # Рассылаем сообщение по роли
         await websocket_manager.broadcast_to_role(role, message)
+        await websocket_manager.flush()
         
         # Проверяем что всем отправлено
         for user_id in user_ids:
-            websockets[user_id].send_json.assert_called_once_with(message)
+            assert _sent_frames(websockets[user_id]) == [message]
     
     async def test_broadcast_to_role_exclude_user(self, websocket_manager):
         """Тест рассылки сообщения по роли с исключением пользователя"""
@@ -300,14 +403,15 @@ class TestWebSocketConnectionManager:
         
         # Рассылаем с исключением
         await websocket_manager.broadcast_to_role(role, message, exclude_user=exclude_user)
+        await websocket_manager.flush()
         
         # Проверяем исключение
-        websockets[exclude_user].send_json.assert_not_called()
+        websockets[exclude_user].send_text.assert_not_called()
         
         # Проверяем отправку остальным
         for user_id in user_ids:
             if user_id != exclude_user:
-                websockets[user_id].send_json.assert_called_once_with(message)
+                assert _sent_frames(websockets[user_id]) == [message]
     
     async def test_broadcast_to_operators(self, websocket_manager):
         """Тест рассылки сообщения операторам"""
@@ -326,14 +430,15 @@ class TestWebSocketConnectionManager:
         
         # Рассылаем всем операторам
         await websocket_manager.broadcast_to_operators(message)
+        await websocket_manager.flush()
         
         # Проверяем что всем операторам отправлено
-        support_websocket.send_json.assert_called_once_with(message)
-        lawyer_websocket.send_json.assert_called_once_with(message)
-        salesman_websocket.send_json.assert_called_once_with(message)
+        assert _sent_frames(support_websocket) == [message]
+        assert _sent_frames(lawyer_websocket) == [message]
+        assert _sent_frames(salesman_websocket) == [message]
         
         # Проверяем что клиенту не отправлено
-        client_websocket.send_json.assert_not_called()
+        client_websocket.send_text.assert_not_called()
     
     async def test_broadcast_to_operators_specific_types(self, websocket_manager):
         """Тест рассылки сообщения только определенным типам операторов"""
@@ -348,10 +453,119 @@ class TestWebSocketConnectionManager:
         
         # Рассылаем только операторам поддержки
         await websocket_manager.broadcast_to_operators(message, operator_types=["support"])
+        await websocket_manager.flush()
         
         # Проверяем рассылку
-        support_websocket.send_json.assert_called_once_with(message)
-        lawyer_websocket.send_json.assert_not_called()
+        assert _sent_frames(support_websocket) == [message]
+        lawyer_websocket.send_text.assert_not_called()
+    
+    async def test_broadcast_encodes_once(self, websocket_manager):
+        """Тест: сообщение рассылки сериализуется один раз для всех получателей"""
+        chat_id = 456
+        for user_id in (1, 2, 3):
+            await websocket_manager.connect_user(user_id, AsyncMock(), "client")
+            await websocket_manager.join_chat(user_id, chat_id)
+        
+        with patch('utils.websocket_manager._encode', wraps=json.dumps) as encode:
+            await websocket_manager.broadcast_to_chat(chat_id, {"type": "test"})
+            await websocket_manager.flush()
+        
+        encode.assert_called_once()
+    
+    async def test_broadcast_slow_recipient_does_not_block_others(self, websocket_manager):
+        """Тест: медленное соединение не задерживает остальных и отключается после рассылки"""
+        chat_id = 456
+        message = {"type": "test"}
+        delivered_before_timeout = []
+        
+        async def hang(text):
+            await asyncio.sleep(10)
+        
+        slow_websocket = AsyncMock()
+        slow_websocket.send_text = AsyncMock(side_effect=hang)
+        fast_websocket = AsyncMock()
+        fast_websocket.send_text = AsyncMock(side_effect=lambda text: delivered_before_timeout.append(text))
+        
+        await websocket_manager.connect_user(1, slow_websocket, "client")
+        await websocket_manager.connect_user(2, fast_websocket, "client")
+        await websocket_manager.join_chat(1, chat_id)
+        await websocket_manager.join_chat(2, chat_id)
+        
+        with patch('utils.websocket_manager.WEBSOCKET_SEND_TIMEOUT', 0.05):
+            # Рассылка не ждет сеть: кадры только ставятся в очереди соединений
+            await asyncio.wait_for(websocket_manager.broadcast_to_chat(chat_id, message), timeout=0.01)
+            await websocket_manager.flush()
+        
+        assert [json.loads(text) for text in delivered_before_timeout] == [message]
+        assert 1 not in websocket_manager.user_connections
+        assert 2 in websocket_manager.user_connections
+        assert websocket_manager.chat_connections[chat_id] == {2}
+        
+        stats = websocket_manager.get_connection_stats()
+        assert stats['broadcast_latency']['count'] == 1
+        assert stats['delivery_latency']['count'] == 2
+        assert stats['delivery_latency']['failed_recipients'] == 1
+        assert stats['outbound']['pending_connections'] == 0
+    
+    async def test_send_to_user_does_not_wait_for_network(self, websocket_manager):
+        """Тест: отправка не блокирует вызывающего, кадры уходят по порядку"""
+        release = asyncio.Event()
+        sent = []
+        
+        async def slow_send(text):
+            await release.wait()
+            sent.append(json.loads(text))
+        
+        websocket = AsyncMock()
+        websocket.send_text = AsyncMock(side_effect=slow_send)
+        await websocket_manager.connect_user(1, websocket, "client")
+        
+        for i in range(3):
+            assert await asyncio.wait_for(
+                websocket_manager.send_to_user(1, {"type": "message", "payload": {"n": i}}), timeout=0.01
+            ) is True
+        
+        assert websocket_manager.get_connection_stats()['outbound']['pending_frames'] == 2
+        
+        release.set()
+        await websocket_manager.flush()
+        assert [frame['payload']['n'] for frame in sent] == [0, 1, 2]
+    
+    async def test_slow_consumer_drops_optional_and_closes_on_overflow(self, websocket_manager):
+        """Тест: необязательные сообщения отбрасываются, переполненное соединение закрывается"""
+        release = asyncio.Event()
+        
+        async def blocked_send(text):
+            await release.wait()
+        
+        websocket = AsyncMock()
+        websocket.send_text = AsyncMock(side_effect=blocked_send)
+        await websocket_manager.connect_user(1, websocket, "support")
+        await websocket_manager.join_chat(1, 10)
+        
+        with patch('utils.outbound_queue.WEBSOCKET_OUTBOUND_QUEUE_SIZE', 2):
+            await websocket_manager.broadcast_to_chat(10, {"type": "message"})  # сразу у писателя
+            await asyncio.sleep(0)
+            await websocket_manager.broadcast_to_chat(10, {"type": "message"})
+            await websocket_manager.broadcast_to_chat(10, {"type": "message"})
+            
+            # Очередь заполнена: индикатор печати отбрасывается
+            assert await websocket_manager.send_to_user(
+                1, {"type": "typing", "payload": {"chat_id": 10, "user_id": 2}}
+            ) is False
+            assert websocket_manager.dropped_frames == 1
+            
+            # Обязательные сообщения принимаются сверх лимита до двойного размера очереди
+            await websocket_manager.broadcast_to_chat(10, {"type": "message"})
+            await websocket_manager.broadcast_to_chat(10, {"type": "message"})
+            assert 1 in websocket_manager.user_connections
+            
+            await websocket_manager.broadcast_to_chat(10, {"type": "message"})
+        
+        assert 1 not in websocket_manager.user_connections
+        assert 10 not in websocket_manager.chat_connections
+        assert websocket_manager.slow_consumers_closed == 1
+        websocket.close.assert_called_with(code=1013)
     
     async def test_notify_operators_new_chat(self, websocket_manager):
         """Тест уведомления операторов о новом чате"""
@@ -364,10 +578,10 @@ class TestWebSocketConnectionManager:
         
         # Отправляем уведомление
         await websocket_manager.notify_operators_new_chat(chat_id, client_id)
+        await websocket_manager.flush()
         
         # Проверяем что уведомление отправлено
-        support_websocket.send_json.assert_called_once()
-        call_args = support_websocket.send_json.call_args[0][0]
+        (call_args,) = _sent_frames(support_websocket)
         
         assert call_args['type'] == 'new_chat_available'
         assert call_args['payload']['chat_id'] == chat_id
@@ -387,17 +601,17 @@ class TestWebSocketConnectionManager:
         
         # Скрываем клиента
         await websocket_manager.hide_client_from_operators(client_id, except_operator=except_operator)
+        await websocket_manager.flush()
         
         # Проверяем что первому оператору отправлено уведомление
-        support1_websocket.send_json.assert_called_once()
-        call_args = support1_websocket.send_json.call_args[0][0]
+        (call_args,) = _sent_frames(support1_websocket)
         
         assert call_args['type'] == 'client_taken'
         assert call_args['payload']['client_id'] == client_id
         assert call_args['payload']['taken_by'] == except_operator
         
         # Проверяем что исключенному оператору не отправлено
-        support2_websocket.send_json.assert_not_called()
+        support2_websocket.send_text.assert_not_called()
     
     async def test_notify_chat_assigned(self, websocket_manager):
         """Тест уведомления о назначении чата"""
@@ -414,14 +628,11 @@ class TestWebSocketConnectionManager:
         
         # Отправляем уведомление
         await websocket_manager.notify_chat_assigned(chat_id, operator_id, client_id)
+        await websocket_manager.flush()
         
         # Проверяем уведомления
-        operator_websocket.send_json.assert_called_once()
-        client_websocket.send_json.assert_called_once()
-        
-        # Проверяем содержимое уведомлений
-        operator_call = operator_websocket.send_json.call_args[0][0]
-        client_call = client_websocket.send_json.call_args[0][0]
+        (operator_call,) = _sent_frames(operator_websocket)
+        (client_call,) = _sent_frames(client_websocket)
         
         assert operator_call['type'] == 'chat_assigned'
         assert operator_call['payload']['chat_id'] == chat_id
@@ -457,10 +668,11 @@ class TestWebSocketConnectionManager:
         await websocket_manager.notify_chat_transferred(
             chat_id, new_operator_id, previous_operator_id, reason
         )
+        await websocket_manager.flush()
         
         # Проверяем уведомления операторов
-        new_operator_websocket.send_json.assert_called()
-        previous_operator_websocket.send_json.assert_called()
+        assert _sent_frames(new_operator_websocket)
+        assert _sent_frames(previous_operator_websocket)
         
         # Проверяем что участники чата обновлены
         assert chat_id in websocket_manager.chat_connections
@@ -482,14 +694,11 @@ class TestWebSocketConnectionManager:
         
         # Отправляем уведомление
         await websocket_manager.notify_lawyer_assigned(client_id, lawyer_id, chat_id)
+        await websocket_manager.flush()
         
         # Проверяем уведомления
-        client_websocket.send_json.assert_called_once()
-        lawyer_websocket.send_json.assert_called_once()
-        
-        # Проверяем содержимое
-        client_call = client_websocket.send_json.call_args[0][0]
-        lawyer_call = lawyer_websocket.send_json.call_args[0][0]
+        (client_call,) = _sent_frames(client_websocket)
+        (lawyer_call,) = _sent_frames(lawyer_websocket)
         
         assert client_call['type'] == 'lawyer_assigned'
         assert client_call['payload']['lawyer_id'] == lawyer_id
@@ -1,13 +1,16 @@
 """
 Менеджер назначений операторов и юристов для чата поддержки
 """
-import asyncio
+import time
 from typing import Dict, List, Optional, Tuple
-from datetime import datetime
+from datetime import datetime, UTC
 import logging
 
 from database.logic.chats.chat import chat_db
-from utils.kafka_producer import kafka_producer
+from utils.kafka_producer import kafka_producer, chat_assigned_event, operator_accept_chat_event
+from utils.outbox_relay import outbox_relay, outbox_rows
+from utils.queue_manager import QueuedClient
+from utils.striped_lock import StripedLock
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +26,11 @@ class ChatAssignmentManager:
         self.user_roles_cache: Dict[int, str] = {}
         self.lawyer_assignments: Dict[int, int] = {}  # client_id -> lawyer_id
         
-        # Блокировки для избежания race conditions
-        self._assignment_lock = asyncio.Lock()
+        # Блокировки по чатам и клиентам: операции над одним чатом (назначение,
+        # перевод) упорядочены, несвязанные назначения идут параллельно.
+        # Емкость оператора проверяет сам менеджер очереди атомарно при назначении.
+        self._chat_locks = StripedLock()
+        self._client_locks = StripedLock()
     
     # Управление операторами
     
@@ -37,12 +43,12 @@ class ChatAssignmentManager:
     
     async def set_operator_offline(self, operator_id: int):
         """Установка оператора в оффлайн состояние"""
-        if operator_id in self.queue_manager.operators:
-            operator_type = self.queue_manager.operators[operator_id].operator_type
+        operator = await self.queue_manager.get_operator(operator_id)
+        if operator:
             await self.queue_manager.set_operator_offline(operator_id)
             
             # Отправляем Kafka событие
-            await kafka_producer.send_operator_offline(operator_id, operator_type)
+            await kafka_producer.send_operator_offline(operator_id, operator.operator_type)
     
     async def get_operator_type(self, user_id: int) -> Optional[str]:
         """Получение типа оператора по ID пользователя"""
@@ -60,60 +66,111 @@ class ChatAssignmentManager:
         self.user_roles_cache[user_id] = role
         return role
     
+    # Теплый рестарт
+    
+    async def restore_routing_state(self):
+        """
+        Восстановление очереди, назначений и юристов из БД после рестарта.
+        
+        Активные чаты без оператора возвращаются в очередь (время ожидания
+        считается от создания чата), чаты с оператором - в карту назначений.
+        Личные чаты с закрепленным юристом в очередь поддержки не попадают.
+        """
+        chats, lawyer_rows = await chat_db.load_routing_state()
+        
+        for row in lawyer_rows:
+            self.lawyer_assignments[row.client_id] = row.lawyer_id
+        
+        now = datetime.now(UTC)
+        monotonic_now = time.monotonic()
+        waiting_clients: List[QueuedClient] = []
+        assignments: List[Tuple[int, int, str]] = []
+        seen_chats = set()
+        
+        for chat_id, client_id, support_id, date_created, role in chats:
+            if chat_id in seen_chats:
+                continue
+            seen_chats.add(chat_id)
+            
+            if support_id is None:
+                if date_created.tzinfo is None:
+                    date_created = date_created.replace(tzinfo=UTC)
+                waiting_clients.append(QueuedClient(
+                    client_id=client_id,
+                    chat_id=chat_id,
+                    enqueued_at=monotonic_now - max(0.0, (now - date_created).total_seconds())
+                ))
+            elif self.lawyer_assignments.get(client_id) != support_id:
+                assignments.append((chat_id, support_id, role or "support"))
+        
+        await self.queue_manager.restore_state(waiting_clients, assignments)
+        logger.info(f"Восстановлено {len(lawyer_rows)} назначений юристов")
+    
     # Назначение чатов
     
     async def assign_chat_to_operator(self, chat_id: int, operator_id: int, client_id: int) -> bool:
         """Назначение чата оператору"""
-        async with self._assignment_lock:
-            # Проверяем, что оператор может принять чат
-            if operator_id not in self.queue_manager.operators:
-                logger.error(f"Оператор {operator_id} не найден")
-                return False
-            
-            operator = self.queue_manager.operators[operator_id]
-            if not operator.can_accept_chat:
+        operator = await self.queue_manager.get_operator(operator_id)
+        if operator is None:
+            logger.error(f"Оператор {operator_id} не найден")
+            return False
+        
+        async with self._chat_locks(chat_id):
+            # Менеджер очереди проверяет емкость и назначает чат одной операцией
+            if not await self.queue_manager.assign_chat_to_operator(chat_id, operator_id, client_id):
                 logger.error(f"Оператор {operator_id} не может принять чат")
                 return False
             
-            # Назначаем чат в менеджере очереди
-            success = await self.queue_manager.assign_chat_to_operator(chat_id, operator_id, client_id)
-            
-            if success:
-                # Обновляем БД
-                try:
-                    async with chat_db.get_async_session() as session:
-                        # Обновляем чат в БД - назначаем оператора
-                        await chat_db.update_chat_operator(session, chat_id, operator_id)
-                        
-                        # Добавляем участника в чат
-                        await chat_db.add_chat_participant(
-                            session, chat_id, operator_id, operator.operator_type
-                        )
-                    
-                    # Отправляем Kafka события
-                    await kafka_producer.send_chat_assigned(
-                        chat_id, operator_id, operator.operator_type, client_id, "operator_assignment"
-                    )
-                    await kafka_producer.send_operator_accept_chat(
-                        operator_id, operator.operator_type, chat_id, client_id
-                    )
-                    
-                    logger.info(f"Чат {chat_id} успешно назначен оператору {operator_id}")
-                    return True
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка обновления БД при назначении чата: {e}")
-                    # Откатываем назначение
-                    await self.queue_manager.release_operator_from_chat(chat_id)
-                    return False
-            
-            return False
+            # Обновляем БД: оператор чата, участник и события Kafka (outbox) - одна транзакция
+            try:
+                await chat_db.assign_operator(chat_id, operator_id, operator.operator_type, outbox=outbox_rows([
+                    chat_assigned_event(chat_id, operator_id, operator.operator_type, client_id, "operator_assignment"),
+                    operator_accept_chat_event(operator_id, operator.operator_type, chat_id, client_id),
+                ]))
+            except Exception as e:
+                logger.error(f"Ошибка обновления БД при назначении чата: {e}")
+                # Откатываем назначение
+                await self.queue_manager.release_operator_from_chat(chat_id)
+                return False
+        
+        # События отправит фоновая задача outbox, ответ не ждет брокера
+        outbox_relay.notify()
+        
+        logger.info(f"Чат {chat_id} успешно назначен оператору {operator_id}")
+        return True
+    
+    async def handle_batch_assignments(self, assignments: List):
+        """
+        Обработка пакета автоматических назначений из менеджера очереди.
+        
+        Все назначения и их Kafka события (outbox) сохраняются в БД одной
+        транзакцией, операторы получают одно WebSocket сообщение о разобранных
+        клиентах. При ошибке БД пакет откатывается в очереди.
+        """
+        try:
+            await chat_db.assign_operators_bulk([
+                (a.chat_id, a.operator_id, a.operator_type) for a in assignments
+            ], outbox=outbox_rows([
+                chat_assigned_event(a.chat_id, a.operator_id, a.operator_type, a.client_id, "auto_assignment")
+                for a in assignments
+            ]))
+        except Exception as e:
+            logger.error(f"Ошибка обновления БД при пакетном назначении чатов: {e}")
+            await self.queue_manager.revert_assignments(assignments)
+            return
+        outbox_relay.notify()
+        
+        if self.websocket_manager:
+            await self.websocket_manager.hide_clients_from_operators(
+                [a.client_id for a in assignments]
+            )
+        
+        logger.info(f"Пакет из {len(assignments)} назначений обработан")
     
     async def release_operator_from_chat(self, chat_id: int):
         """Освобождение оператора от чата"""
-        if chat_id in self.queue_manager.chat_assignments:
-            operator_id = self.queue_manager.chat_assignments[chat_id]
-            
+        operator_id = await self.queue_manager.get_chat_operator(chat_id)
+        if operator_id is not None:
             await self.queue_manager.release_operator_from_chat(chat_id)
             
             # Обновляем БД
@@ -129,59 +186,57 @@ class ChatAssignmentManager:
                                       from_operator_id: int, reason: str = "manual_transfer",
                                       admin_id: Optional[int] = None) -> bool:
         """Перевод чата другому оператору"""
-        async with self._assignment_lock:
-            # Проверяем, что новый оператор может принять чат
-            if new_operator_id not in self.queue_manager.operators:
-                logger.error(f"Новый оператор {new_operator_id} не найден")
-                return False
-            
-            new_operator = self.queue_manager.operators[new_operator_id]
-            if not new_operator.can_accept_chat:
+        new_operator = await self.queue_manager.get_operator(new_operator_id)
+        if new_operator is None:
+            logger.error(f"Новый оператор {new_operator_id} не найден")
+            return False
+        
+        async with self._chat_locks(chat_id):
+            # Менеджер очереди проверяет емкость нового оператора и переводит чат одной операцией
+            old_operator_id = await self.queue_manager.get_chat_operator(chat_id)
+            if not await self.queue_manager.transfer_chat(chat_id, new_operator_id, reason):
                 logger.error(f"Новый оператор {new_operator_id} не может принять чат")
                 return False
             
-            # Выполняем перевод
-            success = await self.queue_manager.transfer_chat(chat_id, new_operator_id, reason)
-            
-            if success:
-                try:
-                    async with chat_db.get_async_session() as session:
-                        # Выполняем перевод чата в БД
-                        await chat_db.transfer_chat(
-                            session, chat_id, new_operator_id, from_operator_id, None
-                        )
-                    
-                    # Получаем информацию о клиенте
-                    client_id = await self._get_client_id_from_chat(chat_id)
-                    
-                    # Отправляем Kafka события
-                    await kafka_producer.send_chat_transferred(
-                        chat_id, new_operator_id, new_operator.operator_type,
-                        from_operator_id, client_id, reason
+            try:
+                async with chat_db.get_async_session() as session:
+                    # Выполняем перевод чата в БД
+                    await chat_db.transfer_chat(
+                        session, chat_id, new_operator_id, from_operator_id, None
                     )
-                    
-                    if admin_id:
-                        await kafka_producer.send_force_transfer(
-                            admin_id, chat_id, new_operator_id, from_operator_id, reason
-                        )
-                    
-                    logger.info(f"Чат {chat_id} переведен с оператора {from_operator_id} на {new_operator_id}")
-                    return True
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка БД при переводе чата: {e}")
-                    return False
+            except Exception as e:
+                logger.error(f"Ошибка БД при переводе чата: {e}")
+                # Чат возвращается прежнему оператору, чтобы очередь не расходилась с БД
+                await self.queue_manager.revert_transfer(chat_id, old_operator_id, new_operator_id)
+                return False
+        
+        # Получаем информацию о клиенте и отправляем Kafka события (вне блокировки)
+        try:
+            client_id = await self._get_client_id_from_chat(chat_id)
             
-            return False
+            await kafka_producer.send_chat_transferred(
+                chat_id, new_operator_id, new_operator.operator_type,
+                from_operator_id, client_id, reason
+            )
+            
+            if admin_id:
+                await kafka_producer.send_force_transfer(
+                    admin_id, chat_id, new_operator_id, from_operator_id, reason
+                )
+        except Exception as e:
+            logger.error(f"Ошибка отправки событий перевода чата {chat_id}: {e}")
+        
+        logger.info(f"Чат {chat_id} переведен с оператора {from_operator_id} на {new_operator_id}")
+        return True
     
     # Назначение юристов
     
     async def assign_personal_lawyer(self, client_id: int, lawyer_id: int, assigned_by: int) -> Optional[int]:
         """Назначение персонального юриста клиенту"""
-        async with self._assignment_lock:
+        async with self._client_locks(client_id):
             try:
                 # Проверяем, что юрист доступен
-                if lawyer_id not in self.queue_manager.operators:
+                if await self.queue_manager.get_operator(lawyer_id) is None:
                     await self.queue_manager.register_operator(lawyer_id, "lawyer", 10)
                 
                 # Создаем новый чат с юристом
@@ -195,15 +250,18 @@ class ChatAssignmentManager:
                 # Сохраняем назначение
                 self.lawyer_assignments[client_id] = lawyer_id
                 
-                # Отправляем Kafka событие
-                await kafka_producer.send_lawyer_assigned(client_id, lawyer_id, lawyer_chat.id)
-                
-                logger.info(f"Клиенту {client_id} назначен персональный юрист {lawyer_id}")
-                return lawyer_chat.id
-                
             except Exception as e:
                 logger.error(f"Ошибка назначения юриста: {e}")
                 return None
+        
+        # Отправляем Kafka событие (вне блокировки)
+        try:
+            await kafka_producer.send_lawyer_assigned(client_id, lawyer_id, lawyer_chat.id)
+        except Exception as e:
+            logger.error(f"Ошибка отправки события назначения юриста: {e}")
+        
+        logger.info(f"Клиенту {client_id} назначен персональный юрист {lawyer_id}")
+        return lawyer_chat.id
     
     async def create_lawyer_chat(self, client_id: int, lawyer_id: int) -> Optional[int]:
         """Создание отдельного чата с юристом"""
@@ -292,27 +350,25 @@ class ChatAssignmentManager:
     
     async def get_operator_chats(self, operator_id: int) -> List[int]:
         """Получение списка чатов оператора"""
-        if operator_id in self.queue_manager.operators:
-            return list(self.queue_manager.operators[operator_id].current_chats)
-        return []
+        operator = await self.queue_manager.get_operator(operator_id)
+        return list(operator.current_chats) if operator else []
     
     async def get_chat_operator(self, chat_id: int) -> Optional[int]:
         """Получение оператора чата"""
-        return self.queue_manager.chat_assignments.get(chat_id)
+        return await self.queue_manager.get_chat_operator(chat_id)
     
     async def is_operator_available(self, operator_id: int) -> bool:
         """Проверка доступности оператора"""
-        if operator_id in self.queue_manager.operators:
-            return self.queue_manager.operators[operator_id].can_accept_chat
-        return False
+        operator = await self.queue_manager.get_operator(operator_id)
+        return operator.can_accept_chat if operator else False
     
-    def get_assignment_stats(self) -> Dict:
+    async def get_assignment_stats(self) -> Dict:
         """Получение статистики назначений"""
-        total_assignments = len(self.queue_manager.chat_assignments)
+        total_assignments = len(await self.queue_manager.list_chat_assignments())
         operator_loads = {}
         
-        for operator_id, operator in self.queue_manager.operators.items():
-            operator_loads[operator_id] = {
+        for operator in await self.queue_manager.list_operators():
+            operator_loads[operator.operator_id] = {
                 'type': operator.operator_type,
                 'current_chats': len(operator.current_chats),
                 'max_chats': operator.max_concurrent_chats,
@@ -0,0 +1,151 @@
+"""
+Журнал событий чатов для возобновления сессий: сквозной номер (seq) каждого
+события чата и короткий кольцевой буфер последних событий для досылки
+после переподключения
+"""
+import json
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+from config.chat_config import (
+    CHAT_REPLAY_BUFFER_SIZE,
+    CHAT_REPLAY_MAX_CHATS,
+    CHAT_REPLAY_TTL,
+    CHAT_STATE_KEY_PREFIX,
+    CHAT_STATE_REDIS_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ChatEventLog:
+    """
+    Журнал событий чатов в памяти процесса.
+
+    append() присваивает событию следующий номер в чате и запоминает его
+    в буфере на capacity событий. since() возвращает события после номера,
+    который клиент видел последним, или None, если часть из них уже вытеснена
+    из буфера (или журнал их не видел, например после рестарта) - тогда
+    недостающее нужно брать из БД.
+
+    Хранятся только max_chats чатов с самыми свежими событиями (LRU): номер
+    чата - номер последнего события в его буфере и вытесняется вместе с ним.
+    Нумерация нового буфера начинается после наибольшего вытесненного номера,
+    поэтому номера, которые клиенты получили до вытеснения, не повторяются.
+    """
+
+    def __init__(self, capacity: int = CHAT_REPLAY_BUFFER_SIZE, max_chats: int = CHAT_REPLAY_MAX_CHATS):
+        self._capacity = capacity
+        self._max_chats = max_chats
+        self._events: "OrderedDict[int, Deque[Tuple[int, Dict[str, Any]]]]" = OrderedDict()
+        self._evicted_seq = 0  # наибольший номер среди вытесненных чатов
+
+    async def append(self, chat_id: int, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Событие с присвоенным номером (исходный словарь не изменяется)"""
+        events = self._events.get(chat_id)
+        if events is None:
+            if len(self._events) >= self._max_chats:
+                _, evicted = self._events.popitem(last=False)
+                self._evicted_seq = max(self._evicted_seq, evicted[-1][0])
+            events = self._events[chat_id] = deque(maxlen=self._capacity)
+            seq = self._evicted_seq + 1
+        else:
+            self._events.move_to_end(chat_id)
+            seq = events[-1][0] + 1
+        event = {**message, 'seq': seq}
+        events.append((seq, event))
+        return event
+
+    async def current_seq(self, chat_id: int) -> int:
+        """Номер последнего события чата (без буфера - номер, после которого начнется нумерация)"""
+        events = self._events.get(chat_id)
+        return events[-1][0] if events else self._evicted_seq
+
+    async def since(self, chat_id: int, last_seq: int) -> Optional[List[Dict[str, Any]]]:
+        """События с номером больше last_seq или None, если буфер их уже не содержит"""
+        events = self._events.get(chat_id)
+        if not events:
+            # Буфер вытеснен или журнал не видел событий чата - нужна БД
+            return None
+        current = events[-1][0]
+        if last_seq == current:
+            return []
+        if last_seq > current or events[0][0] > last_seq + 1:
+            return None
+        return [event for seq, event in events if seq > last_seq]
+
+
+# Номер события - ID записи стрима вида 0-<seq>, поэтому XRANGE по номерам
+# работает без отдельного индекса. INCR и XADD в одном скрипте, чтобы номера
+# с разных узлов попадали в стрим по порядку
+_APPEND = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', ARGV[2], '0-' .. seq, 'e', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return seq
+"""
+
+
+class RedisChatEventLog:
+    """
+    Журнал событий чатов в Redis: номер - счетчик INCR, буфер - Redis Stream
+    с ограничением длины. Номера и буфер общие для всех экземпляров приложения,
+    поэтому клиент может переподключиться к любому узлу.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, key_prefix: str = CHAT_STATE_KEY_PREFIX,
+                 capacity: int = CHAT_REPLAY_BUFFER_SIZE, ttl: int = CHAT_REPLAY_TTL):
+        self._redis = redis_client or aioredis.from_url(CHAT_STATE_REDIS_URL, decode_responses=True)
+        self._prefix = key_prefix
+        self._capacity = capacity
+        self._ttl = ttl
+        self._append = self._redis.register_script(_APPEND)
+
+    def _keys(self, chat_id: int) -> Tuple[str, str]:
+        return f"{self._prefix}chat:{chat_id}:seq", f"{self._prefix}chat:{chat_id}:events"
+
+    async def append(self, chat_id: int, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Событие с присвоенным номером (исходный словарь не изменяется)"""
+        seq = await self._append(
+            keys=self._keys(chat_id),
+            args=[json.dumps(message, default=str), self._capacity, self._ttl],
+        )
+        return {**message, 'seq': int(seq)}
+
+    async def current_seq(self, chat_id: int) -> int:
+        """Номер последнего события чата (0 - событий не было)"""
+        seq_key, _ = self._keys(chat_id)
+        return int(await self._redis.get(seq_key) or 0)
+
+    async def since(self, chat_id: int, last_seq: int) -> Optional[List[Dict[str, Any]]]:
+        """События с номером больше last_seq или None, если буфер их уже не содержит"""
+        seq_key, events_key = self._keys(chat_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.get(seq_key)
+            pipe.xrange(events_key, min=f"0-{last_seq + 1}", max="+")
+            current, entries = await pipe.execute()
+        current = int(current or 0)
+        if last_seq == current:
+            return []
+        if last_seq > current or not entries or entries[0][0] != f"0-{last_seq + 1}":
+            return None
+        return [
+            {**json.loads(fields['e']), 'seq': int(entry_id.split('-', 1)[1])}
+            for entry_id, fields in entries
+        ]
+
+
+# Выбор хранилища в зависимости от конфигурации: при общем состоянии в Redis
+# номера событий тоже общие для всех узлов. Рассылка между узлами требует
+# общего журнала - иначе каждый узел нумеровал бы события чата по-своему,
+# а события с других узлов не попадали бы в локальный буфер
+from config.chat_config import CHAT_FANOUT_ENABLED, CHAT_STATE_BACKEND, ChatStateBackend
+
+if CHAT_STATE_BACKEND == ChatStateBackend.REDIS or CHAT_FANOUT_ENABLED:
+    chat_event_log = RedisChatEventLog()
+else:
+    chat_event_log = ChatEventLog()
@@ -0,0 +1,154 @@
+"""
+Доставка событий чатов между узлами: локальная рассылка через websocket_manager,
+удаленная - через Redis pub/sub по каналам чатов с локальными участниками
+"""
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Set
+
+from config.chat_config import (
+    CHAT_FANOUT_CHANNEL_PREFIX,
+    CHAT_FANOUT_ENABLED,
+    CHAT_FANOUT_PATTERN_SUBSCRIBE,
+    CHAT_FANOUT_REDIS_URL,
+    CHAT_NODE_ID,
+)
+from utils.chat_event_log import chat_event_log
+from utils.outbound_queue import coalesce_key
+from utils.striped_lock import StripedLock
+from utils.websocket_manager import WebSocketConnectionManager, websocket_manager
+
+logger = logging.getLogger(__name__)
+
+
+class ChatFanout:
+    """
+    Рассылка событий чата по всем узлам.
+
+    Узел-источник доставляет событие своим сокетам напрямую, без Redis,
+    и публикует его в канал чата для остальных узлов. Узел подписан только
+    на каналы чатов, в которых у него есть подключенные участники: подписка
+    оформляется при появлении первого участника и снимается при уходе
+    последнего. Без pubsub работает как локальная рассылка.
+
+    С журналом событий (event_log) каждое событие чата, кроме необязательных
+    (индикатор печати), получает номер seq до рассылки - по нему клиент
+    после переподключения запрашивает пропущенное.
+    """
+
+    def __init__(self, websocket_manager: WebSocketConnectionManager, pubsub=None, event_log=None,
+                 node_id: str = CHAT_NODE_ID, channel_prefix: str = CHAT_FANOUT_CHANNEL_PREFIX):
+        self.websocket_manager = websocket_manager
+        self.pubsub = pubsub
+        self.event_log = event_log
+        self.node_id = node_id
+        self.channel_prefix = channel_prefix
+        self._subscribed: Set[int] = set()
+        self._sync_locks = StripedLock()
+        self._sync_tasks: Set[asyncio.Task] = set()
+
+    def _channel(self, chat_id: int) -> str:
+        return f"{self.channel_prefix}{chat_id}"
+
+    async def start(self):
+        """Запуск: подписка на уже активные чаты и слежение за присутствием"""
+        if self.pubsub is None:
+            return
+        await self.pubsub.start(self._on_remote_message)
+        self.websocket_manager.set_chat_presence_listener(self._on_chat_presence)
+        for chat_id in list(self.websocket_manager.chat_connections):
+            self._on_chat_presence(chat_id, True)
+        logger.info(f"Chat fanout started on node {self.node_id}")
+
+    async def stop(self):
+        """Остановка: отписка от всех каналов и закрытие pubsub"""
+        if self.pubsub is None:
+            return
+        self.websocket_manager.set_chat_presence_listener(None)
+        for task in list(self._sync_tasks):
+            task.cancel()
+        if self._sync_tasks:
+            await asyncio.gather(*self._sync_tasks, return_exceptions=True)
+        await self.pubsub.stop()
+        self._subscribed.clear()
+        logger.info(f"Chat fanout stopped on node {self.node_id}")
+
+    def _on_chat_presence(self, chat_id: int, present: bool):
+        """Слушатель websocket_manager: синхронизация подписки выносится в задачу"""
+        task = asyncio.create_task(self._sync(chat_id))
+        self._sync_tasks.add(task)
+        task.add_done_callback(self._sync_tasks.discard)
+
+    async def _sync(self, chat_id: int):
+        """
+        Приведение подписки на канал чата к текущему локальному присутствию.
+
+        Смотрит на фактическое состояние, а не на событие, поэтому быстрые
+        вход/выход в чат схлопываются, а порядок задач не важен.
+        """
+        async with self._sync_locks(chat_id):
+            present = chat_id in self.websocket_manager.chat_connections
+            if present == (chat_id in self._subscribed):
+                return
+            try:
+                if present:
+                    await self.pubsub.subscribe(self._channel(chat_id))
+                    self._subscribed.add(chat_id)
+                else:
+                    await self.pubsub.unsubscribe(self._channel(chat_id))
+                    self._subscribed.discard(chat_id)
+            except Exception as e:
+                logger.error(f"Error syncing fanout subscription for chat {chat_id}: {e}")
+
+    async def broadcast_to_chat(self, chat_id: int, message: Dict[str, Any],
+                                exclude_user: Optional[int] = None):
+        """Рассылка события всем участникам чата на всех узлах"""
+        if self.event_log is not None and coalesce_key(message) is None:
+            try:
+                message = await self.event_log.append(chat_id, message)
+            except Exception as e:
+                logger.error(f"Error assigning sequence to chat {chat_id} event: {e}")
+        await self.websocket_manager.broadcast_to_chat(chat_id, message, exclude_user=exclude_user)
+        if self.pubsub is None:
+            return
+        try:
+            await self.pubsub.publish(self._channel(chat_id), {
+                'origin': self.node_id,
+                'exclude_user': exclude_user,
+                'message': message,
+            })
+        except Exception as e:
+            logger.error(f"Error publishing chat {chat_id} event to other nodes: {e}")
+
+    async def _on_remote_message(self, channel: str, envelope: Dict[str, Any]):
+        """Событие из Redis: доставка локальным участникам чата"""
+        if envelope.get('origin') == self.node_id or 'message' not in envelope:
+            return
+        try:
+            chat_id = int(channel[len(self.channel_prefix):])
+        except ValueError:
+            logger.warning(f"Unexpected fanout channel: {channel}")
+            return
+        await self.websocket_manager.broadcast_to_chat(
+            chat_id, envelope['message'], exclude_user=envelope.get('exclude_user')
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика подписок узла"""
+        return {
+            'node_id': self.node_id,
+            'enabled': self.pubsub is not None,
+            'subscribed_chats': len(self._subscribed),
+        }
+
+
+# Глобальный экземпляр
+if CHAT_FANOUT_ENABLED:
+    from endpoints.chats.redis_bridge import RedisPubSub
+
+    chat_fanout = ChatFanout(websocket_manager, RedisPubSub(
+        CHAT_FANOUT_REDIS_URL,
+        pattern=CHAT_FANOUT_CHANNEL_PREFIX + '*' if CHAT_FANOUT_PATTERN_SUBSCRIBE else None,
+    ), event_log=chat_event_log)
+else:
+    chat_fanout = ChatFanout(websocket_manager, event_log=chat_event_log)
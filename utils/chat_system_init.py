@@ -10,6 +10,9 @@ from utils.kafka_consumer import kafka_consumer, SupportChatEventHandlers
 from utils.queue_manager import queue_manager
 from utils.assignment_manager import create_assignment_manager
 from utils.websocket_manager import websocket_manager
+from utils.chat_fanout import chat_fanout
+from utils.message_writer import chat_message_writer
+from utils.outbox_relay import outbox_relay
 from config.kafka_config import KafkaTopics, ChatEventType, SupportQueueEventType, OperatorEventType, AssignmentEventType, AdminActionType, KAFKA_ENABLED
 
 logger = logging.getLogger(__name__)
@@ -41,19 +44,34 @@ class SupportChatSystem:
             await kafka_producer.start()
             logger.info("Kafka Producer запущен")
             
+            # 1.1. Запускаем отправку событий из outbox
+            await outbox_relay.start()
+            
             # 2. Запускаем менеджер очереди
             await queue_manager.start()
             logger.info("Менеджер очереди запущен")
             
             # 3. Создаем менеджер назначений
             self.assignment_manager = create_assignment_manager(queue_manager, websocket_manager)
+            queue_manager.set_batch_assignment_handler(self.assignment_manager.handle_batch_assignments)
             logger.info("Менеджер назначений создан")
-            
+
+            # 3.1. Восстанавливаем очередь и назначения из БД (теплый рестарт)
+            try:
+                await self.assignment_manager.restore_routing_state()
+            except Exception as e:
+                logger.error(f"Не удалось восстановить состояние очереди из БД: {e}")
+
+            # 3.2. Запускаем доставку событий чатов между узлами
+            await chat_fanout.start()
+            logger.info("Рассылка событий чатов между узлами запущена")
+
             # 4. Создаем обработчики событий
             self.event_handlers = SupportChatEventHandlers(
                 websocket_manager, 
                 queue_manager, 
-                self.assignment_manager
+                self.assignment_manager,
+                chat_fanout
             )
             
             # 5. Регистрируем обработчики событий в Kafka Consumer (или mock)
@@ -166,8 +184,17 @@ class SupportChatSystem:
             logger.info("Kafka Consumer остановлен")
             
             await queue_manager.stop()
+            queue_manager.set_batch_assignment_handler(None)
             logger.info("Менеджер очереди остановлен")
             
+            await chat_fanout.stop()
+            logger.info("Рассылка событий чатов между узлами остановлена")
+            
+            await chat_message_writer.flush()
+            logger.info("Накопленные сообщения чатов записаны")
+            
+            await outbox_relay.stop()
+            
             await kafka_producer.stop()
             logger.info("Kafka Producer остановлен")
             
@@ -181,7 +208,7 @@ class SupportChatSystem:
         """Проверка, запущена ли система"""
         return self.started
     
-    def get_system_status(self) -> dict:
+    async def get_system_status(self) -> dict:
         """Получение статуса всей системы"""
         if not self.started:
             return {"status": "stopped"}
@@ -192,17 +219,22 @@ class SupportChatSystem:
             "mode": "production" if KAFKA_ENABLED else "mock",
             "queue_manager": {
                 "running": queue_manager._running,
-                "operators_count": len(queue_manager.operators),
-                "waiting_clients": len(queue_manager.waiting_clients),
-                "active_chats": len(queue_manager.chat_assignments)
+                "operators_count": len(await queue_manager.list_operators()),
+                "waiting_clients": (await queue_manager.fetch_queue_status())['total_waiting'],
+                "active_chats": len(await queue_manager.list_chat_assignments())
             },
             "kafka": {
                 "enabled": KAFKA_ENABLED,
                 "producer_started": kafka_producer._started,
-                "consumer_started": kafka_consumer._started
+                "producer": kafka_producer.get_stats(),
+                "consumer_started": kafka_consumer._started,
+                "consumer": kafka_consumer.get_stats()
             },
             "websockets": websocket_manager.get_connection_stats(),
-            "assignments": self.assignment_manager.get_assignment_stats() if self.assignment_manager else {}
+            "fanout": chat_fanout.get_stats(),
+            "message_writer": chat_message_writer.get_stats(),
+            "outbox": outbox_relay.get_stats(),
+            "assignments": await self.assignment_manager.get_assignment_stats() if self.assignment_manager else {}
         }
 
 
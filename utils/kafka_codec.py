@@ -0,0 +1,142 @@
+"""
+Кодек событий Kafka, общий для producer и consumer: события собираются
+сразу в словари по схемам, один раз построенным из pydantic-моделей
+config/kafka_config.py, и сериализуются orjson
+"""
+import json
+import logging
+from datetime import datetime
+from enum import Enum
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+from pydantic import BaseModel
+
+from config.kafka_config import (
+    KafkaTopics,
+    ChatEvent, SupportQueueEvent, OperatorEvent, AssignmentEvent, AdminActionEvent
+)
+
+try:
+    import orjson
+except ImportError:  # окружение без зависимостей проекта - запасной путь через json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def _enum_decoder(enum_cls: Type[Enum]) -> Callable[[Any], Any]:
+    # Неизвестное значение остается строкой - событие дойдет до проверки обработчика
+    members = enum_cls._value2member_map_
+    return lambda value: members.get(value, value)
+
+
+def _datetime_decoder(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            logger.warning(f"Некорректная дата в событии: {value!r}")
+    return value
+
+
+class EventSchema:
+    """
+    Схема события, построенная один раз по pydantic-модели.
+
+    build() собирает событие-словарь без валидации pydantic: значения
+    по умолчанию подставляются, обязательные поля проверяются. decode()
+    приводит поля прочитанного события к типам модели (datetime, Enum) -
+    обработчики получают тот же словарь, что и раньше, но с типизированными
+    значениями.
+    """
+    __slots__ = ('model', '_defaults', '_required', '_decoders')
+
+    def __init__(self, model: Type[BaseModel]):
+        self.model = model
+        self._defaults: Dict[str, Any] = {}
+        required = []
+        decoders = []
+        for name, field in model.model_fields.items():
+            if field.is_required():
+                required.append(name)
+            else:
+                self._defaults[name] = field.default
+            annotation = field.annotation
+            if annotation is datetime:
+                decoders.append((name, _datetime_decoder))
+            elif isinstance(annotation, type) and issubclass(annotation, Enum):
+                decoders.append((name, _enum_decoder(annotation)))
+        self._required: Tuple[str, ...] = tuple(required)
+        self._decoders: Tuple[Tuple[str, Callable[[Any], Any]], ...] = tuple(decoders)
+
+    def build(self, **fields) -> Dict[str, Any]:
+        """Событие-словарь с подставленными значениями по умолчанию"""
+        for name in self._required:
+            if name not in fields:
+                raise ValueError(f"{self.model.__name__}: не указано поле {name}")
+        event = dict(self._defaults)
+        event.update(fields)
+        return event
+
+    def decode(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        """Приведение полей прочитанного события к типам схемы (на месте)"""
+        for name, decoder in self._decoders:
+            value = event.get(name)
+            if value is not None:
+                event[name] = decoder(value)
+        return event
+
+
+# Схемы событий по топикам
+CHAT_EVENT = EventSchema(ChatEvent)
+SUPPORT_QUEUE_EVENT = EventSchema(SupportQueueEvent)
+OPERATOR_EVENT = EventSchema(OperatorEvent)
+ASSIGNMENT_EVENT = EventSchema(AssignmentEvent)
+ADMIN_ACTION_EVENT = EventSchema(AdminActionEvent)
+
+TOPIC_SCHEMAS: Dict[str, EventSchema] = {
+    KafkaTopics.CHAT_EVENTS: CHAT_EVENT,
+    KafkaTopics.SUPPORT_QUEUE: SUPPORT_QUEUE_EVENT,
+    KafkaTopics.OPERATOR_EVENTS: OPERATOR_EVENT,
+    KafkaTopics.CHAT_ASSIGNMENTS: ASSIGNMENT_EVENT,
+    KafkaTopics.ADMIN_ACTIONS: ADMIN_ACTION_EVENT,
+}
+
+
+if orjson is not None:
+    def encode_event(event: Dict[str, Any]) -> bytes:
+        """Сериализация события (datetime - ISO 8601, Enum - значение)"""
+        return orjson.dumps(event, default=str)
+
+    _loads = orjson.loads
+else:
+    def encode_event(event: Dict[str, Any]) -> bytes:
+        """Сериализация события (datetime - ISO 8601, Enum - значение)"""
+        return json.dumps(event, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+    _loads = json.loads
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def jsonable_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Событие в виде JSON-совместимого словаря (для хранения в JSONB)"""
+    return _loads(encode_event(event))
+
+
+def decode_event(raw: bytes, schema: Optional[EventSchema] = None) -> Dict[str, Any]:
+    """Чтение события: JSON в словарь и, если известна схема, приведение типов"""
+    event = _loads(raw)
+    if schema is not None and isinstance(event, dict):
+        schema.decode(event)
+    return event
+
+
+def topic_decoder(topic: str) -> Callable[[bytes], Dict[str, Any]]:
+    """value_deserializer для consumer'а топика"""
+    schema = TOPIC_SCHEMAS.get(topic)
+    return lambda raw: decode_event(raw, schema)
@@ -1,29 +1,81 @@
 """
 Kafka Consumer для обработки событий чата поддержки
 """
-import json
 import asyncio
-from typing import Dict, Callable, Any, Set
+from datetime import datetime
+from typing import Dict, Callable, Any, Set, List, Optional, Hashable
 from aiokafka import AIOKafkaConsumer
 import logging
 
 from config.kafka_config import (
     KAFKA_CONFIG, KafkaTopics,
+    KAFKA_CONSUMER_BATCHED, KAFKA_CONSUMER_MAX_RECORDS,
+    KAFKA_CONSUMER_POLL_TIMEOUT_MS, KAFKA_CONSUMER_WORKERS, KAFKA_CONSUMER_ERROR_BACKOFF,
+    KAFKA_CONSUMER_HANDLER_ATTEMPTS, KAFKA_CONSUMER_RETRY_BACKOFF,
     ChatEventType, SupportQueueEventType, OperatorEventType,
     AssignmentEventType, AdminActionType
 )
+from utils.kafka_codec import TOPIC_SCHEMAS, decode_event, topic_decoder
+from utils.kafka_dedup import event_deduplicator
 
 logger = logging.getLogger(__name__)
 
 
+# Топики, которые читает сервис
+CONSUMED_TOPICS = [
+    KafkaTopics.CHAT_EVENTS,
+    KafkaTopics.SUPPORT_QUEUE,
+    KafkaTopics.OPERATOR_EVENTS,
+    KafkaTopics.CHAT_ASSIGNMENTS,
+    KafkaTopics.ADMIN_ACTIONS
+]
+
+
+def _ordering_key(message, event_data: Dict[str, Any]) -> Hashable:
+    """Ключ упорядочивания: события одного чата (или оператора, клиента) обрабатываются по порядку"""
+    for field in ('chat_id', 'operator_id', 'client_id'):
+        value = event_data.get(field)
+        if value is not None:
+            return field, value
+    # Без ключа - порядок партиции
+    return message.topic, message.partition
+
+
 class SupportChatKafkaConsumer:
-    """Kafka Consumer для чата поддержки"""
+    """
+    Kafka Consumer для чата поддержки.
     
-    def __init__(self):
+    В пакетном режиме (batched) один клиент подписан на все топики и забирает
+    события пачками getmany(). Пачка раскладывается по ключам (chat_id,
+    operator_id, client_id): события одного ключа обрабатываются по порядку,
+    разные ключи - параллельно (не больше workers одновременно). Offset'ы
+    фиксируются только после обработки всей пачки.
+    
+    Без пакетного режима - отдельный consumer на каждый топик, события
+    обрабатываются по одному, offset фиксируется после каждого события.
+    
+    Повторная доставка (ребалансировка, падение до commit, повтор outbox)
+    безопасна: обработанные event_id запоминаются в окне дедупликации,
+    повторы пропускаются без вызова обработчиков. Упавший обработчик
+    вызывается повторно до handler_attempts раз, после чего событие
+    пропускается, чтобы не блокировать партицию.
+    """
+    
+    def __init__(self, batched: bool = KAFKA_CONSUMER_BATCHED, workers: int = KAFKA_CONSUMER_WORKERS,
+                 dedup=None, handler_attempts: int = KAFKA_CONSUMER_HANDLER_ATTEMPTS,
+                 retry_backoff: float = KAFKA_CONSUMER_RETRY_BACKOFF):
         self.consumers: Dict[str, AIOKafkaConsumer] = {}
         self.handlers: Dict[str, Dict[str, Callable]] = {}
         self.running_tasks: Set[asyncio.Task] = set()
         self._started = False
+        self.batched = batched
+        self.workers = workers
+        self.dedup = dedup or event_deduplicator
+        self.handler_attempts = max(1, handler_attempts)
+        self.retry_backoff = retry_backoff
+        self._consumer: Optional[AIOKafkaConsumer] = None
+        self._stats = {'batches': 0, 'events': 0, 'duplicates': 0, 'failed_events': 0, 'commit_errors': 0,
+                       'batch_errors': 0, 'last_error': None}
     
     def register_handler(self, topic: str, event_type: str, handler: Callable):
         """Регистрация обработчика для конкретного типа события в топике"""
@@ -37,23 +89,19 @@ class SupportChatKafkaConsumer:
         if self._started:
             return
         
+        if self.batched:
+            await self._start_batched()
+            return
+        
         # Создаем consumer'ы для всех топиков
-        topics_to_consume = [
-            KafkaTopics.CHAT_EVENTS,
-            KafkaTopics.SUPPORT_QUEUE,
-            KafkaTopics.OPERATOR_EVENTS,
-            KafkaTopics.CHAT_ASSIGNMENTS,
-            KafkaTopics.ADMIN_ACTIONS
-        ]
-        
-        for topic in topics_to_consume:
+        for topic in CONSUMED_TOPICS:
             consumer = AIOKafkaConsumer(
                 topic,
                 bootstrap_servers=KAFKA_CONFIG['bootstrap_servers'],
                 group_id=f"{KAFKA_CONFIG['group_id']}_{topic}",
                 auto_offset_reset=KAFKA_CONFIG['auto_offset_reset'],
                 enable_auto_commit=KAFKA_CONFIG['enable_auto_commit'],
-                value_deserializer=lambda m: json.loads(m.decode('utf-8'))
+                value_deserializer=topic_decoder(topic)
             )
             
             await consumer.start()
@@ -82,29 +130,185 @@ class SupportChatKafkaConsumer:
         # Останавливаем consumer'ы
         for consumer in self.consumers.values():
             await consumer.stop()
+        if self._consumer:
+            await self._consumer.stop()
+            self._consumer = None
         
         self.consumers.clear()
         self.running_tasks.clear()
         self._started = False
         logger.info("Kafka Consumer остановлен")
     
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика обработки событий: пачки, пропущенные повторы, ошибки"""
+        batches = self._stats['batches']
+        return {
+            'batched': self.batched,
+            'batches': batches,
+            'events': self._stats['events'],
+            'duplicates': self._stats['duplicates'],
+            'failed_events': self._stats['failed_events'],
+            'commit_errors': self._stats['commit_errors'],
+            'batch_errors': self._stats['batch_errors'],
+            'last_error': self._stats['last_error'],
+            'avg_batch_size': self._stats['events'] / batches if batches else 0,
+            'dedup': self.dedup.get_stats(),
+        }
+    
+    async def _start_batched(self):
+        """Один consumer на все топики с ручной фиксацией offset'ов"""
+        consumer = AIOKafkaConsumer(
+            *CONSUMED_TOPICS,
+            bootstrap_servers=KAFKA_CONFIG['bootstrap_servers'],
+            group_id=KAFKA_CONFIG['group_id'],
+            auto_offset_reset=KAFKA_CONFIG['auto_offset_reset'],
+            enable_auto_commit=False
+        )
+        await consumer.start()
+        self._consumer = consumer
+        
+        task = asyncio.create_task(self._consume_batches(consumer))
+        self.running_tasks.add(task)
+        
+        self._started = True
+        logger.info("Kafka Consumer запущен для всех топиков (пакетный режим)")
+    
+    async def _consume_batches(self, consumer: AIOKafkaConsumer):
+        """
+        Чтение пачек getmany(), обработка и фиксация offset'ов. Ошибка чтения или
+        обработки пачки не останавливает чтение: после паузы необработанная
+        пачка читается повторно, уже обработанные события пропустит дедупликация.
+        """
+        while True:
+            batches = {}
+            try:
+                batches = await consumer.getmany(
+                    timeout_ms=KAFKA_CONSUMER_POLL_TIMEOUT_MS, max_records=KAFKA_CONSUMER_MAX_RECORDS
+                )
+                if not batches:
+                    continue
+                
+                await self.process_batch([message for messages in batches.values() for message in messages])
+                
+                await self._commit(consumer, {tp: messages[-1].offset + 1 for tp, messages in batches.items()})
+            
+            except asyncio.CancelledError:
+                logger.info("Обработка пачек событий Kafka отменена")
+                return
+            except Exception as e:
+                self._stats['batch_errors'] += 1
+                self._stats['last_error'] = str(e)
+                logger.error(f"Ошибка обработки пачки событий Kafka: {e}")
+                self._rewind(consumer, batches)
+                await asyncio.sleep(KAFKA_CONSUMER_ERROR_BACKOFF)
+    
+    def _rewind(self, consumer: AIOKafkaConsumer, batches: Dict):
+        """Возврат позиции чтения к началу необработанной пачки"""
+        for tp, messages in batches.items():
+            try:
+                consumer.seek(tp, messages[0].offset)
+            except Exception as e:
+                # Партиция могла уйти при ребалансировке - новый владелец прочитает ее с commit'а
+                logger.warning(f"Не удалось вернуться к offset {messages[0].offset} в {tp}: {e}")
+    
+    async def process_batch(self, messages: List):
+        """
+        Обработка пачки сообщений: по порядку внутри ключа, параллельно между ключами.
+        Возвращается, когда обработаны все сообщения пачки.
+        """
+        decoded = []
+        for message in messages:
+            try:
+                event_data = decode_event(message.value, TOPIC_SCHEMAS.get(message.topic))
+                if not isinstance(event_data, dict):
+                    raise ValueError("событие должно быть JSON-объектом")
+            except Exception as e:
+                self._stats['failed_events'] += 1
+                logger.error(f"Некорректное событие в {message.topic}:{message.partition}@{message.offset}: {e}")
+                continue
+            decoded.append((message, event_data))
+        
+        # Повторы пропускаются: уже обработанные ранее и копии внутри пачки
+        event_ids = [event_data['event_id'] for _, event_data in decoded if event_data.get('event_id')]
+        seen = await self.dedup.filter_seen(event_ids) if event_ids else set()
+        batch_ids: Set[str] = set()
+        sequences: Dict[Hashable, List] = {}
+        for message, event_data in decoded:
+            event_id = event_data.get('event_id')
+            if event_id:
+                if event_id in seen or event_id in batch_ids:
+                    self._stats['duplicates'] += 1
+                    continue
+                batch_ids.add(event_id)
+            sequences.setdefault(_ordering_key(message, event_data), []).append((message.topic, event_data))
+        
+        semaphore = asyncio.Semaphore(self.workers)
+        processed: List[str] = []
+        
+        async def run_sequence(sequence):
+            async with semaphore:
+                for topic, event_data in sequence:
+                    if await self._handle_event(topic, event_data) and event_data.get('event_id'):
+                        processed.append(event_data['event_id'])
+        
+        await asyncio.gather(*(run_sequence(sequence) for sequence in sequences.values()))
+        await self.dedup.mark_processed(processed)
+        self._stats['batches'] += 1
+        self._stats['events'] += len(messages)
+    
+    async def _handle_event(self, topic: str, event_data: Dict[str, Any]) -> bool:
+        """
+        Вызов обработчика события с повторами. False - обработчик не справился
+        за все попытки и событие пропущено; ошибка не прерывает пачку.
+        """
+        event_type = event_data.get('event_type')
+        handler = self.handlers.get(topic, {}).get(event_type)
+        if handler is None:
+            logger.warning(f"Нет обработчика для {topic}:{getattr(event_type, 'value', event_type)}")
+            return True
+        for attempt in range(1, self.handler_attempts + 1):
+            try:
+                await handler(event_data)
+                return True
+            except Exception as e:
+                if attempt == self.handler_attempts:
+                    self._stats['failed_events'] += 1
+                    logger.error(f"Событие {event_data.get('event_id')} из {topic} пропущено "
+                                 f"после {attempt} попыток: {e}")
+                    return False
+                logger.warning(f"Ошибка обработки сообщения из {topic} (попытка {attempt}): {e}")
+                await asyncio.sleep(self.retry_backoff * attempt)
+        return False
+    
+    async def _commit(self, consumer: AIOKafkaConsumer, offsets: Optional[Dict] = None):
+        """Фиксация offset'ов обработанных событий"""
+        try:
+            await consumer.commit(offsets)
+        except Exception as e:
+            # Например, ребалансировка: события повторно получит новый владелец
+            # партиций, обработанные будут пропущены дедупликацией
+            self._stats['commit_errors'] += 1
+            logger.error(f"Ошибка фиксации offset'ов Kafka: {e}")
+    
     async def _consume_messages(self, topic: str, consumer: AIOKafkaConsumer):
         """Обработка сообщений из топика"""
         try:
             async for message in consumer:
                 try:
                     event_data = message.value
-                    event_type = event_data.get('event_type')
+                    event_id = event_data.get('event_id')
+                    self._stats['events'] += 1
                     
-                    if topic in self.handlers and event_type in self.handlers[topic]:
-                        handler = self.handlers[topic][event_type]
-                        await handler(event_data)
-                    else:
-                        logger.warning(f"Нет обработчика для {topic}:{event_type}")
+                    if event_id and await self.dedup.filter_seen([event_id]):
+                        self._stats['duplicates'] += 1
+                    elif await self._handle_event(topic, event_data) and event_id:
+                        await self.dedup.mark_processed([event_id])
                 
                 except Exception as e:
                     logger.error(f"Ошибка обработки сообщения из {topic}: {e}")
-                    continue
+                
+                # Offset фиксируется после обработки события
+                await self._commit(consumer)
                     
         except asyncio.CancelledError:
             logger.info(f"Обработка сообщений для топика {topic} отменена")
@@ -115,10 +319,12 @@ class SupportChatKafkaConsumer:
 class SupportChatEventHandlers:
     """Обработчики событий чата поддержки"""
     
-    def __init__(self, websocket_manager, queue_manager, assignment_manager):
+    def __init__(self, websocket_manager, queue_manager, assignment_manager, chat_fanout=None):
         self.websocket_manager = websocket_manager
         self.queue_manager = queue_manager
         self.assignment_manager = assignment_manager
+        # Рассылка событий чата по всем узлам (без него - только локальные соединения)
+        self.chat_fanout = chat_fanout or websocket_manager
     
     # Обработчики событий чата
     
@@ -140,15 +346,17 @@ class SupportChatEventHandlers:
         chat_id = event_data['chat_id']
         sender_id = event_data['sender_id']
         message_text = event_data.get('message_text')
+        timestamp = event_data['timestamp']
         
         # Рассылаем сообщение всем участникам чата
-        await self.websocket_manager.broadcast_to_chat(chat_id, {
+        await self.chat_fanout.broadcast_to_chat(chat_id, {
             'type': 'message',
             'payload': {
                 'chat_id': chat_id,
+                'message_id': event_data.get('message_id'),
                 'sender_id': sender_id,
                 'message': message_text,
-                'timestamp': event_data['timestamp']
+                'timestamp': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
             }
         })
     
@@ -161,7 +369,7 @@ class SupportChatEventHandlers:
         logger.info(f"Оператор {operator_id} ({operator_type}) вошел в чат {chat_id}")
         
         # Уведомляем участников чата о входе оператора
-        await self.websocket_manager.broadcast_to_chat(chat_id, {
+        await self.chat_fanout.broadcast_to_chat(chat_id, {
             'type': 'operator_joined',
             'payload': {
                 'chat_id': chat_id,
@@ -179,7 +387,7 @@ class SupportChatEventHandlers:
         logger.info(f"Чат {chat_id} закрыт пользователем {closed_by}, причина: {reason}")
         
         # Уведомляем всех участников о закрытии чата
-        await self.websocket_manager.broadcast_to_chat(chat_id, {
+        await self.chat_fanout.broadcast_to_chat(chat_id, {
             'type': 'chat_closed',
             'payload': {
                 'chat_id': chat_id,
@@ -260,7 +468,9 @@ class SupportChatEventHandlers:
         logger.info(f"Чат {chat_id} назначен оператору {operator_id}")
         
         # Уведомляем оператора и клиента о назначении
-        await self.websocket_manager.notify_chat_assigned(chat_id, operator_id, client_id)
+        await self.websocket_manager.notify_chat_assigned(
+            chat_id, operator_id, client_id, chat_fanout=self.chat_fanout
+        )
     
     async def handle_chat_transferred(self, event_data: Dict[str, Any]):
         """Обработка перевода чата"""
@@ -273,7 +483,7 @@ class SupportChatEventHandlers:
         
         # Уведомляем всех участников о переводе
         await self.websocket_manager.notify_chat_transferred(
-            chat_id, new_operator_id, previous_operator_id, reason
+            chat_id, new_operator_id, previous_operator_id, reason, chat_fanout=self.chat_fanout
         )
     
     async def handle_lawyer_assigned(self, event_data: Dict[str, Any]):
@@ -332,6 +542,11 @@ class MockSupportChatKafkaConsumer:
         """Mock остановка consumer"""
         self._started = False
         logger.info("Mock Kafka Consumer остановлен")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Mock статистика обработки событий"""
+        return {'batched': False, 'batches': 0, 'events': 0, 'duplicates': 0, 'failed_events': 0,
+                'commit_errors': 0, 'batch_errors': 0, 'last_error': None, 'avg_batch_size': 0, 'dedup': {}}
 
 
 # Выбор реализации в зависимости от конфигурации
@@ -0,0 +1,130 @@
+"""
+Дедупликация событий Kafka по event_id: окно последних обработанных событий,
+чтобы повторная доставка (ребалансировка, повтор отправки из outbox) не
+вызывала обработчики второй раз
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import redis.asyncio as aioredis
+
+from config.chat_config import CHAT_STATE_KEY_PREFIX, CHAT_STATE_REDIS_URL
+from config.kafka_config import KAFKA_DEDUP_TTL, KAFKA_DEDUP_WINDOW_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator:
+    """
+    Окно обработанных event_id в памяти процесса: LRU на max_size событий,
+    каждое помнится не дольше ttl секунд.
+
+    filter_seen() перед обработкой пачки возвращает уже обработанные события,
+    mark_processed() после обработки добавляет успешно обработанные в окно.
+    """
+
+    def __init__(self, max_size: int = KAFKA_DEDUP_WINDOW_SIZE, ttl: int = KAFKA_DEDUP_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._seen: "OrderedDict[str, float]" = OrderedDict()  # event_id -> момент истечения (monotonic)
+
+    async def filter_seen(self, event_ids: Iterable[str]) -> Set[str]:
+        """Уже обработанные события из переданных"""
+        return self._filter_local(event_ids)
+
+    async def mark_processed(self, event_ids: Iterable[str]):
+        """Добавление обработанных событий в окно"""
+        self._remember(event_ids)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Размер окна дедупликации"""
+        return {'window_size': len(self._seen), 'max_size': self._max_size, 'ttl': self._ttl, 'shared': False}
+
+    def _filter_local(self, event_ids: Iterable[str]) -> Set[str]:
+        now = time.monotonic()
+        seen = set()
+        for event_id in event_ids:
+            expires_at = self._seen.get(event_id)
+            if expires_at is None:
+                continue
+            if expires_at > now:
+                seen.add(event_id)
+            else:
+                del self._seen[event_id]
+        return seen
+
+    def _remember(self, event_ids: Iterable[str]):
+        now = time.monotonic()
+        expires_at = now + self._ttl
+        for event_id in event_ids:
+            self._seen[event_id] = expires_at
+            self._seen.move_to_end(event_id)
+        # В начале - самые старые записи: сначала истекшие, затем сверх лимита
+        while self._seen:
+            oldest_id, oldest_expires_at = next(iter(self._seen.items()))
+            if oldest_expires_at > now and len(self._seen) <= self._max_size:
+                break
+            del self._seen[oldest_id]
+
+
+class RedisEventDeduplicator(EventDeduplicator):
+    """
+    Окно обработанных event_id, общее для всех экземпляров приложения: после
+    ребалансировки партиция может перейти к узлу, который сам этих событий
+    не видел. Локальное окно остается первым уровнем, Redis опрашивается
+    одним MGET на пачку только для событий, которых нет локально. Ошибки
+    Redis не останавливают обработку - дедупликация остается локальной.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None,
+                 key_prefix: str = CHAT_STATE_KEY_PREFIX + 'kafka_event:',
+                 max_size: int = KAFKA_DEDUP_WINDOW_SIZE, ttl: int = KAFKA_DEDUP_TTL):
+        super().__init__(max_size, ttl)
+        self._redis = redis_client or aioredis.from_url(CHAT_STATE_REDIS_URL, decode_responses=True)
+        self._prefix = key_prefix
+
+    async def filter_seen(self, event_ids: Iterable[str]) -> Set[str]:
+        """Уже обработанные события: локальное окно, затем Redis"""
+        event_ids = list(event_ids)
+        seen = self._filter_local(event_ids)
+        unknown: List[str] = [event_id for event_id in event_ids if event_id not in seen]
+        if not unknown:
+            return seen
+        try:
+            values = await self._redis.mget([self._prefix + event_id for event_id in unknown])
+        except Exception as e:
+            logger.error(f"Ошибка чтения окна дедупликации из Redis: {e}")
+            return seen
+        remote = {event_id for event_id, value in zip(unknown, values) if value is not None}
+        self._remember(remote)
+        return seen | remote
+
+    async def mark_processed(self, event_ids: Iterable[str]):
+        """Добавление обработанных событий в локальное окно и в Redis (одним pipeline)"""
+        event_ids = list(event_ids)
+        self._remember(event_ids)
+        if not event_ids:
+            return
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for event_id in event_ids:
+                    pipe.set(self._prefix + event_id, 1, ex=self._ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Ошибка записи окна дедупликации в Redis: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Размер локального окна дедупликации"""
+        return {**super().get_stats(), 'shared': True}
+
+
+# Выбор хранилища в зависимости от конфигурации: при общем состоянии в Redis
+# окно дедупликации тоже общее для всех узлов
+from config.chat_config import CHAT_STATE_BACKEND, ChatStateBackend
+
+if CHAT_STATE_BACKEND == ChatStateBackend.REDIS:
+    event_deduplicator = RedisEventDeduplicator()
+else:
+    event_deduplicator = EventDeduplicator()
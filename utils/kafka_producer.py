@@ -1,31 +1,106 @@
 """
 Kafka Producer для отправки событий чата поддержки
 """
-import json
+import time
 import uuid
 import asyncio
 from datetime import datetime, UTC
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Set, List, NamedTuple
 from aiokafka import AIOKafkaProducer
+from aiokafka import codec as kafka_codec
 import logging
 
 from config.kafka_config import (
     KAFKA_CONFIG, KafkaTopics, 
-    BaseKafkaEvent, ChatEvent, SupportQueueEvent, 
-    OperatorEvent, AssignmentEvent, AdminActionEvent,
+    KAFKA_PRODUCER_PIPELINED, KAFKA_PRODUCER_LINGER_MS,
+    KAFKA_PRODUCER_BATCH_SIZE, KAFKA_PRODUCER_COMPRESSION,
     ChatEventType, SupportQueueEventType, OperatorEventType,
     AssignmentEventType, AdminActionType
 )
+from utils.kafka_codec import (
+    encode_event,
+    CHAT_EVENT, SUPPORT_QUEUE_EVENT, OPERATOR_EVENT, ASSIGNMENT_EVENT, ADMIN_ACTION_EVENT
+)
 
 logger = logging.getLogger(__name__)
 
+# Проверка наличия библиотек сжатия (lz4 и zstd - необязательные зависимости aiokafka)
+_COMPRESSION_AVAILABLE = {
+    'gzip': kafka_codec.has_gzip,
+    'snappy': kafka_codec.has_snappy,
+    'lz4': kafka_codec.has_lz4,
+    'zstd': kafka_codec.has_zstd,
+}
+
+
+def _compression_type(compression: str) -> Optional[str]:
+    """Тип сжатия для AIOKafkaProducer; без нужной библиотеки - без сжатия"""
+    if not compression or compression == 'none':
+        return None
+    available = _COMPRESSION_AVAILABLE.get(compression)
+    if available is None or not available():
+        logger.warning(f"Сжатие {compression} недоступно, события отправляются без сжатия")
+        return None
+    return compression
+
+
+class KafkaEventRecord(NamedTuple):
+    """Событие с топиком и ключом - для отправки сразу или через outbox"""
+    topic: str
+    key: Optional[str]
+    event: Dict[str, Any]
+
+
+def chat_assigned_event(chat_id: int, operator_id: int, operator_type: str, client_id: int,
+                        assignment_reason: Optional[str] = None) -> KafkaEventRecord:
+    """Событие назначения чата оператору"""
+    event = ASSIGNMENT_EVENT.build(
+        event_id=str(uuid.uuid4()),
+        event_type=AssignmentEventType.CHAT_ASSIGNED,
+        timestamp=datetime.now(UTC),
+        chat_id=chat_id,
+        user_id=client_id,
+        operator_id=operator_id,
+        operator_type=operator_type,
+        assignment_reason=assignment_reason
+    )
+    return KafkaEventRecord(KafkaTopics.CHAT_ASSIGNMENTS, f"chat_{chat_id}", event)
+
+
+def operator_accept_chat_event(operator_id: int, operator_type: str, chat_id: int,
+                               client_id: int) -> KafkaEventRecord:
+    """Событие принятия чата оператором"""
+    event = OPERATOR_EVENT.build(
+        event_id=str(uuid.uuid4()),
+        event_type=OperatorEventType.OPERATOR_ACCEPT_CHAT,
+        timestamp=datetime.now(UTC),
+        operator_id=operator_id,
+        operator_type=operator_type,
+        chat_id=chat_id,
+        metadata={'client_id': client_id}
+    )
+    return KafkaEventRecord(KafkaTopics.OPERATOR_EVENTS, f"operator_{operator_id}", event)
+
 
 class SupportChatKafkaProducer:
-    """Kafka Producer для чата поддержки"""
-    
-    def __init__(self):
+    """
+    Kafka Producer для чата поддержки.
+    
+    В конвейерном режиме (pipelined) событие ставится в буфер producer'а и
+    метод возвращается сразу, не дожидаясь брокера: aiokafka собирает события
+    в батчи (linger_ms, batch_size) и сжимает их. Доставка отслеживается в фоне -
+    ошибки логируются и передаются обработчику set_delivery_error_handler(),
+    задержка и счетчики доступны в get_stats(). Если событие должно быть
+    подтверждено брокером до продолжения, метод отправки вызывается с wait=True.
+    """
+    
+    def __init__(self, pipelined: bool = KAFKA_PRODUCER_PIPELINED):
         self.producer: Optional[AIOKafkaProducer] = None
         self._started = False
+        self.pipelined = pipelined
+        self._in_flight: Set[asyncio.Future] = set()
+        self._delivery_error_handler: Optional[Callable[[str, Dict[str, Any], BaseException], Any]] = None
+        self._stats = {'sent': 0, 'delivered': 0, 'failed': 0, 'latency_total': 0.0, 'latency_max': 0.0}
     
     async def start(self):
         """Запуск producer"""
@@ -33,41 +108,130 @@ class SupportChatKafkaProducer:
             self.producer = AIOKafkaProducer(
                 bootstrap_servers=KAFKA_CONFIG['bootstrap_servers'],
                 client_id=KAFKA_CONFIG['client_id'],
-                value_serializer=lambda v: json.dumps(v, default=str).encode('utf-8')
+                value_serializer=encode_event,
+                linger_ms=KAFKA_PRODUCER_LINGER_MS,
+                max_batch_size=KAFKA_PRODUCER_BATCH_SIZE,
+                compression_type=_compression_type(KAFKA_PRODUCER_COMPRESSION)
             )
             await self.producer.start()
             self._started = True
             logger.info("Kafka Producer запущен")
     
     async def stop(self):
-        """Остановка producer"""
+        """Остановка producer (накопленные события отправляются до остановки)"""
         if self.producer and self._started:
+            await self.flush()
             await self.producer.stop()
             self._started = False
             logger.info("Kafka Producer остановлен")
     
-    async def _send_event(self, topic: str, event: BaseKafkaEvent, key: Optional[str] = None):
-        """Отправка события в Kafka"""
+    async def flush(self):
+        """Отправка накопленных событий и ожидание подтверждения всех отправленных"""
+        if self.producer and self._started:
+            await self.producer.flush()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+    
+    def set_delivery_error_handler(self, handler: Optional[Callable[[str, Dict[str, Any], BaseException], Any]]):
+        """Обработчик неудачной фоновой доставки: handler(topic, event_dict, error)"""
+        self._delivery_error_handler = handler
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика отправки событий"""
+        delivered = self._stats['delivered']
+        return {
+            'pipelined': self.pipelined,
+            'sent': self._stats['sent'],
+            'delivered': delivered,
+            'failed': self._stats['failed'],
+            'in_flight': len(self._in_flight),
+            'avg_delivery_ms': self._stats['latency_total'] * 1000 / delivered if delivered else 0,
+            'max_delivery_ms': self._stats['latency_max'] * 1000,
+        }
+    
+    async def _send_event(self, topic: str, event: Dict[str, Any], key: Optional[str] = None, wait: bool = False):
+        """Отправка события в Kafka (с ожиданием брокера - только в wait=True или без конвейера)"""
         if not self._started:
             await self.start()
         
         try:
-            event_dict = event.model_dump()
-            await self.producer.send_and_wait(
-                topic=topic,
-                value=event_dict,
-                key=key.encode('utf-8') if key else None
-            )
-            logger.debug(f"Событие отправлено в топик {topic}: {event.event_type}")
+            if wait or not self.pipelined:
+                await self.producer.send_and_wait(
+                    topic=topic,
+                    value=event,
+                    key=key.encode('utf-8') if key else None
+                )
+                self._stats['sent'] += 1
+                self._stats['delivered'] += 1
+            else:
+                # send() ждет только места в буфере, подтверждение брокера - в фоне
+                delivery = await self.producer.send(
+                    topic=topic,
+                    value=event,
+                    key=key.encode('utf-8') if key else None
+                )
+                self._stats['sent'] += 1
+                self._track_delivery(delivery, topic, event)
+            logger.debug(f"Событие отправлено в топик {topic}: {event['event_type']}")
         except Exception as e:
             logger.error(f"Ошибка отправки события в Kafka: {e}")
             raise
     
+    async def send_events(self, records: List[KafkaEventRecord]):
+        """
+        Отправка пачки событий с ожиданием подтверждения брокера для всех.
+        
+        События ставятся в буфер по порядку списка, поэтому события одного
+        ключа попадают в партицию в этом порядке. Если хотя бы одно событие
+        не доставлено, ошибка поднимается - пачку нужно отправить повторно.
+        """
+        if not self._started:
+            await self.start()
+        
+        deliveries = []
+        for record in records:
+            deliveries.append(await self.producer.send(
+                topic=record.topic,
+                value=record.event,
+                key=record.key.encode('utf-8') if record.key else None
+            ))
+        self._stats['sent'] += len(deliveries)
+        results = await asyncio.gather(*deliveries, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        self._stats['delivered'] += len(results) - len(errors)
+        self._stats['failed'] += len(errors)
+        if errors:
+            logger.error(f"Не доставлено {len(errors)} из {len(results)} событий пачки: {errors[0]}")
+            raise errors[0]
+    
+    def _track_delivery(self, delivery: asyncio.Future, topic: str, event_dict: Dict[str, Any]):
+        started = time.monotonic()
+        self._in_flight.add(delivery)
+        
+        def on_done(future: asyncio.Future):
+            self._in_flight.discard(future)
+            error = future.exception() if not future.cancelled() else asyncio.CancelledError()
+            if error is None:
+                latency = time.monotonic() - started
+                self._stats['delivered'] += 1
+                self._stats['latency_total'] += latency
+                self._stats['latency_max'] = max(self._stats['latency_max'], latency)
+                return
+            self._stats['failed'] += 1
+            logger.error(f"Событие {event_dict.get('event_type')} не доставлено в топик {topic}: {error}")
+            if self._delivery_error_handler:
+                try:
+                    self._delivery_error_handler(topic, event_dict, error)
+                except Exception as e:
+                    logger.error(f"Ошибка в обработчике недоставленного события: {e}")
+        
+        delivery.add_done_callback(on_done)
+    
     # Методы для отправки событий чата
     
-    async def send_chat_created(self, chat_id: int, user_id: int, metadata: Optional[Dict] = None):
+    async def send_chat_created(self, chat_id: int, user_id: int, metadata: Optional[Dict] = None, wait: bool = False):
         """Отправка события создания чата"""
-        event = ChatEvent(
+        event = CHAT_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=ChatEventType.CHAT_CREATED,
             timestamp=datetime.now(UTC),
@@ -75,12 +239,12 @@ class SupportChatKafkaProducer:
             user_id=user_id,
             metadata=metadata
         )
-        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}")
+        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}", wait=wait)
     
     async def send_message_sent(self, chat_id: int, sender_id: int, sender_type: str, 
-                               message_id: int, message_text: Optional[str] = None):
+                               message_id: int, message_text: Optional[str] = None, wait: bool = False):
         """Отправка события отправки сообщения"""
-        event = ChatEvent(
+        event = CHAT_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=ChatEventType.MESSAGE_SENT,
             timestamp=datetime.now(UTC),
@@ -90,11 +254,11 @@ class SupportChatKafkaProducer:
             message_id=message_id,
             message_text=message_text
         )
-        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}")
+        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}", wait=wait)
     
-    async def send_operator_joined(self, chat_id: int, operator_id: int, operator_type: str):
+    async def send_operator_joined(self, chat_id: int, operator_id: int, operator_type: str, wait: bool = False):
         """Отправка события входа оператора в чат"""
-        event = ChatEvent(
+        event = CHAT_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=ChatEventType.OPERATOR_JOINED,
             timestamp=datetime.now(UTC),
@@ -102,11 +266,12 @@ class SupportChatKafkaProducer:
             user_id=operator_id,
             metadata={'operator_type': operator_type}
         )
-        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}")
+        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}", wait=wait)
     
-    async def send_chat_closed(self, chat_id: int, closed_by_user_id: int, reason: Optional[str] = None):
+    async def send_chat_closed(self, chat_id: int, closed_by_user_id: int, reason: Optional[str] = None,
+                               wait: bool = False):
         """Отправка события закрытия чата"""
-        event = ChatEvent(
+        event = CHAT_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=ChatEventType.CHAT_CLOSED,
             timestamp=datetime.now(UTC),
@@ -114,13 +279,14 @@ class SupportChatKafkaProducer:
             user_id=closed_by_user_id,
             metadata={'reason': reason} if reason else None
         )
-        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}")
+        await self._send_event(KafkaTopics.CHAT_EVENTS, event, key=f"chat_{chat_id}", wait=wait)
     
     # Методы для отправки событий очереди поддержки
     
-    async def send_client_waiting(self, client_id: int, priority: int = 0, metadata: Optional[Dict] = None):
+    async def send_client_waiting(self, client_id: int, priority: int = 0, metadata: Optional[Dict] = None,
+                                  wait: bool = False):
         """Отправка события ожидания клиента в очереди"""
-        event = SupportQueueEvent(
+        event = SUPPORT_QUEUE_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=SupportQueueEventType.CLIENT_WAITING,
             timestamp=datetime.now(UTC),
@@ -129,11 +295,11 @@ class SupportChatKafkaProducer:
             priority=priority,
             metadata=metadata
         )
-        await self._send_event(KafkaTopics.SUPPORT_QUEUE, event, key=f"client_{client_id}")
+        await self._send_event(KafkaTopics.SUPPORT_QUEUE, event, key=f"client_{client_id}", wait=wait)
     
-    async def send_client_request_removed(self, client_id: int, operator_id: int, chat_id: int):
+    async def send_client_request_removed(self, client_id: int, operator_id: int, chat_id: int, wait: bool = False):
         """Отправка события удаления запроса клиента из очереди (принят оператором)"""
-        event = SupportQueueEvent(
+        event = SUPPORT_QUEUE_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=SupportQueueEventType.CLIENT_REQUEST_REMOVED,
             timestamp=datetime.now(UTC),
@@ -142,13 +308,14 @@ class SupportChatKafkaProducer:
             chat_id=chat_id,
             metadata={'operator_id': operator_id}
         )
-        await self._send_event(KafkaTopics.SUPPORT_QUEUE, event, key=f"client_{client_id}")
+        await self._send_event(KafkaTopics.SUPPORT_QUEUE, event, key=f"client_{client_id}", wait=wait)
     
     # Методы для отправки событий операторов
     
-    async def send_operator_online(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5):
+    async def send_operator_online(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5,
+                                   wait: bool = False):
         """Отправка события выхода оператора в онлайн"""
-        event = OperatorEvent(
+        event = OPERATOR_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=OperatorEventType.OPERATOR_ONLINE,
             timestamp=datetime.now(UTC),
@@ -157,53 +324,37 @@ class SupportChatKafkaProducer:
             max_concurrent_chats=max_concurrent_chats,
             current_chat_count=0
         )
-        await self._send_event(KafkaTopics.OPERATOR_EVENTS, event, key=f"operator_{operator_id}")
+        await self._send_event(KafkaTopics.OPERATOR_EVENTS, event, key=f"operator_{operator_id}", wait=wait)
     
-    async def send_operator_offline(self, operator_id: int, operator_type: str):
+    async def send_operator_offline(self, operator_id: int, operator_type: str, wait: bool = False):
         """Отправка события выхода оператора из онлайн"""
-        event = OperatorEvent(
+        event = OPERATOR_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=OperatorEventType.OPERATOR_OFFLINE,
             timestamp=datetime.now(UTC),
             operator_id=operator_id,
             operator_type=operator_type
         )
-        await self._send_event(KafkaTopics.OPERATOR_EVENTS, event, key=f"operator_{operator_id}")
+        await self._send_event(KafkaTopics.OPERATOR_EVENTS, event, key=f"operator_{operator_id}", wait=wait)
     
-    async def send_operator_accept_chat(self, operator_id: int, operator_type: str, chat_id: int, client_id: int):
+    async def send_operator_accept_chat(self, operator_id: int, operator_type: str, chat_id: int, client_id: int,
+                                        wait: bool = False):
         """Отправка события принятия чата оператором"""
-        event = OperatorEvent(
-            event_id=str(uuid.uuid4()),
-            event_type=OperatorEventType.OPERATOR_ACCEPT_CHAT,
-            timestamp=datetime.now(UTC),
-            operator_id=operator_id,
-            operator_type=operator_type,
-            chat_id=chat_id,
-            metadata={'client_id': client_id}
-        )
-        await self._send_event(KafkaTopics.OPERATOR_EVENTS, event, key=f"operator_{operator_id}")
+        record = operator_accept_chat_event(operator_id, operator_type, chat_id, client_id)
+        await self._send_event(record.topic, record.event, key=record.key, wait=wait)
     
     # Методы для отправки событий назначений
     
     async def send_chat_assigned(self, chat_id: int, operator_id: int, operator_type: str, 
-                                client_id: int, assignment_reason: Optional[str] = None):
+                                client_id: int, assignment_reason: Optional[str] = None, wait: bool = False):
         """Отправка события назначения чата оператору"""
-        event = AssignmentEvent(
-            event_id=str(uuid.uuid4()),
-            event_type=AssignmentEventType.CHAT_ASSIGNED,
-            timestamp=datetime.now(UTC),
-            chat_id=chat_id,
-            user_id=client_id,
-            operator_id=operator_id,
-            operator_type=operator_type,
-            assignment_reason=assignment_reason
-        )
-        await self._send_event(KafkaTopics.CHAT_ASSIGNMENTS, event, key=f"chat_{chat_id}")
+        record = chat_assigned_event(chat_id, operator_id, operator_type, client_id, assignment_reason)
+        await self._send_event(record.topic, record.event, key=record.key, wait=wait)
     
     async def send_chat_transferred(self, chat_id: int, new_operator_id: int, new_operator_type: str,
-                                   previous_operator_id: int, client_id: int, reason: Optional[str] = None):
+                                   previous_operator_id: int, client_id: int, reason: Optional[str] = None, wait: bool = False):
         """Отправка события перевода чата другому оператору"""
-        event = AssignmentEvent(
+        event = ASSIGNMENT_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=AssignmentEventType.CHAT_TRANSFERRED,
             timestamp=datetime.now(UTC),
@@ -214,11 +365,11 @@ class SupportChatKafkaProducer:
             previous_operator_id=previous_operator_id,
             assignment_reason=reason
         )
-        await self._send_event(KafkaTopics.CHAT_ASSIGNMENTS, event, key=f"chat_{chat_id}")
+        await self._send_event(KafkaTopics.CHAT_ASSIGNMENTS, event, key=f"chat_{chat_id}", wait=wait)
     
-    async def send_lawyer_assigned(self, client_id: int, lawyer_id: int, chat_id: int):
+    async def send_lawyer_assigned(self, client_id: int, lawyer_id: int, chat_id: int, wait: bool = False):
         """Отправка события назначения персонального юриста"""
-        event = AssignmentEvent(
+        event = ASSIGNMENT_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=AssignmentEventType.LAWYER_ASSIGNED,
             timestamp=datetime.now(UTC),
@@ -228,14 +379,14 @@ class SupportChatKafkaProducer:
             operator_type='lawyer',
             assignment_reason='personal_lawyer_assignment'
         )
-        await self._send_event(KafkaTopics.CHAT_ASSIGNMENTS, event, key=f"client_{client_id}")
+        await self._send_event(KafkaTopics.CHAT_ASSIGNMENTS, event, key=f"client_{client_id}", wait=wait)
     
     # Методы для отправки административных действий
     
     async def send_force_transfer(self, admin_id: int, chat_id: int, target_operator_id: int, 
-                                 source_operator_id: int, reason: str):
+                                 source_operator_id: int, reason: str, wait: bool = False):
         """Отправка события принудительного перевода чата"""
-        event = AdminActionEvent(
+        event = ADMIN_ACTION_EVENT.build(
             event_id=str(uuid.uuid4()),
             event_type=AdminActionType.FORCE_TRANSFER,
             timestamp=datetime.now(UTC),
@@ -246,7 +397,7 @@ class SupportChatKafkaProducer:
             reason=reason,
             force=True
         )
-        await self._send_event(KafkaTopics.ADMIN_ACTIONS, event, key=f"chat_{chat_id}")
+        await self._send_event(KafkaTopics.ADMIN_ACTIONS, event, key=f"chat_{chat_id}", wait=wait)
 
 
 # Mock класс для работы без Kafka
@@ -266,52 +417,71 @@ class MockSupportChatKafkaProducer:
         self._started = False
         logger.info("Mock Kafka Producer остановлен")
     
-    async def _send_event(self, topic: str, event: BaseKafkaEvent, key: Optional[str] = None):
+    async def _send_event(self, topic: str, event: Dict[str, Any], key: Optional[str] = None, wait: bool = False):
         """Mock отправка события"""
-        logger.debug(f"Mock: Событие {event.event_type} для топика {topic}")
+        logger.debug(f"Mock: Событие {event['event_type']} для топика {topic}")
+    
+    async def send_events(self, records: List[KafkaEventRecord]):
+        """Mock отправка пачки событий"""
+        logger.debug(f"Mock: Пачка из {len(records)} событий")
+    
+    async def flush(self):
+        """Mock ожидание доставки"""
+    
+    def set_delivery_error_handler(self, handler):
+        """Mock обработчик недоставленных событий"""
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Mock статистика отправки"""
+        return {'pipelined': False, 'sent': 0, 'delivered': 0, 'failed': 0, 'in_flight': 0,
+                'avg_delivery_ms': 0, 'max_delivery_ms': 0}
     
     # Mock методы для всех событий чата
-    async def send_chat_created(self, chat_id: int, user_id: int, metadata: Optional[Dict] = None):
+    async def send_chat_created(self, chat_id: int, user_id: int, metadata: Optional[Dict] = None, wait: bool = False):
         logger.debug(f"Mock: Чат {chat_id} создан для пользователя {user_id}")
     
     async def send_message_sent(self, chat_id: int, sender_id: int, sender_type: str, 
-                               message_id: int, message_text: Optional[str] = None):
+                               message_id: int, message_text: Optional[str] = None, wait: bool = False):
         logger.debug(f"Mock: Сообщение {message_id} отправлено в чат {chat_id}")
     
-    async def send_operator_joined(self, chat_id: int, operator_id: int, operator_type: str):
+    async def send_operator_joined(self, chat_id: int, operator_id: int, operator_type: str, wait: bool = False):
         logger.debug(f"Mock: Оператор {operator_id} присоединился к чату {chat_id}")
     
-    async def send_chat_closed(self, chat_id: int, closed_by_user_id: int, reason: Optional[str] = None):
+    async def send_chat_closed(self, chat_id: int, closed_by_user_id: int, reason: Optional[str] = None,
+                               wait: bool = False):
         logger.debug(f"Mock: Чат {chat_id} закрыт пользователем {closed_by_user_id}")
     
-    async def send_client_waiting(self, client_id: int, priority: int = 0, metadata: Optional[Dict] = None):
+    async def send_client_waiting(self, client_id: int, priority: int = 0, metadata: Optional[Dict] = None,
+                                  wait: bool = False):
         logger.debug(f"Mock: Клиент {client_id} ожидает в очереди")
     
-    async def send_client_request_removed(self, client_id: int, operator_id: int, chat_id: int):
+    async def send_client_request_removed(self, client_id: int, operator_id: int, chat_id: int, wait: bool = False):
         logger.debug(f"Mock: Запрос клиента {client_id} удален из очереди")
     
-    async def send_operator_online(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5):
+    async def send_operator_online(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5,
+                                   wait: bool = False):
         logger.debug(f"Mock: Оператор {operator_id} онлайн")
     
-    async def send_operator_offline(self, operator_id: int, operator_type: str):
+    async def send_operator_offline(self, operator_id: int, operator_type: str, wait: bool = False):
         logger.debug(f"Mock: Оператор {operator_id} оффлайн")
     
-    async def send_operator_accept_chat(self, operator_id: int, operator_type: str, chat_id: int, client_id: int):
+    async def send_operator_accept_chat(self, operator_id: int, operator_type: str, chat_id: int, client_id: int,
+                                        wait: bool = False):
         logger.debug(f"Mock: Оператор {operator_id} принял чат {chat_id}")
     
     async def send_chat_assigned(self, chat_id: int, operator_id: int, operator_type: str, 
-                                client_id: int, assignment_reason: Optional[str] = None):
+                                client_id: int, assignment_reason: Optional[str] = None, wait: bool = False):
         logger.debug(f"Mock: Чат {chat_id} назначен оператору {operator_id}")
     
     async def send_chat_transferred(self, chat_id: int, new_operator_id: int, new_operator_type: str,
-                                   previous_operator_id: int, client_id: int, reason: Optional[str] = None):
+                                   previous_operator_id: int, client_id: int, reason: Optional[str] = None, wait: bool = False):
         logger.debug(f"Mock: Чат {chat_id} переведен на оператора {new_operator_id}")
     
-    async def send_lawyer_assigned(self, client_id: int, lawyer_id: int, chat_id: int):
+    async def send_lawyer_assigned(self, client_id: int, lawyer_id: int, chat_id: int, wait: bool = False):
         logger.debug(f"Mock: Юрист {lawyer_id} назначен клиенту {client_id}")
     
     async def send_force_transfer(self, admin_id: int, chat_id: int, target_operator_id: int, 
-                                 source_operator_id: int, reason: str):
+                                 source_operator_id: int, reason: str, wait: bool = False):
         logger.debug(f"Mock: Принудительный перевод чата {chat_id} админом {admin_id}")
 
 
@@ -0,0 +1,122 @@
+"""
+Групповая запись сообщений чатов: сообщения всех чатов копятся несколько
+миллисекунд и сохраняются одним многострочным INSERT ... RETURNING
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config.chat_config import CHAT_MESSAGE_BATCH_DELAY, CHAT_MESSAGE_BATCH_SIZE
+from database.logic.chats.chat import chat_db
+from database.models.support import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessageWriter:
+    """
+    Писатель сообщений чатов с групповым commit.
+
+    add_message() ставит сообщение в общий буфер и ждет, пока батч будет
+    записан: первый вызов запускает таймер на max_delay, батч пишется по
+    таймеру или сразу при накоплении max_batch сообщений. Весь батч - один
+    INSERT ... RETURNING и один commit, каждый вызывающий получает свое
+    сохраненное сообщение с id.
+
+    Пока батч пишется, следующий накапливается и уходит сразу после него,
+    поэтому под нагрузкой размер батча растет сам по себе, а max_delay
+    определяет задержку только для одиночных сообщений.
+
+    Батчи пишутся строго по очереди, поэтому id, присвоенные БД, идут
+    в порядке вызовов add_message, в том числе между батчами. created_at
+    фиксируется при постановке в буфер, а не при записи.
+    """
+
+    def __init__(self, db=None, max_batch: int = CHAT_MESSAGE_BATCH_SIZE,
+                 max_delay: float = CHAT_MESSAGE_BATCH_DELAY):
+        self.db = db or chat_db
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._write_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {'messages': 0, 'batches': 0, 'failed_batches': 0, 'write_time': 0.0}
+
+    async def add_message(self, chat_id: int, sender_id: Optional[int], sender_type: str,
+                          text: Optional[str]) -> ChatMessage:
+        """Сохранение сообщения в составе ближайшего батча"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        row = {
+            'chat_id': chat_id,
+            'sender_id': sender_id,
+            'sender_type': sender_type,
+            'message': text,
+            'created_at': datetime.utcnow(),
+        }
+        self._pending.append((row, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_delay, self._flush_pending)
+        return await future
+
+    async def flush(self):
+        """Запись накопленных сообщений и ожидание всех начатых батчей (при остановке)"""
+        self._flush_pending()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика групповой записи"""
+        batches = self._stats['batches']
+        return {
+            'messages': self._stats['messages'],
+            'batches': batches,
+            'failed_batches': self._stats['failed_batches'],
+            'pending': len(self._pending),
+            'avg_batch_size': self._stats['messages'] / batches if batches else 0,
+            'avg_write_ms': self._stats['write_time'] * 1000 / batches if batches else 0,
+        }
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        # asyncio.Lock отдает блокировку ожидающим в порядке очереди - батчи
+        # записываются в том порядке, в котором были сформированы
+        async with self._write_lock:
+            started = time.perf_counter()
+            try:
+                messages = await self.db.add_messages_bulk([row for row, _ in batch])
+            except Exception as e:
+                self._stats['failed_batches'] += 1
+                logger.error(f"Ошибка записи батча из {len(batch)} сообщений: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            self._stats['batches'] += 1
+            self._stats['messages'] += len(batch)
+            self._stats['write_time'] += time.perf_counter() - started
+            for (_, future), message in zip(batch, messages):
+                if not future.done():
+                    future.set_result(message)
+        # Пока батч писался, следующие сообщения уже прождали в буфере - пишем их
+        # сразу, не дожидаясь таймера
+        if self._pending and not self._write_lock.locked():
+            self._flush_pending()
+
+
+# Глобальный экземпляр писателя сообщений
+chat_message_writer = ChatMessageWriter()
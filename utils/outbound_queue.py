@@ -0,0 +1,94 @@
+"""
+Исходящие очереди WebSocket-соединений: ограниченный буфер готовых кадров
+на соединение, который разбирает отдельная задача-писатель
+"""
+import time
+from collections import deque
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from fastapi import WebSocket
+
+from config.chat_config import WEBSOCKET_OUTBOUND_QUEUE_SIZE, WEBSOCKET_SLOW_CONSUMER_TIMEOUT
+
+
+class Delivery:
+    """Результат постановки кадра в исходящую очередь"""
+
+    QUEUED = "queued"        # кадр поставлен в очередь
+    COALESCED = "coalesced"  # заменил еще не отправленный кадр с тем же ключом
+    DROPPED = "dropped"      # необязательный кадр отброшен из-за переполнения
+    OVERFLOW = "overflow"    # соединение не успевает читать - его нужно закрыть
+
+
+def coalesce_key(message: Dict[str, Any]) -> Optional[Hashable]:
+    """
+    Ключ объединения необязательного сообщения.
+
+    Для индикатора печати и позиции в очереди важно только последнее значение,
+    поэтому такие сообщения объединяются и могут быть отброшены. None -
+    сообщение обязательное (сообщения чата, назначения и т.п.).
+    """
+    message_type = message.get('type')
+    payload = message.get('payload') or {}
+    if message_type == 'typing':
+        return message_type, payload.get('chat_id'), payload.get('user_id')
+    if message_type == 'queue_update':
+        return message_type, payload.get('client_id')
+    return None
+
+
+class OutboundQueue:
+    """
+    Исходящая очередь одного соединения.
+
+    Необязательные кадры объединяются по ключу (в очереди остается последний)
+    и отбрасываются при заполненной очереди. Обязательные кадры не теряются:
+    они принимаются сверх лимита, но если соединение остается переполненным
+    дольше WEBSOCKET_SLOW_CONSUMER_TIMEOUT или буфер вырастает вдвое,
+    возвращается OVERFLOW и соединение должно быть закрыто.
+    """
+    __slots__ = ('websocket', 'writer', '_limit', '_frames', '_pending', '_over_limit_since')
+
+    def __init__(self, websocket: WebSocket, limit: Optional[int] = None):
+        self.websocket = websocket
+        self.writer = None  # задача-писатель, пока в очереди есть кадры
+        self._limit = limit or WEBSOCKET_OUTBOUND_QUEUE_SIZE
+        self._frames: deque = deque()  # [text, enqueued_at, key]
+        self._pending: Dict[Hashable, list] = {}  # ключ объединения -> кадр в очереди
+        self._over_limit_since: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, text: str, key: Optional[Hashable] = None) -> str:
+        """Постановка кадра в очередь"""
+        size = len(self._frames)
+        if key is not None:
+            frame = self._pending.get(key)
+            if frame is not None:
+                frame[0] = text
+                return Delivery.COALESCED
+            if size >= self._limit:
+                return Delivery.DROPPED
+        elif size >= self._limit:
+            now = time.monotonic()
+            if self._over_limit_since is None:
+                self._over_limit_since = now
+            if size >= 2 * self._limit or now - self._over_limit_since >= WEBSOCKET_SLOW_CONSUMER_TIMEOUT:
+                return Delivery.OVERFLOW
+
+        frame = [text, time.monotonic(), key]
+        self._frames.append(frame)
+        if key is not None:
+            self._pending[key] = frame
+        return Delivery.QUEUED
+
+    def pop(self) -> Tuple[str, float]:
+        """Следующий кадр и монотонное время его постановки в очередь"""
+        frame = self._frames.popleft()
+        key = frame[2]
+        if key is not None and self._pending.get(key) is frame:
+            del self._pending[key]
+        if self._over_limit_since is not None and len(self._frames) < self._limit:
+            self._over_limit_since = None
+        return frame[0], frame[1]
@@ -0,0 +1,125 @@
+"""
+Transactional outbox для событий Kafka: события записываются в kafka_outbox
+в той же транзакции, что и изменения чатов, и отправляются фоновой задачей
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from config.kafka_config import KAFKA_OUTBOX_BATCH_SIZE, KAFKA_OUTBOX_POLL_INTERVAL
+from database.logic.chats.chat import chat_db
+from utils.kafka_codec import jsonable_event
+from utils.kafka_producer import KafkaEventRecord, kafka_producer
+
+logger = logging.getLogger(__name__)
+
+
+def outbox_rows(records: List[KafkaEventRecord]) -> List[Dict[str, Any]]:
+    """Строки kafka_outbox для событий (передаются в методы chat_db с outbox=...)"""
+    return [
+        {'topic': record.topic, 'key': record.key, 'payload': jsonable_event(record.event)}
+        for record in records
+    ]
+
+
+class KafkaOutboxRelay:
+    """
+    Фоновая отправка событий из kafka_outbox в Kafka.
+
+    Задача забирает события пачками до batch_size в порядке записи, отправляет
+    их с ожиданием подтверждения брокера и удаляет доставленные в той же
+    транзакции. Полная пачка означает, что в outbox есть еще события, -
+    следующая забирается сразу. Иначе задача ждет notify() (его вызывают
+    после commit транзакций с событиями) или poll_interval - на случай
+    событий, записанных другими узлами, и повторов после ошибки.
+
+    Доставка - "как минимум один раз": если брокер не подтвердил пачку,
+    транзакция откатывается и пачка отправляется снова. При нескольких узлах
+    outbox в каждый момент разбирает только один из них, чтобы события
+    уходили в Kafka в порядке записи.
+    """
+
+    def __init__(self, db=None, producer=None, batch_size: int = KAFKA_OUTBOX_BATCH_SIZE,
+                 poll_interval: float = KAFKA_OUTBOX_POLL_INTERVAL):
+        self.db = db or chat_db
+        self.producer = producer or kafka_producer
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+        self._stats = {'relayed': 0, 'batches': 0, 'failed_batches': 0, 'last_error': None, 'send_time': 0.0}
+
+    async def start(self):
+        """Запуск фоновой отправки"""
+        if self._running:
+            return
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+        logger.info("Отправка событий outbox запущена")
+
+    async def stop(self):
+        """Остановка фоновой отправки (неотправленные события остаются в outbox)"""
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+        logger.info("Отправка событий outbox остановлена")
+
+    def notify(self):
+        """Сигнал о новых событиях в outbox - отправить, не дожидаясь poll_interval"""
+        self._wakeup.set()
+
+    async def relay_once(self) -> int:
+        """Отправка одной пачки событий, возвращает количество отправленных"""
+        started = time.perf_counter()
+        relayed = await self.db.drain_outbox(self.batch_size, self._publish)
+        if relayed:
+            self._stats['relayed'] += relayed
+            self._stats['batches'] += 1
+            self._stats['send_time'] += time.perf_counter() - started
+        return relayed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика отправки событий outbox"""
+        batches = self._stats['batches']
+        return {
+            'running': self._running,
+            'relayed': self._stats['relayed'],
+            'batches': batches,
+            'failed_batches': self._stats['failed_batches'],
+            'last_error': self._stats['last_error'],
+            'avg_batch_ms': self._stats['send_time'] * 1000 / batches if batches else 0,
+        }
+
+    async def _publish(self, events) -> None:
+        await self.producer.send_events([
+            KafkaEventRecord(event.topic, event.key, event.payload) for event in events
+        ])
+
+    async def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            try:
+                relayed = await self.relay_once()
+            except Exception as e:
+                self._stats['failed_batches'] += 1
+                self._stats['last_error'] = str(e)
+                logger.error(f"Ошибка отправки событий outbox: {e}")
+                # Повтор не раньше poll_interval, даже если приходят новые сигналы
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if relayed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Глобальный экземпляр отправки событий outbox
+outbox_relay = KafkaOutboxRelay()
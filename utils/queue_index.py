@@ -0,0 +1,309 @@
+"""
+Индексы очереди клиентов и доступности операторов для чата поддержки
+"""
+import heapq
+import random
+import time
+from collections.abc import Mapping
+from itertools import count
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+_MAX_LEVELS = 24  # хватает на ~16 млн элементов
+
+
+class _SkipNode:
+    """Узел skip-списка с ширинами ссылок (для вычисления позиции)"""
+    __slots__ = ('key', 'value', 'next', 'width')
+
+    def __init__(self, key, value, levels: int):
+        self.key = key
+        self.value = value
+        self.next: List[Optional['_SkipNode']] = [None] * levels
+        self.width: List[int] = [1] * levels
+
+
+class IndexedClientQueue(Mapping):
+    """
+    Очередь ожидающих клиентов, упорядоченная по ключу (-priority, enqueued_at).
+
+    Внутри - индексируемый skip-список: вставка, удаление, смена приоритета и
+    получение позиции клиента выполняются за O(log n). Снаружи очередь ведет
+    себя как словарь client_id -> QueuedClient (только для чтения), поэтому
+    существующий код с `in`, `[]`, `len()` и `.items()` продолжает работать.
+
+    Агрегаты (количество по приоритетам, сумма монотонных времен постановки,
+    самый давний клиент) обновляются инкрементально, поэтому среднее и
+    максимальное время ожидания читаются без обхода очереди.
+    """
+
+    def __init__(self):
+        self._head = _SkipNode(None, None, _MAX_LEVELS)
+        self._entries: Dict[int, Tuple[tuple, object]] = {}  # client_id -> (key, client)
+        self._seq = count()
+        self._priority_counts: Dict[int, int] = {}
+        self._enqueued_sum = 0.0
+        # Куча (enqueued_at, client_id) с ленивым удалением - для максимального ожидания
+        self._oldest: List[Tuple[float, int]] = []
+
+    # Интерфейс Mapping
+
+    def __getitem__(self, client_id: int):
+        return self._entries[client_id][1]
+
+    def __contains__(self, client_id) -> bool:
+        return client_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[int]:
+        """Итерация по client_id в порядке очереди"""
+        for client in self.ordered():
+            yield client.client_id
+
+    # Изменение очереди
+
+    def push(self, client) -> None:
+        """Добавление клиента в очередь"""
+        if client.client_id in self._entries:
+            raise KeyError(f"Клиент {client.client_id} уже в очереди")
+        key = (-client.priority, client.enqueued_at, next(self._seq))
+        self._insert(key, client)
+        self._entries[client.client_id] = (key, client)
+        self._account(client, 1)
+        heapq.heappush(self._oldest, (client.enqueued_at, client.client_id))
+
+    def remove(self, client_id: int):
+        """Удаление клиента из очереди. Возвращает удаленного клиента или None"""
+        entry = self._entries.pop(client_id, None)
+        if entry is None:
+            return None
+        key, client = entry
+        self._delete(key)
+        self._account(client, -1)
+        if len(self._oldest) > 2 * len(self._entries) + 64:
+            self._compact_oldest()
+        return client
+
+    def reprioritize(self, client_id: int, priority: int) -> bool:
+        """Изменение приоритета клиента с сохранением времени постановки в очередь"""
+        entry = self._entries.get(client_id)
+        if entry is None:
+            return False
+        old_key, client = entry
+        if client.priority == priority:
+            return True
+        self._delete(old_key)
+        self._account(client, -1)
+        client.priority = priority
+        key = (-priority, old_key[1], old_key[2])
+        self._insert(key, client)
+        self._entries[client_id] = (key, client)
+        self._account(client, 1)
+        return True
+
+    # Запросы
+
+    def rank(self, client_id: int) -> int:
+        """Позиция клиента в очереди (с 1), -1 если клиента нет"""
+        entry = self._entries.get(client_id)
+        if entry is None:
+            return -1
+        key = entry[0]
+        position = 0
+        node = self._head
+        for level in reversed(range(_MAX_LEVELS)):
+            nxt = node.next[level]
+            while nxt is not None and nxt.key < key:
+                position += node.width[level]
+                node = nxt
+                nxt = node.next[level]
+        return position + 1
+
+    def first(self):
+        """Клиент в голове очереди или None"""
+        node = self._head.next[0]
+        return node.value if node is not None else None
+
+    def ordered(self) -> Iterator:
+        """Клиенты в порядке очереди"""
+        node = self._head.next[0]
+        while node is not None:
+            yield node.value
+            node = node.next[0]
+
+    def priority_counts(self) -> Dict[int, int]:
+        """Количество клиентов по приоритетам"""
+        return dict(self._priority_counts)
+
+    def average_wait_time(self, now: Optional[float] = None) -> float:
+        """Среднее время ожидания в секундах по сумме времен постановки"""
+        if not self._entries:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, now - self._enqueued_sum / len(self._entries))
+
+    def max_wait_time(self, now: Optional[float] = None) -> float:
+        """Максимальное время ожидания в секундах (самый давний клиент)"""
+        oldest = self._oldest
+        while oldest:
+            enqueued_at, client_id = oldest[0]
+            entry = self._entries.get(client_id)
+            if entry is not None and entry[1].enqueued_at == enqueued_at:
+                if now is None:
+                    now = time.monotonic()
+                return max(0.0, now - enqueued_at)
+            heapq.heappop(oldest)  # клиент уже ушел из очереди
+        return 0
+
+    # Внутренние операции skip-списка
+
+    def _account(self, client, sign: int) -> None:
+        counts = self._priority_counts
+        remaining = counts.get(client.priority, 0) + sign
+        if remaining:
+            counts[client.priority] = remaining
+        else:
+            counts.pop(client.priority, None)
+        self._enqueued_sum += sign * client.enqueued_at
+
+    def _compact_oldest(self) -> None:
+        """Перестроение кучи давности без удаленных клиентов (амортизированно O(1))"""
+        self._oldest = [(client.enqueued_at, client_id) for client_id, (_, client) in self._entries.items()]
+        heapq.heapify(self._oldest)
+
+    def _insert(self, key: tuple, value) -> None:
+        chain: List[_SkipNode] = [self._head] * _MAX_LEVELS
+        steps_at_level = [0] * _MAX_LEVELS
+        node = self._head
+        for level in reversed(range(_MAX_LEVELS)):
+            nxt = node.next[level]
+            while nxt is not None and nxt.key < key:
+                steps_at_level[level] += node.width[level]
+                node = nxt
+                nxt = node.next[level]
+            chain[level] = node
+
+        levels = 1
+        while levels < _MAX_LEVELS and random.random() < 0.5:
+            levels += 1
+
+        new_node = _SkipNode(key, value, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, _MAX_LEVELS):
+            chain[level].width[level] += 1
+
+    def _delete(self, key: tuple) -> None:
+        chain: List[_SkipNode] = [self._head] * _MAX_LEVELS
+        node = self._head
+        for level in reversed(range(_MAX_LEVELS)):
+            nxt = node.next[level]
+            while nxt is not None and nxt.key < key:
+                node = nxt
+                nxt = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+
+        levels = len(target.next)
+        for level in range(levels):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(levels, _MAX_LEVELS):
+            chain[level].width[level] -= 1
+
+
+class OperatorLoadIndex:
+    """
+    Индекс доступных операторов по типу и текущей загрузке.
+
+    Для каждого типа оператора (support, lawyer, salesman) хранится массив
+    корзин: корзина с номером N содержит операторов, у которых сейчас N чатов.
+    В индексе находятся только операторы, которые могут принять чат
+    (`can_accept_chat`), поэтому выбор наименее загруженного оператора стоит
+    O(max_concurrent_chats), а не O(количество операторов).
+
+    Индекс не следит за OperatorStatus сам - после любого изменения статуса,
+    доступности или набора чатов оператора нужно вызвать `update()`.
+    """
+
+    def __init__(self):
+        # operator_type -> [load -> упорядоченное множество operator_id]
+        self._buckets: Dict[str, List[Dict[int, None]]] = {}
+        # operator_id -> (operator_type, load)
+        self._positions: Dict[int, Tuple[str, int]] = {}
+        self._counts: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, operator_id) -> bool:
+        return operator_id in self._positions
+
+    def update(self, operator) -> None:
+        """Переиндексация оператора по его текущему состоянию"""
+        if not operator.can_accept_chat:
+            self.discard(operator.operator_id)
+            return
+
+        position = (operator.operator_type, len(operator.current_chats))
+        if self._positions.get(operator.operator_id) == position:
+            return
+
+        self.discard(operator.operator_id)
+        operator_type, load = position
+        buckets = self._buckets.setdefault(operator_type, [])
+        while len(buckets) <= load:
+            buckets.append({})
+        buckets[load][operator.operator_id] = None
+        self._positions[operator.operator_id] = position
+        self._counts[operator_type] = self._counts.get(operator_type, 0) + 1
+
+    def discard(self, operator_id: int) -> None:
+        """Удаление оператора из индекса"""
+        position = self._positions.pop(operator_id, None)
+        if position is None:
+            return
+        operator_type, load = position
+        del self._buckets[operator_type][load][operator_id]
+        self._counts[operator_type] -= 1
+
+    def least_loaded(self, operator_type: str) -> Optional[int]:
+        """ID наименее загруженного доступного оператора указанного типа"""
+        if not self._counts.get(operator_type):
+            return None
+        for bucket in self._buckets[operator_type]:
+            if bucket:
+                return next(iter(bucket))
+        return None
+
+    def iter_available(self, operator_type: Optional[str] = None) -> Iterator[int]:
+        """ID доступных операторов по возрастанию загрузки"""
+        if operator_type is not None:
+            for bucket in self._buckets.get(operator_type, ()):
+                yield from bucket
+            return
+
+        max_load = max((len(buckets) for buckets in self._buckets.values()), default=0)
+        for load in range(max_load):
+            for buckets in self._buckets.values():
+                if load < len(buckets):
+                    yield from buckets[load]
+
+    def count(self, operator_type: Optional[str] = None) -> int:
+        """Количество доступных операторов"""
+        if operator_type is None:
+            return len(self._positions)
+        return self._counts.get(operator_type, 0)
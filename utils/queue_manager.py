@@ -1,28 +1,50 @@
 """
 Менеджер очереди операторов и клиентов для чата поддержки
 """
-import asyncio
+import heapq
 import time
-from typing import Dict, List, Set, Optional, Tuple
+from itertools import islice
+from typing import Awaitable, Callable, Dict, List, Set, Optional, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta, UTC
 import logging
 
+from utils.queue_index import IndexedClientQueue, OperatorLoadIndex
+
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+def _wall_clock(monotonic_ts: float) -> datetime:
+    """Перевод монотонного времени в календарное (UTC)"""
+    return datetime.now(UTC) - timedelta(seconds=time.monotonic() - monotonic_ts)
+
+
+@dataclass(slots=True)
 class QueuedClient:
-    """Клиент в очереди ожидания оператора"""
+    """
+    Клиент в очереди ожидания оператора.
+    
+    Компактная запись: без __dict__, время хранится одним монотонным float,
+    пустые метаданные не создают словарь.
+    """
     client_id: int
     chat_id: int
-    timestamp: datetime
     priority: int = 0
-    wait_time: int = 0
-    metadata: Dict = field(default_factory=dict)
+    metadata: Optional[Dict] = None
+    enqueued_at: float = field(default_factory=time.monotonic)  # монотонное время постановки в очередь
+    
+    @property
+    def timestamp(self) -> datetime:
+        """Время постановки в очередь (UTC)"""
+        return _wall_clock(self.enqueued_at)
+    
+    @property
+    def wait_time(self) -> int:
+        """Время ожидания в секундах (вычисляется при чтении)"""
+        return int(time.monotonic() - self.enqueued_at)
 
 
-@dataclass
+@dataclass(slots=True)
 class OperatorStatus:
     """Статус оператора"""
     operator_id: int
@@ -31,7 +53,12 @@ class OperatorStatus:
     is_available: bool = True
     max_concurrent_chats: int = 5  # сколько у оператора может быть максимум чатов (регулировать нагрузку на оператора, но такое себе)
     current_chats: Set[int] = field(default_factory=set)
-    last_activity: datetime = field(default_factory=datetime.utcnow)
+    last_active_at: float = field(default_factory=time.monotonic)  # монотонное время последней активности
+    
+    @property
+    def last_activity(self) -> datetime:
+        """Время последней активности (UTC)"""
+        return _wall_clock(self.last_active_at)
     
     @property
     def can_accept_chat(self) -> bool:
@@ -41,63 +68,62 @@ class OperatorStatus:
                 len(self.current_chats) < self.max_concurrent_chats)
 
 
+@dataclass(slots=True)
+class ChatAssignment:
+    """Результат автоматического назначения клиента оператору"""
+    chat_id: int
+    client_id: int
+    operator_id: int
+    operator_type: str
+    client: QueuedClient  # исходная запись очереди (для отката назначения)
+
+
+BatchAssignmentHandler = Callable[[List[ChatAssignment]], Awaitable[None]]
+
+
 class SupportQueueManager:
     """Менеджер очереди поддержки"""
     
     def __init__(self):
-        # Очередь клиентов ожидающих операторов
-        self.waiting_clients: Dict[int, QueuedClient] = {}
+        # Очередь клиентов ожидающих операторов (упорядочена по приоритету и времени)
+        self.waiting_clients: IndexedClientQueue = IndexedClientQueue()
         
         # Статусы операторов
         self.operators: Dict[int, OperatorStatus] = {}
         
+        # Индекс доступных операторов по типу и загрузке
+        self._operator_index = OperatorLoadIndex()
+        
         # Назначения чатов операторам
         self.chat_assignments: Dict[int, int] = {}  # chat_id -> operator_id
         
-        # Блокировки для обработки одновременных запросов
-        self._queue_lock = asyncio.Lock()
-        self._assignment_lock = asyncio.Lock()
+        # Глобальных блокировок нет: каждое изменение состояния выполняется без await
+        # внутри, поэтому в цикле событий оно атомарно. Проверка емкости оператора и
+        # назначение чата - одна такая операция (compare-and-set по загрузке), и
+        # несвязанные назначения не ждут друг друга.
+        
+        # Обработчик пакетов автоматических назначений (БД, Kafka, WebSocket)
+        self._batch_assignment_handler: Optional[BatchAssignmentHandler] = None
         
-        # Задача обновления времени ожидания
-        self._update_task: Optional[asyncio.Task] = None
         self._running = False
     
+    def set_batch_assignment_handler(self, handler: Optional[BatchAssignmentHandler]):
+        """Установка обработчика пакетов автоматических назначений"""
+        self._batch_assignment_handler = handler
+    
     async def start(self):
         """Запуск менеджера очереди"""
+        # Время ожидания вычисляется при чтении, фоновых задач у менеджера нет
         if not self._running:
             self._running = True
-            self._update_task = asyncio.create_task(self._update_wait_times())
             logger.info("Менеджер очереди запущен")
     
     async def stop(self):
         """Остановка менеджера очереди"""
         if self._running:
             self._running = False
-            if self._update_task:
-                self._update_task.cancel()
-                try:
-                    await self._update_task
-                except asyncio.CancelledError:
-                    pass
             logger.info("Менеджер очереди остановлен")
     
-    async def _update_wait_times(self):
-        """Обновление времени ожидания клиентов"""
-        try:
-            while self._running:
-                current_time = datetime.now(UTC)
-                
-                async with self._queue_lock:
-                    for client in self.waiting_clients.values():
-                        client.wait_time = int((current_time - client.timestamp).total_seconds())
-                
-                await asyncio.sleep(30)  # Обновляем каждые 30 секунд
-                
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            logger.error(f"Ошибка в обновлении времени ожидания: {e}")
-    
     # Управление операторами
     
     async def register_operator(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5):
@@ -117,7 +143,8 @@ class SupportQueueManager:
         operator = self.operators[operator_id]
         operator.is_online = True
         operator.is_available = True
-        operator.last_activity = datetime.now(UTC)
+        operator.last_active_at = time.monotonic()
+        self._operator_index.update(operator)
         
         logger.info(f"Оператор {operator_id} ({operator_type}) в онлайн")
         
@@ -130,6 +157,7 @@ class SupportQueueManager:
             operator = self.operators[operator_id]
             operator.is_online = False
             operator.is_available = False
+            self._operator_index.discard(operator_id)
             
             # Переводим все активные чаты оператора другим операторам
             chats_to_transfer = list(operator.current_chats)
@@ -141,21 +169,35 @@ class SupportQueueManager:
     async def set_operator_busy(self, operator_id: int, busy: bool = True):
         """Установка статуса занятости оператора"""
         if operator_id in self.operators:
-            self.operators[operator_id].is_available = not busy
+            operator = self.operators[operator_id]
+            operator.is_available = not busy
+            self._operator_index.update(operator)
             status = "занят" if busy else "доступен"
             logger.info(f"Оператор {operator_id} {status}")
     
     def get_available_operators(self, operator_type: Optional[str] = None) -> List[OperatorStatus]:
-        """Получение списка доступных операторов"""
-        available = []
-        for operator in self.operators.values():
-            if operator.can_accept_chat:
-                if operator_type is None or operator.operator_type == operator_type:
-                    available.append(operator)
-        
-        # Сортируем по загрузке (менее загруженные первыми)
-        available.sort(key=lambda op: len(op.current_chats))
-        return available
+        """Получение списка доступных операторов (менее загруженные первыми)"""
+        return [
+            self.operators[operator_id]
+            for operator_id in self._operator_index.iter_available(operator_type)
+        ]
+    
+    def get_least_loaded_operator(self, operator_type: str) -> Optional[OperatorStatus]:
+        """Получение наименее загруженного доступного оператора"""
+        operator_id = self._operator_index.least_loaded(operator_type)
+        return self.operators[operator_id] if operator_id is not None else None
+    
+    def count_available_operators(self, operator_type: Optional[str] = None) -> int:
+        """Количество доступных операторов"""
+        return self._operator_index.count(operator_type)
+    
+    async def get_operator(self, operator_id: int) -> Optional[OperatorStatus]:
+        """Получение статуса оператора"""
+        return self.operators.get(operator_id)
+    
+    async def list_operators(self) -> List[OperatorStatus]:
+        """Получение статусов всех зарегистрированных операторов"""
+        return list(self.operators.values())
     
     def get_operator_stats(self, operator_id: int) -> Optional[Dict]:
         """Получение статистики оператора"""
@@ -176,141 +218,197 @@ class SupportQueueManager:
     
     async def add_client_to_queue(self, client_id: int, chat_id: int, priority: int = 0, metadata: Optional[Dict] = None):
         """Добавление клиента в очередь ожидания"""
-        async with self._queue_lock:
-            if client_id not in self.waiting_clients:
-                queued_client = QueuedClient(
-                    client_id=client_id,
-                    chat_id=chat_id,
-                    timestamp=datetime.now(UTC),
-                    priority=priority,
-                    metadata=metadata or {}
-                )
-                self.waiting_clients[client_id] = queued_client
-                
-                logger.info(f"Клиент {client_id} добавлен в очередь (приоритет: {priority})")
-                
-                # Пытаемся сразу назначить доступного оператора
-                await self._try_assign_operator_to_client(client_id)
+        if client_id not in self.waiting_clients:
+            queued_client = QueuedClient(
+                client_id=client_id,
+                chat_id=chat_id,
+                priority=priority,
+                metadata=metadata or None
+            )
+            self.waiting_clients.push(queued_client)
+            
+            logger.info(f"Клиент {client_id} добавлен в очередь (приоритет: {priority})")
+            
+            # Пытаемся сразу назначить доступного оператора тем же пакетным проходом:
+            # назначение сохраняется в БД и уходит в Kafka через обработчик пакета
+            await self._try_auto_assign_clients()
     
     async def remove_client_from_queue(self, client_id: int) -> bool:
         """Удаление клиента из очереди"""
-        async with self._queue_lock:
-            if client_id in self.waiting_clients:
-                del self.waiting_clients[client_id]
-                logger.info(f"Клиент {client_id} удален из очереди")
-                return True
-            return False
+        if self.waiting_clients.remove(client_id) is not None:
+            logger.info(f"Клиент {client_id} удален из очереди")
+            return True
+        return False
     
     async def update_queue_position(self, client_id: int, new_priority: int) -> int:
         """Обновление приоритета клиента в очереди"""
-        async with self._queue_lock:
-            if client_id in self.waiting_clients:
-                self.waiting_clients[client_id].priority = new_priority
-                logger.info(f"Приоритет клиента {client_id} изменен на {new_priority}")
+        if self.waiting_clients.reprioritize(client_id, new_priority):
+            logger.info(f"Приоритет клиента {client_id} изменен на {new_priority}")
         
         return await self.get_queue_position(client_id)
     
     async def get_queue_position(self, client_id: int) -> int:
         """Получение позиции клиента в очереди"""
-        if client_id not in self.waiting_clients:
-            return -1
-        
-        # Сортируем клиентов по приоритету (выше приоритет = меньше номер в очереди)
-        # Затем по времени ожидания
-        sorted_clients = sorted(
-            self.waiting_clients.values(),
-            key=lambda c: (-c.priority, c.timestamp)
-        )
-        
-        for position, client in enumerate(sorted_clients, 1):
-            if client.client_id == client_id:
-                return position
-        return -1
+        # Выше приоритет = меньше номер в очереди, затем по времени постановки
+        return self.waiting_clients.rank(client_id)
+    
+    async def is_client_waiting(self, client_id: int) -> bool:
+        """Находится ли клиент в очереди"""
+        return client_id in self.waiting_clients
+    
+    async def list_waiting_clients(self, limit: Optional[int] = None) -> List[QueuedClient]:
+        """Клиенты в порядке очереди"""
+        return list(islice(self.waiting_clients.ordered(), limit))
+    
+    async def fetch_queue_status(self) -> Dict:
+        """Получение статуса очереди (общий асинхронный интерфейс для всех хранилищ)"""
+        return self.get_queue_status()
     
     def get_queue_status(self) -> Dict:
         """Получение статуса очереди"""
         return {
             'total_waiting': len(self.waiting_clients),
-            'average_wait_time': sum(c.wait_time for c in self.waiting_clients.values()) / len(self.waiting_clients) if self.waiting_clients else 0,
-            'available_operators': len(self.get_available_operators()),
+            'average_wait_time': self.waiting_clients.average_wait_time(),
+            'max_wait_time': self.waiting_clients.max_wait_time(),
+            'available_operators': self.count_available_operators(),
             'queue_by_priority': self._get_queue_by_priority()
         }
     
     def _get_queue_by_priority(self) -> Dict[int, int]:
         """Получение количества клиентов по приоритетам"""
-        priority_counts = {}
-        for client in self.waiting_clients.values():
-            priority_counts[client.priority] = priority_counts.get(client.priority, 0) + 1
-        return priority_counts
+        return self.waiting_clients.priority_counts()
     
     # Управление назначениями чатов
     
     async def assign_chat_to_operator(self, chat_id: int, operator_id: int, client_id: int) -> bool:
         """Назначение чата оператору"""
-        async with self._assignment_lock:
-            if operator_id not in self.operators:
-                return False
-            
-            operator = self.operators[operator_id]
-            if not operator.can_accept_chat:
-                return False
-            
-            # Назначаем чат
-            self.chat_assignments[chat_id] = operator_id
-            operator.current_chats.add(chat_id)
-            operator.last_activity = datetime.now(UTC)
-            
-            # Удаляем клиента из очереди
-            await self.remove_client_from_queue(client_id)
-            
-            logger.info(f"Чат {chat_id} назначен оператору {operator_id}")
-            return True
+        return self._assign(chat_id, operator_id, client_id)
+    
+    def _assign(self, chat_id: int, operator_id: int, client_id: int) -> bool:
+        """Проверка емкости оператора и назначение чата одной операцией без await"""
+        operator = self.operators.get(operator_id)
+        if operator is None or not operator.can_accept_chat:
+            return False
+        
+        # Назначаем чат
+        self.chat_assignments[chat_id] = operator_id
+        operator.current_chats.add(chat_id)
+        operator.last_active_at = time.monotonic()
+        self._operator_index.update(operator)
+        
+        # Удаляем клиента из очереди
+        if self.waiting_clients.remove(client_id) is not None:
+            logger.info(f"Клиент {client_id} удален из очереди")
+        
+        logger.info(f"Чат {chat_id} назначен оператору {operator_id}")
+        return True
     
     async def release_operator_from_chat(self, chat_id: int) -> bool:
         """Освобождение оператора от чата"""
-        async with self._assignment_lock:
-            if chat_id not in self.chat_assignments:
-                return False
-            
-            operator_id = self.chat_assignments[chat_id]
-            del self.chat_assignments[chat_id]
-            
-            if operator_id in self.operators:
-                operator = self.operators[operator_id]
-                operator.current_chats.discard(chat_id)
-                operator.last_activity = datetime.now(UTC)
-                
-                # Если оператор снова доступен, проверяем очередь
-                if operator.can_accept_chat:
-                    await self._try_auto_assign_clients()
-            
-            logger.info(f"Оператор {operator_id} освобожден от чата {chat_id}")
-            return True
+        operator_id = self.chat_assignments.pop(chat_id, None)
+        if operator_id is None:
+            return False
+        
+        operator = self.operators.get(operator_id)
+        if operator:
+            operator.current_chats.discard(chat_id)
+            operator.last_active_at = time.monotonic()
+            self._operator_index.update(operator)
+        
+        logger.info(f"Оператор {operator_id} освобожден от чата {chat_id}")
+        
+        # Если оператор снова доступен, проверяем очередь
+        if operator and operator.can_accept_chat:
+            await self._try_auto_assign_clients()
+        return True
     
     async def transfer_chat(self, chat_id: int, new_operator_id: int, reason: str = "manual_transfer") -> bool:
         """Перевод чата другому оператору"""
+        # Проверка и перевод выполняются без await между ними
         if chat_id not in self.chat_assignments:
             return False
         
         old_operator_id = self.chat_assignments[chat_id]
         
         # Проверяем, что новый оператор может принять чат
-        if new_operator_id not in self.operators or not self.operators[new_operator_id].can_accept_chat:
+        new_operator = self.operators.get(new_operator_id)
+        if new_operator is None or not new_operator.can_accept_chat:
             return False
         
-        async with self._assignment_lock:
-            # Освобождаем старого оператора
-            if old_operator_id in self.operators:
-                self.operators[old_operator_id].current_chats.discard(chat_id)
-            
-            # Назначаем новому оператору
-            self.chat_assignments[chat_id] = new_operator_id
-            self.operators[new_operator_id].current_chats.add(chat_id)
-            self.operators[new_operator_id].last_activity = datetime.now(UTC)
+        # Освобождаем старого оператора
+        if old_operator_id in self.operators:
+            old_operator = self.operators[old_operator_id]
+            old_operator.current_chats.discard(chat_id)
+            self._operator_index.update(old_operator)
+        
+        # Назначаем новому оператору
+        self.chat_assignments[chat_id] = new_operator_id
+        new_operator.current_chats.add(chat_id)
+        new_operator.last_active_at = time.monotonic()
+        self._operator_index.update(new_operator)
         
         logger.info(f"Чат {chat_id} переведен с оператора {old_operator_id} на {new_operator_id}, причина: {reason}")
         return True
     
+    async def revert_transfer(self, chat_id: int, old_operator_id: int, new_operator_id: int) -> bool:
+        """Откат перевода чата: чат возвращается прежнему оператору без проверки его емкости"""
+        if self.chat_assignments.get(chat_id) != new_operator_id:
+            return False
+        
+        new_operator = self.operators.get(new_operator_id)
+        if new_operator:
+            new_operator.current_chats.discard(chat_id)
+            self._operator_index.update(new_operator)
+        
+        self.chat_assignments[chat_id] = old_operator_id
+        old_operator = self.operators.get(old_operator_id)
+        if old_operator:
+            old_operator.current_chats.add(chat_id)
+            self._operator_index.update(old_operator)
+        
+        logger.warning(f"Перевод чата {chat_id} на оператора {new_operator_id} откачен")
+        return True
+    
+    async def get_chat_operator(self, chat_id: int) -> Optional[int]:
+        """Оператор, которому назначен чат"""
+        return self.chat_assignments.get(chat_id)
+    
+    async def list_chat_assignments(self) -> Dict[int, int]:
+        """Все назначения chat_id -> operator_id"""
+        return dict(self.chat_assignments)
+    
+    async def restore_state(self, waiting_clients: List[QueuedClient],
+                            assignments: List[Tuple[int, int, str]]):
+        """
+        Восстановление очереди и назначений после рестарта (из снимка БД).
+        
+        assignments: список (chat_id, operator_id, operator_type). Операторы, которых
+        еще нет в менеджере, регистрируются оффлайн - в онлайн их переведет
+        переподключение, после чего сработает обычное автоназначение.
+        """
+        touched: Dict[int, OperatorStatus] = {}
+        for chat_id, operator_id, operator_type in assignments:
+            operator = self.operators.get(operator_id)
+            if operator is None:
+                operator = self.operators[operator_id] = OperatorStatus(
+                    operator_id=operator_id,
+                    operator_type=operator_type
+                )
+            self.chat_assignments[chat_id] = operator_id
+            operator.current_chats.add(chat_id)
+            touched[operator_id] = operator
+        
+        for operator in touched.values():
+            self._operator_index.update(operator)
+        
+        restored = 0
+        for client in waiting_clients:
+            if client.client_id not in self.waiting_clients:
+                self.waiting_clients.push(client)
+                restored += 1
+        
+        logger.info(f"Восстановлено {restored} клиентов в очереди и {len(assignments)} назначений чатов")
+    
     # Автоматическое назначение
     
     async def _try_assign_operator_to_client(self, client_id: int):
@@ -319,40 +417,101 @@ class SupportQueueManager:
             return
         
         client = self.waiting_clients[client_id]
-        available_operators = self.get_available_operators("support")  # Сначала ищем операторов поддержки
+        # Сначала ищем оператора поддержки с наименьшей загрузкой
+        selected_operator = self.get_least_loaded_operator("support")
         
-        if available_operators:
-            # Выбираем оператора с наименьшей загрузкой
-            selected_operator = available_operators[0]
-            await self.assign_chat_to_operator(client.chat_id, selected_operator.operator_id, client_id)
-            
-            # Отправляем событие о назначении (это будет делать вызывающий код через Kafka)
-            return selected_operator.operator_id
+        if selected_operator:
+            if self._assign(client.chat_id, selected_operator.operator_id, client_id):
+                # Отправляем событие о назначении (это будет делать вызывающий код через Kafka)
+                return selected_operator.operator_id
         
         return None
     
     async def _try_auto_assign_clients(self):
         """Попытка автоматически назначить операторов ожидающим клиентам"""
-        if not self.waiting_clients:
+        assignments = await self.match_waiting_clients("support")
+        if not assignments:
             return
         
-        # Сортируем клиентов по приоритету и времени ожидания
-        sorted_clients = sorted(
-            self.waiting_clients.values(),
-            key=lambda c: (-c.priority, c.timestamp)
-        )
+        logger.info(f"Автоматически назначено {len(assignments)} клиентов операторам")
+        
+        if self._batch_assignment_handler:
+            try:
+                await self._batch_assignment_handler(assignments)
+            except Exception as e:
+                logger.error(f"Ошибка обработки пакета назначений: {e}")
+    
+    async def match_waiting_clients(self, operator_type: str = "support",
+                                    limit: Optional[int] = None) -> List[ChatAssignment]:
+        """
+        Пакетное сопоставление ожидающих клиентов со свободными операторами.
+        
+        Берется снимок свободной емкости операторов указанного типа, после чего
+        клиенты с головы очереди распределяются по наименее загруженным операторам
+        за один проход. Внутри прохода нет await, поэтому снимок остается
+        согласованным, а индекс загрузки обновляется один раз на оператора.
+        """
+        # Снимок: (загрузка, порядок, оператор). iter_available уже отдает операторов
+        # по возрастанию загрузки, поэтому список сразу является кучей.
+        capacity = [
+            (len(operator.current_chats), order, operator)
+            for order, operator in enumerate(self.get_available_operators(operator_type))
+        ]
         
-        for client in sorted_clients:
-            operator_id = await self._try_assign_operator_to_client(client.client_id)
-            if operator_id:
-                logger.info(f"Автоматически назначен оператор {operator_id} клиенту {client.client_id}")
+        assignments: List[ChatAssignment] = []
+        touched: Dict[int, OperatorStatus] = {}
+        now = time.monotonic()
+        
+        while capacity and self.waiting_clients and (limit is None or len(assignments) < limit):
+            load, order, operator = capacity[0]
+            client = self.waiting_clients.remove(self.waiting_clients.first().client_id)
+            
+            self.chat_assignments[client.chat_id] = operator.operator_id
+            operator.current_chats.add(client.chat_id)
+            operator.last_active_at = now
+            touched[operator.operator_id] = operator
+            
+            assignments.append(ChatAssignment(
+                chat_id=client.chat_id,
+                client_id=client.client_id,
+                operator_id=operator.operator_id,
+                operator_type=operator.operator_type,
+                client=client
+            ))
+            
+            if load + 1 < operator.max_concurrent_chats:
+                heapq.heapreplace(capacity, (load + 1, order, operator))
+            else:
+                heapq.heappop(capacity)
+        
+        for operator in touched.values():
+            self._operator_index.update(operator)
+        
+        return assignments
+    
+    async def revert_assignments(self, assignments: List[ChatAssignment]):
+        """Откат пакета назначений: чаты снимаются с операторов, клиенты возвращаются в очередь"""
+        for assignment in assignments:
+            if self.chat_assignments.get(assignment.chat_id) != assignment.operator_id:
+                continue
+            del self.chat_assignments[assignment.chat_id]
+            
+            operator = self.operators.get(assignment.operator_id)
+            if operator:
+                operator.current_chats.discard(assignment.chat_id)
+                self._operator_index.update(operator)
+            
+            # Клиент возвращается на прежнее место - время постановки сохраняется
+            if assignment.client_id not in self.waiting_clients:
+                self.waiting_clients.push(assignment.client)
+        
+        logger.warning(f"Откачено {len(assignments)} автоматических назначений")
     
     async def _transfer_chat_to_available_operator(self, chat_id: int, offline_operator_id: int, reason: str):
         """Перевод чата доступному оператору при уходе оператора"""
-        available_operators = self.get_available_operators("support")
+        new_operator = self.get_least_loaded_operator("support")
         
-        if available_operators:
-            new_operator = available_operators[0]
+        if new_operator:
             await self.transfer_chat(chat_id, new_operator.operator_id, reason)
             logger.info(f"Чат {chat_id} автоматически переведен на оператора {new_operator.operator_id}")
         else:
@@ -364,5 +523,14 @@ class SupportQueueManager:
                 await self.release_operator_from_chat(chat_id)
 
 
-# Глобальный экземпляр менеджера очереди
-queue_manager = SupportQueueManager()
+# Выбор хранилища состояния в зависимости от конфигурации
+from config.chat_config import CHAT_STATE_BACKEND, ChatStateBackend
+
+if CHAT_STATE_BACKEND == ChatStateBackend.REDIS:
+    from utils.redis_queue_manager import RedisSupportQueueManager
+    
+    queue_manager = RedisSupportQueueManager()
+    logger.info("Состояние очереди поддержки хранится в Redis")
+else:
+    # Глобальный экземпляр менеджера очереди
+    queue_manager = SupportQueueManager()
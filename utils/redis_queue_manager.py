@@ -0,0 +1,672 @@
+"""
+Менеджер очереди поддержки с состоянием в Redis (для нескольких экземпляров приложения)
+"""
+import json
+import time
+from datetime import datetime, UTC
+from typing import Dict, List, Optional, Tuple
+import logging
+
+import redis.asyncio as aioredis
+
+from config.chat_config import CHAT_STATE_REDIS_URL, CHAT_STATE_KEY_PREFIX
+from utils.queue_manager import (
+    BatchAssignmentHandler,
+    ChatAssignment,
+    OperatorStatus,
+    QueuedClient,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Общие функции Lua-скриптов.
+#
+# Схема ключей (P - префикс):
+#   P..'queue'                ZSET client_id -> -priority * PRIORITY_WEIGHT + enqueued_at
+#   P..'queue:age'            ZSET client_id -> enqueued_at (для максимального ожидания)
+#   P..'queue:stats'          HASH priority:<N> -> количество, enqueued_sum -> сумма времен постановки
+#   P..'client:<id>'          HASH chat_id, priority, timestamp, enqueued_at, metadata
+#   P..'operators'            SET  всех operator_id
+#   P..'operator_types'       SET  типов операторов
+#   P..'operator:<id>'        HASH operator_type, is_online, is_available, max_concurrent_chats, last_activity
+#   P..'operator:<id>:chats'  SET  chat_id, которые ведет оператор (загрузка = SCARD)
+#   P..'available:<type>'     ZSET operator_id -> загрузка, только операторы, которые могут принять чат
+#   P..'assignments'          HASH chat_id -> operator_id
+#
+# Ключи строятся внутри скриптов, поэтому все состояние должно жить на одном узле Redis.
+_LUA_PRELUDE = """
+local P = ARGV[1]
+local PRIORITY_WEIGHT = 1e10
+
+local function can_accept(op_id)
+    local key = P .. 'operator:' .. op_id
+    local op = redis.call('HMGET', key, 'is_online', 'is_available', 'max_concurrent_chats')
+    if not op[3] then
+        return false
+    end
+    return op[1] == '1' and op[2] == '1' and redis.call('SCARD', key .. ':chats') < tonumber(op[3])
+end
+
+local function reindex(op_id)
+    local key = P .. 'operator:' .. op_id
+    local operator_type = redis.call('HGET', key, 'operator_type')
+    if not operator_type then
+        return
+    end
+    local available = P .. 'available:' .. operator_type
+    if can_accept(op_id) then
+        redis.call('ZADD', available, redis.call('SCARD', key .. ':chats'), op_id)
+    else
+        redis.call('ZREM', available, op_id)
+    end
+end
+
+local function register(op_id, operator_type, max_chats, now)
+    local key = P .. 'operator:' .. op_id
+    if redis.call('EXISTS', key) == 1 then
+        return false
+    end
+    redis.call('HSET', key, 'operator_type', operator_type, 'is_online', '0', 'is_available', '1',
+               'max_concurrent_chats', max_chats, 'last_activity', now)
+    redis.call('SADD', P .. 'operators', op_id)
+    redis.call('SADD', P .. 'operator_types', operator_type)
+    return true
+end
+
+local function count_priority(priority, delta)
+    local stats = P .. 'queue:stats'
+    if redis.call('HINCRBY', stats, 'priority:' .. priority, delta) <= 0 then
+        redis.call('HDEL', stats, 'priority:' .. priority)
+    end
+end
+
+local function enqueue(client_id, chat_id, priority, timestamp, enqueued_at, metadata)
+    local key = P .. 'client:' .. client_id
+    if redis.call('EXISTS', key) == 1 then
+        return false
+    end
+    redis.call('HSET', key, 'chat_id', chat_id, 'priority', priority, 'timestamp', timestamp,
+               'enqueued_at', enqueued_at, 'metadata', metadata)
+    local score = -tonumber(priority) * PRIORITY_WEIGHT + tonumber(enqueued_at)
+    redis.call('ZADD', P .. 'queue', string.format('%.17g', score), client_id)
+    redis.call('ZADD', P .. 'queue:age', enqueued_at, client_id)
+    count_priority(priority, 1)
+    redis.call('HINCRBYFLOAT', P .. 'queue:stats', 'enqueued_sum', enqueued_at)
+    return true
+end
+
+local function dequeue(client_id)
+    local key = P .. 'client:' .. client_id
+    local client = redis.call('HMGET', key, 'priority', 'enqueued_at')
+    if not client[1] then
+        return false
+    end
+    redis.call('DEL', key)
+    redis.call('ZREM', P .. 'queue', client_id)
+    redis.call('ZREM', P .. 'queue:age', client_id)
+    count_priority(client[1], -1)
+    if redis.call('ZCARD', P .. 'queue') == 0 then
+        redis.call('HDEL', P .. 'queue:stats', 'enqueued_sum')
+    else
+        redis.call('HINCRBYFLOAT', P .. 'queue:stats', 'enqueued_sum', '-' .. client[2])
+    end
+    return true
+end
+
+local function attach(chat_id, op_id, now)
+    local key = P .. 'operator:' .. op_id
+    redis.call('HSET', P .. 'assignments', chat_id, op_id)
+    redis.call('SADD', key .. ':chats', chat_id)
+    redis.call('HSET', key, 'last_activity', now)
+    reindex(op_id)
+end
+
+local function detach(chat_id, op_id)
+    redis.call('SREM', P .. 'operator:' .. op_id .. ':chats', chat_id)
+    reindex(op_id)
+end
+"""
+
+# ARGV: P, client_id, chat_id, priority, timestamp, enqueued_at, metadata
+_ENQUEUE = _LUA_PRELUDE + """
+return enqueue(ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6], ARGV[7]) and 1 or 0
+"""
+
+# ARGV: P, client_id
+_DEQUEUE = _LUA_PRELUDE + """
+return dequeue(ARGV[2]) and 1 or 0
+"""
+
+# ARGV: P, client_id, priority
+_REPRIORITIZE = _LUA_PRELUDE + """
+local key = P .. 'client:' .. ARGV[2]
+local client = redis.call('HMGET', key, 'priority', 'enqueued_at')
+if not client[1] then
+    return 0
+end
+if client[1] ~= ARGV[3] then
+    count_priority(client[1], -1)
+    count_priority(ARGV[3], 1)
+    redis.call('HSET', key, 'priority', ARGV[3])
+    local score = -tonumber(ARGV[3]) * PRIORITY_WEIGHT + tonumber(client[2])
+    redis.call('ZADD', P .. 'queue', string.format('%.17g', score), ARGV[2])
+end
+return 1
+"""
+
+# ARGV: P, operator_id, operator_type, max_concurrent_chats, now
+_REGISTER_OPERATOR = _LUA_PRELUDE + """
+return register(ARGV[2], ARGV[3], ARGV[4], ARGV[5]) and 1 or 0
+"""
+
+# ARGV: P, operator_id, operator_type, max_concurrent_chats, now
+_SET_ONLINE = _LUA_PRELUDE + """
+register(ARGV[2], ARGV[3], ARGV[4], ARGV[5])
+redis.call('HSET', P .. 'operator:' .. ARGV[2], 'is_online', '1', 'is_available', '1', 'last_activity', ARGV[5])
+reindex(ARGV[2])
+return 1
+"""
+
+# ARGV: P, operator_id. Возвращает чаты оператора или nil, если оператора нет
+_SET_OFFLINE = _LUA_PRELUDE + """
+local key = P .. 'operator:' .. ARGV[2]
+if redis.call('EXISTS', key) == 0 then
+    return false
+end
+redis.call('HSET', key, 'is_online', '0', 'is_available', '0')
+reindex(ARGV[2])
+return redis.call('SMEMBERS', key .. ':chats')
+"""
+
+# ARGV: P, operator_id, is_available
+_SET_AVAILABLE = _LUA_PRELUDE + """
+local key = P .. 'operator:' .. ARGV[2]
+if redis.call('EXISTS', key) == 0 then
+    return 0
+end
+redis.call('HSET', key, 'is_available', ARGV[3])
+reindex(ARGV[2])
+return 1
+"""
+
+# ARGV: P, chat_id, operator_id, client_id, now
+_ASSIGN = _LUA_PRELUDE + """
+if not can_accept(ARGV[3]) then
+    return 0
+end
+attach(ARGV[2], ARGV[3], ARGV[5])
+dequeue(ARGV[4])
+return 1
+"""
+
+# ARGV: P, chat_id, now. Возвращает {operator_id, может ли оператор принять чат} или nil
+_RELEASE = _LUA_PRELUDE + """
+local op_id = redis.call('HGET', P .. 'assignments', ARGV[2])
+if not op_id then
+    return false
+end
+redis.call('HDEL', P .. 'assignments', ARGV[2])
+if redis.call('EXISTS', P .. 'operator:' .. op_id) == 1 then
+    redis.call('HSET', P .. 'operator:' .. op_id, 'last_activity', ARGV[3])
+end
+detach(ARGV[2], op_id)
+return {op_id, can_accept(op_id) and 1 or 0}
+"""
+
+# ARGV: P, chat_id, new_operator_id, now. Возвращает прежнего оператора или nil
+_TRANSFER = _LUA_PRELUDE + """
+local old_op_id = redis.call('HGET', P .. 'assignments', ARGV[2])
+if not old_op_id or not can_accept(ARGV[3]) then
+    return false
+end
+detach(ARGV[2], old_op_id)
+attach(ARGV[2], ARGV[3], ARGV[4])
+return old_op_id
+"""
+
+# ARGV: P, operator_type, limit (0 - без ограничения), now.
+# Возвращает список {client_id, operator_id, поля записи клиента...}
+_MATCH = _LUA_PRELUDE + """
+local available = P .. 'available:' .. ARGV[2]
+local limit = tonumber(ARGV[3])
+local result = {}
+while limit == 0 or #result < limit do
+    local op_id = redis.call('ZRANGE', available, 0, 0)[1]
+    if not op_id then
+        break
+    end
+    local client_id = redis.call('ZRANGE', P .. 'queue', 0, 0)[1]
+    if not client_id then
+        break
+    end
+    local client = redis.call('HGETALL', P .. 'client:' .. client_id)
+    if #client == 0 then
+        -- Записи клиента нет (сбой между удалением из очереди и DEL) - убираем его из очереди
+        redis.call('ZREM', P .. 'queue', client_id)
+        redis.call('ZREM', P .. 'queue:age', client_id)
+    else
+        local chat_id = redis.call('HGET', P .. 'client:' .. client_id, 'chat_id')
+        dequeue(client_id)
+        attach(chat_id, op_id, ARGV[4])
+        table.insert(result, {client_id, op_id, client})
+    end
+end
+return result
+"""
+
+# ARGV: P, chat_id, old_operator_id, new_operator_id, now. Емкость прежнего оператора не проверяется
+_REVERT_TRANSFER = _LUA_PRELUDE + """
+if redis.call('HGET', P .. 'assignments', ARGV[2]) ~= ARGV[4] then
+    return 0
+end
+detach(ARGV[2], ARGV[4])
+attach(ARGV[2], ARGV[3], ARGV[5])
+return 1
+"""
+
+# ARGV: P, chat_id, operator_id, client_id, priority, timestamp, enqueued_at, metadata
+_REVERT = _LUA_PRELUDE + """
+if redis.call('HGET', P .. 'assignments', ARGV[2]) ~= ARGV[3] then
+    return 0
+end
+redis.call('HDEL', P .. 'assignments', ARGV[2])
+detach(ARGV[2], ARGV[3])
+enqueue(ARGV[4], ARGV[2], ARGV[5], ARGV[6], ARGV[7], ARGV[8])
+return 1
+"""
+
+# ARGV: P, chat_id, operator_id, operator_type, now
+_RESTORE_ASSIGNMENT = _LUA_PRELUDE + """
+register(ARGV[3], ARGV[4], '5', ARGV[5])
+if redis.call('HGET', P .. 'assignments', ARGV[2]) then
+    return 0
+end
+attach(ARGV[2], ARGV[3], ARGV[5])
+return 1
+"""
+
+
+def _pairs(flat: List) -> Dict[str, str]:
+    """Преобразование плоского ответа HGETALL из Lua в словарь"""
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def _monotonic_from_epoch(enqueued_at: float) -> float:
+    """Перевод времени постановки (эпоха, общее для всех узлов) в монотонное время процесса"""
+    return time.monotonic() - (time.time() - enqueued_at)
+
+
+def _epoch_from_monotonic(enqueued_at: float) -> float:
+    """Обратный перевод монотонного времени постановки во время эпохи"""
+    return time.time() - (time.monotonic() - enqueued_at)
+
+
+class RedisSupportQueueManager:
+    """
+    Менеджер очереди поддержки, хранящий состояние в Redis.
+
+    Повторяет асинхронный интерфейс SupportQueueManager, но очередь,
+    статусы операторов и назначения общие для всех экземпляров приложения.
+    Каждое изменение (постановка в очередь, назначение, освобождение,
+    перевод, пакетное сопоставление) выполняется одним Lua-скриптом,
+    поэтому операции атомарны без распределенных блокировок.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, key_prefix: str = CHAT_STATE_KEY_PREFIX):
+        self._redis = redis_client or aioredis.from_url(CHAT_STATE_REDIS_URL, decode_responses=True)
+        self._prefix = key_prefix
+
+        self._enqueue = self._redis.register_script(_ENQUEUE)
+        self._dequeue = self._redis.register_script(_DEQUEUE)
+        self._reprioritize = self._redis.register_script(_REPRIORITIZE)
+        self._register_operator = self._redis.register_script(_REGISTER_OPERATOR)
+        self._set_online = self._redis.register_script(_SET_ONLINE)
+        self._set_offline = self._redis.register_script(_SET_OFFLINE)
+        self._set_available = self._redis.register_script(_SET_AVAILABLE)
+        self._assign = self._redis.register_script(_ASSIGN)
+        self._release = self._redis.register_script(_RELEASE)
+        self._transfer = self._redis.register_script(_TRANSFER)
+        self._revert_transfer = self._redis.register_script(_REVERT_TRANSFER)
+        self._match = self._redis.register_script(_MATCH)
+        self._revert = self._redis.register_script(_REVERT)
+        self._restore_assignment = self._redis.register_script(_RESTORE_ASSIGNMENT)
+
+        # Обработчик пакетов автоматических назначений (БД, Kafka, WebSocket)
+        self._batch_assignment_handler: Optional[BatchAssignmentHandler] = None
+
+        self._running = False
+
+    def set_batch_assignment_handler(self, handler: Optional[BatchAssignmentHandler]):
+        """Установка обработчика пакетов автоматических назначений"""
+        self._batch_assignment_handler = handler
+
+    async def start(self):
+        """Запуск менеджера очереди"""
+        if not self._running:
+            await self._redis.ping()
+            self._running = True
+            logger.info("Менеджер очереди (Redis) запущен")
+
+    async def stop(self):
+        """Остановка менеджера очереди"""
+        if self._running:
+            self._running = False
+            logger.info("Менеджер очереди (Redis) остановлен")
+
+    def _key(self, *parts) -> str:
+        return self._prefix + ':'.join(str(part) for part in parts)
+
+    async def _call(self, script, *args):
+        return await script(keys=[], args=[self._prefix, *args])
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now(UTC).isoformat()
+
+    # Управление операторами
+
+    async def register_operator(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5):
+        """Регистрация оператора в системе"""
+        if await self._call(self._register_operator, operator_id, operator_type, max_concurrent_chats, self._now()):
+            logger.info(f"Оператор {operator_id} ({operator_type}) зарегистрирован")
+
+    async def set_operator_online(self, operator_id: int, operator_type: str, max_concurrent_chats: int = 5):
+        """Перевод оператора в онлайн"""
+        await self._call(self._set_online, operator_id, operator_type, max_concurrent_chats, self._now())
+        logger.info(f"Оператор {operator_id} ({operator_type}) в онлайн")
+
+        # Проверяем, есть ли ожидающие клиенты
+        await self._try_auto_assign_clients()
+
+    async def set_operator_offline(self, operator_id: int):
+        """Перевод оператора в оффлайн"""
+        chats = await self._call(self._set_offline, operator_id)
+        if chats is None:
+            return
+
+        # Переводим все активные чаты оператора другим операторам
+        for chat_id in chats:
+            await self._transfer_chat_to_available_operator(int(chat_id), operator_id, "operator_offline")
+
+        logger.info(f"Оператор {operator_id} перешел в оффлайн")
+
+    async def set_operator_busy(self, operator_id: int, busy: bool = True):
+        """Установка статуса занятости оператора"""
+        if await self._call(self._set_available, operator_id, 0 if busy else 1):
+            status = "занят" if busy else "доступен"
+            logger.info(f"Оператор {operator_id} {status}")
+
+    async def get_operator(self, operator_id: int) -> Optional[OperatorStatus]:
+        """Получение статуса оператора (снимок из Redis)"""
+        operators = await self._load_operators([operator_id])
+        return operators[0] if operators else None
+
+    async def list_operators(self) -> List[OperatorStatus]:
+        """Получение статусов всех зарегистрированных операторов"""
+        operator_ids = await self._redis.smembers(self._key('operators'))
+        return await self._load_operators(sorted(int(operator_id) for operator_id in operator_ids))
+
+    async def _load_operators(self, operator_ids: List[int]) -> List[OperatorStatus]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for operator_id in operator_ids:
+                pipe.hgetall(self._key('operator', operator_id))
+                pipe.smembers(self._key('operator', operator_id, 'chats'))
+            replies = await pipe.execute()
+
+        operators = []
+        for operator_id, data, chats in zip(operator_ids, replies[::2], replies[1::2]):
+            if not data:
+                continue
+            operators.append(OperatorStatus(
+                operator_id=operator_id,
+                operator_type=data['operator_type'],
+                is_online=data['is_online'] == '1',
+                is_available=data['is_available'] == '1',
+                max_concurrent_chats=int(data['max_concurrent_chats']),
+                current_chats={int(chat_id) for chat_id in chats},
+                last_active_at=_monotonic_from_epoch(datetime.fromisoformat(data['last_activity']).timestamp())
+            ))
+        return operators
+
+    async def _least_loaded_operator_id(self, operator_type: str) -> Optional[int]:
+        operator_ids = await self._redis.zrange(self._key('available', operator_type), 0, 0)
+        return int(operator_ids[0]) if operator_ids else None
+
+    # Управление очередью клиентов
+
+    async def add_client_to_queue(self, client_id: int, chat_id: int, priority: int = 0, metadata: Optional[Dict] = None):
+        """Добавление клиента в очередь ожидания"""
+        added = await self._call(
+            self._enqueue, client_id, chat_id, int(priority), self._now(),
+            repr(time.time()), json.dumps(metadata or {}, default=str)
+        )
+        if added:
+            logger.info(f"Клиент {client_id} добавлен в очередь (приоритет: {priority})")
+
+            # Пытаемся сразу назначить доступного оператора тем же пакетным проходом:
+            # назначение сохраняется в БД и уходит в Kafka через обработчик пакета
+            await self._try_auto_assign_clients()
+
+    async def remove_client_from_queue(self, client_id: int) -> bool:
+        """Удаление клиента из очереди"""
+        if await self._call(self._dequeue, client_id):
+            logger.info(f"Клиент {client_id} удален из очереди")
+            return True
+        return False
+
+    async def update_queue_position(self, client_id: int, new_priority: int) -> int:
+        """Обновление приоритета клиента в очереди"""
+        if await self._call(self._reprioritize, client_id, int(new_priority)):
+            logger.info(f"Приоритет клиента {client_id} изменен на {new_priority}")
+
+        return await self.get_queue_position(client_id)
+
+    async def get_queue_position(self, client_id: int) -> int:
+        """Получение позиции клиента в очереди"""
+        rank = await self._redis.zrank(self._key('queue'), client_id)
+        return rank + 1 if rank is not None else -1
+
+    async def is_client_waiting(self, client_id: int) -> bool:
+        """Находится ли клиент в очереди"""
+        return bool(await self._redis.exists(self._key('client', client_id)))
+
+    async def list_waiting_clients(self, limit: Optional[int] = None) -> List[QueuedClient]:
+        """Клиенты в порядке очереди"""
+        client_ids = await self._redis.zrange(self._key('queue'), 0, -1 if limit is None else limit - 1)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for client_id in client_ids:
+                pipe.hgetall(self._key('client', client_id))
+            records = await pipe.execute()
+
+        return [
+            self._queued_client(int(client_id), data)
+            for client_id, data in zip(client_ids, records) if data
+        ]
+
+    @staticmethod
+    def _queued_client(client_id: int, data: Dict[str, str]) -> QueuedClient:
+        return QueuedClient(
+            client_id=client_id,
+            chat_id=int(data['chat_id']),
+            priority=int(data['priority']),
+            metadata=json.loads(data['metadata']) or None,
+            enqueued_at=_monotonic_from_epoch(float(data['enqueued_at']))
+        )
+
+    async def fetch_queue_status(self) -> Dict:
+        """Получение статуса очереди"""
+        operator_types = await self._redis.smembers(self._key('operator_types'))
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zcard(self._key('queue'))
+            pipe.hgetall(self._key('queue:stats'))
+            pipe.zrange(self._key('queue:age'), 0, 0, withscores=True)
+            for operator_type in operator_types:
+                pipe.zcard(self._key('available', operator_type))
+            total, stats, oldest, *available = await pipe.execute()
+
+        now = time.time()
+        average_wait_time = 0
+        if total:
+            average_wait_time = max(0.0, now - float(stats.get('enqueued_sum', 0)) / total)
+
+        return {
+            'total_waiting': total,
+            'average_wait_time': average_wait_time,
+            'max_wait_time': max(0.0, now - oldest[0][1]) if oldest else 0,
+            'available_operators': sum(available),
+            'queue_by_priority': {
+                int(name.split(':', 1)[1]): int(value)
+                for name, value in stats.items() if name.startswith('priority:')
+            }
+        }
+
+    # Управление назначениями чатов
+
+    async def assign_chat_to_operator(self, chat_id: int, operator_id: int, client_id: int) -> bool:
+        """Назначение чата оператору"""
+        if not await self._call(self._assign, chat_id, operator_id, client_id, self._now()):
+            return False
+
+        logger.info(f"Чат {chat_id} назначен оператору {operator_id}")
+        return True
+
+    async def release_operator_from_chat(self, chat_id: int) -> bool:
+        """Освобождение оператора от чата"""
+        released = await self._call(self._release, chat_id, self._now())
+        if released is None:
+            return False
+
+        operator_id, can_accept_chat = released
+        logger.info(f"Оператор {operator_id} освобожден от чата {chat_id}")
+
+        # Если оператор снова доступен, проверяем очередь
+        if can_accept_chat:
+            await self._try_auto_assign_clients()
+        return True
+
+    async def transfer_chat(self, chat_id: int, new_operator_id: int, reason: str = "manual_transfer") -> bool:
+        """Перевод чата другому оператору"""
+        old_operator_id = await self._call(self._transfer, chat_id, new_operator_id, self._now())
+        if old_operator_id is None:
+            return False
+
+        logger.info(f"Чат {chat_id} переведен с оператора {old_operator_id} на {new_operator_id}, причина: {reason}")
+        return True
+
+    async def revert_transfer(self, chat_id: int, old_operator_id: int, new_operator_id: int) -> bool:
+        """Откат перевода чата: чат возвращается прежнему оператору без проверки его емкости"""
+        if not await self._call(self._revert_transfer, chat_id, old_operator_id, new_operator_id, self._now()):
+            return False
+
+        logger.warning(f"Перевод чата {chat_id} на оператора {new_operator_id} откачен")
+        return True
+
+    async def get_chat_operator(self, chat_id: int) -> Optional[int]:
+        """Оператор, которому назначен чат"""
+        operator_id = await self._redis.hget(self._key('assignments'), chat_id)
+        return int(operator_id) if operator_id is not None else None
+
+    async def list_chat_assignments(self) -> Dict[int, int]:
+        """Все назначения chat_id -> operator_id"""
+        assignments = await self._redis.hgetall(self._key('assignments'))
+        return {int(chat_id): int(operator_id) for chat_id, operator_id in assignments.items()}
+
+    # Автоматическое назначение
+
+    async def _try_assign_operator_to_client(self, client_id: int, chat_id: int):
+        """Попытка назначить оператора клиенту"""
+        operator_id = await self._least_loaded_operator_id("support")
+
+        # Скрипт назначения перепроверяет доступность оператора атомарно
+        if operator_id is not None and await self.assign_chat_to_operator(chat_id, operator_id, client_id):
+            return operator_id
+
+        return None
+
+    async def _try_auto_assign_clients(self):
+        """Попытка автоматически назначить операторов ожидающим клиентам"""
+        assignments = await self.match_waiting_clients("support")
+        if not assignments:
+            return
+
+        logger.info(f"Автоматически назначено {len(assignments)} клиентов операторам")
+
+        if self._batch_assignment_handler:
+            try:
+                await self._batch_assignment_handler(assignments)
+            except Exception as e:
+                logger.error(f"Ошибка обработки пакета назначений: {e}")
+
+    async def match_waiting_clients(self, operator_type: str = "support",
+                                    limit: Optional[int] = None) -> List[ChatAssignment]:
+        """
+        Пакетное сопоставление ожидающих клиентов со свободными операторами.
+
+        Весь проход выполняется одним Lua-скриптом: клиенты с головы очереди
+        по одному назначаются наименее загруженному оператору указанного типа.
+        """
+        matched = await self._call(self._match, operator_type, limit or 0, self._now())
+
+        assignments = []
+        for client_id, operator_id, record in matched:
+            client = self._queued_client(int(client_id), _pairs(record))
+            assignments.append(ChatAssignment(
+                chat_id=client.chat_id,
+                client_id=client.client_id,
+                operator_id=int(operator_id),
+                operator_type=operator_type,
+                client=client
+            ))
+        return assignments
+
+    async def revert_assignments(self, assignments: List[ChatAssignment]):
+        """Откат пакета назначений: чаты снимаются с операторов, клиенты возвращаются в очередь"""
+        for assignment in assignments:
+            client = assignment.client
+            await self._call(
+                self._revert, assignment.chat_id, assignment.operator_id, assignment.client_id,
+                int(client.priority), client.timestamp.isoformat(),
+                repr(_epoch_from_monotonic(client.enqueued_at)),
+                json.dumps(client.metadata, default=str)
+            )
+
+        logger.warning(f"Откачено {len(assignments)} автоматических назначений")
+
+    async def restore_state(self, waiting_clients: List[QueuedClient],
+                            assignments: List[Tuple[int, int, str]]):
+        """
+        Восстановление очереди и назначений из снимка БД.
+
+        Состояние в Redis переживает рестарт приложения, поэтому записи, которые
+        уже есть в Redis, не перезаписываются. Все скрипты отправляются одним
+        конвейером.
+        """
+        now = self._now()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for chat_id, operator_id, operator_type in assignments:
+                await self._restore_assignment(
+                    keys=[], args=[self._prefix, chat_id, operator_id, operator_type, now], client=pipe
+                )
+            for client in waiting_clients:
+                await self._enqueue(
+                    keys=[], client=pipe, args=[
+                        self._prefix, client.client_id, client.chat_id, int(client.priority),
+                        client.timestamp.isoformat(), repr(_epoch_from_monotonic(client.enqueued_at)),
+                        json.dumps(client.metadata, default=str)
+                    ]
+                )
+            results = await pipe.execute()
+
+        restored = sum(results[len(assignments):])
+        logger.info(f"Восстановлено {restored} клиентов в очереди и {sum(results[:len(assignments)])} назначений чатов")
+
+    async def _transfer_chat_to_available_operator(self, chat_id: int, offline_operator_id: int, reason: str):
+        """Перевод чата доступному оператору при уходе оператора"""
+        new_operator_id = await self._least_loaded_operator_id("support")
+
+        if new_operator_id is not None and await self.transfer_chat(chat_id, new_operator_id, reason):
+            logger.info(f"Чат {chat_id} автоматически переведен на оператора {new_operator_id}")
+        else:
+            logger.warning(f"Нет доступных операторов для перевода чата {chat_id}")
+            await self.release_operator_from_chat(chat_id)
@@ -0,0 +1,22 @@
+"""
+Блокировки с разбиением по ключам (lock striping) для менеджеров чата поддержки
+"""
+import asyncio
+from typing import Hashable
+
+
+class StripedLock:
+    """
+    Фиксированный набор asyncio.Lock, распределенных по ключам.
+
+    Операции над одним ключом (чат, клиент) выполняются последовательно,
+    операции над разными ключами - параллельно, кроме редких совпадений
+    полосы. Память не растет с количеством ключей.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def __call__(self, key: Hashable) -> asyncio.Lock:
+        """Блокировка для ключа: `async with locks(chat_id): ...`"""
+        return self._locks[hash(key) % len(self._locks)]
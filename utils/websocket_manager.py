@@ -3,25 +3,67 @@ WebSocket менеджер для чата поддержки с интегра
 """
 import json
 import asyncio
-from typing import Dict, Set, List, Optional, Any
+import time
+from typing import Callable, Dict, Set, List, Optional, Any, Iterable, Tuple
 from fastapi import WebSocket
 import logging
 
+from config.chat_config import WEBSOCKET_SEND_TIMEOUT
+from utils.outbound_queue import Delivery, OutboundQueue, coalesce_key
+
 logger = logging.getLogger(__name__)
 
 
+def _encode(message: Dict[str, Any]) -> str:
+    """Сериализация сообщения в текстовый кадр (как send_json у Starlette)"""
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class LatencyMetric:
+    """Метрика задержки: количество, среднее, максимум и последнее значение"""
+    __slots__ = ('count', 'total', 'max', 'last', 'failed_recipients')
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.failed_recipients = 0
+    
+    def observe(self, seconds: float, failed: int = 0):
+        """Учет одного измерения"""
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.failed_recipients += failed
+    
+    def snapshot(self) -> Dict[str, float]:
+        """Текущие значения метрики (в миллисекундах)"""
+        return {
+            'count': self.count,
+            'avg_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'max_ms': self.max * 1000,
+            'last_ms': self.last * 1000,
+            'failed_recipients': self.failed_recipients
+        }
+
+
 class WebSocketConnectionManager:
     """Менеджер WebSocket соединений для чата поддержки"""
     
     def __init__(self):
-        # Активные соединения пользователей
-        self.user_connections: Dict[int, WebSocket] = {}
+        # Активные соединения пользователей (у пользователя может быть несколько
+        # сокетов: вкладки, телефон и веб). Кортеж вместо множества - обычно
+        # сокетов 1-2, кортеж компактнее и безопасен для обхода во время рассылки
+        self.user_connections: Dict[int, Tuple[WebSocket, ...]] = {}
         
         # Соединения по чатам (chat_id -> set of user_ids)
         self.chat_connections: Dict[int, Set[int]] = {}
         
-        # Соединения операторов (operator_id -> websocket)
-        self.operator_connections: Dict[int, WebSocket] = {}
+        # Соединения операторов (operator_id -> сокеты)
+        self.operator_connections: Dict[int, Tuple[WebSocket, ...]] = {}
         
         # Соединения по ролям (role -> set of user_ids)
         self.role_connections: Dict[str, Set[int]] = {
@@ -31,124 +73,290 @@ class WebSocketConnectionManager:
             'admin': set()
         }
         
-        # Метаданные соединений
+        # Обратные индексы: чаты пользователя и его отслеживаемая роль
+        # (отключение и выход из чата - O(чатов пользователя), без обхода всех чатов)
+        self.user_chats: Dict[int, Set[int]] = {}
+        self.user_roles: Dict[int, str] = {}
+        
+        # Метаданные соединений (хранятся только непустые - у большинства соединений их нет)
         self.connection_metadata: Dict[int, Dict[str, Any]] = {}
         
+        # Исходящие очереди сокетов (только с неотправленными кадрами)
+        self._outboxes: Dict[WebSocket, OutboundQueue] = {}
+        self.dropped_frames = 0
+        self.coalesced_frames = 0
+        self.slow_consumers_closed = 0
+        
+        # Задержка рассылок (сериализация и постановка в очереди) и доставки кадров
+        self.broadcast_latency = LatencyMetric()
+        self.delivery_latency = LatencyMetric()
+        
+        # Слушатель появления/исчезновения локальных участников чата (подписки между узлами)
+        self._chat_presence_listener: Optional[Callable[[int, bool], None]] = None
+        
         # Блокировка для потокобезопасности
         self._lock = asyncio.Lock()
     
-    async def connect_user(self, user_id: int, websocket: WebSocket, user_role: str, metadata: Optional[Dict] = None):
-        """Подключение пользователя"""
+    def set_chat_presence_listener(self, listener: Optional[Callable[[int, bool], None]]):
+        """
+        Установка слушателя локального присутствия в чатах.
+        
+        Слушатель вызывается синхронно (под блокировкой менеджера) с (chat_id, True),
+        когда в чате появляется первый локальный участник, и с (chat_id, False),
+        когда уходит последний. Долгую работу слушатель должен выносить в задачу.
+        """
+        self._chat_presence_listener = listener
+    
+    async def connect_user(self, user_id: int, websocket: WebSocket, user_role: str, metadata: Optional[Dict] = None) -> int:
+        """
+        Подключение сокета пользователя.
+        
+        Предыдущие сокеты пользователя остаются открытыми. Возвращает
+        количество открытых сокетов пользователя.
+        """
         async with self._lock:
             await websocket.accept()
             
-            # Закрываем предыдущее соединение если есть
-            if user_id in self.user_connections:
-                try:
-                    await self.user_connections[user_id].close()
-                except:
-                    pass
+            sockets = self.user_connections.get(user_id, ()) + (websocket,)
+            self.user_connections[user_id] = sockets
+            if metadata:
+                self.connection_metadata[user_id] = metadata
+            else:
+                self.connection_metadata.pop(user_id, None)
             
-            self.user_connections[user_id] = websocket
-            self.connection_metadata[user_id] = metadata or {}
+            # При переподключении с другой ролью убираем пользователя из прежней
+            previous_role = self.user_roles.pop(user_id, None)
+            if previous_role is not None and previous_role != user_role:
+                self.role_connections[previous_role].discard(user_id)
+                self.operator_connections.pop(user_id, None)
             
             # Добавляем в соответствующую роль
             if user_role in self.role_connections:
                 self.role_connections[user_role].add(user_id)
+                self.user_roles[user_id] = user_role
                 
                 # Если это оператор, добавляем в список операторов
                 if user_role in ['support', 'lawyer', 'salesman']:
-                    self.operator_connections[user_id] = websocket
+                    self.operator_connections[user_id] = sockets
             
-            logger.info(f"Пользователь {user_id} ({user_role}) подключен")
+            logger.info(f"Пользователь {user_id} ({user_role}) подключен, сокетов: {len(sockets)}")
+            return len(sockets)
     
-    async def disconnect_user(self, user_id: int):
-        """Отключение пользователя"""
+    async def disconnect_user(self, user_id: int, websocket: Optional[WebSocket] = None) -> int:
+        """
+        Отключение сокета пользователя (или всех его сокетов, если сокет не указан).
+        
+        Присутствие считается по сокетам: пользователь удаляется из ролей и
+        чатов только при закрытии последнего сокета. Возвращает количество
+        оставшихся сокетов.
+        """
         async with self._lock:
-            if user_id in self.user_connections:
-                del self.user_connections[user_id]
+            sockets = self.user_connections.get(user_id, ())
+            remaining = tuple(s for s in sockets if s is not websocket) if websocket is not None else ()
+            for closed in sockets:
+                if closed not in remaining:
+                    self._drop_outbox(closed)
             
-            if user_id in self.connection_metadata:
-                del self.connection_metadata[user_id]
+            if remaining:
+                self.user_connections[user_id] = remaining
+                if user_id in self.operator_connections:
+                    self.operator_connections[user_id] = remaining
+                logger.info(f"Пользователь {user_id} закрыл сокет, осталось: {len(remaining)}")
+                return len(remaining)
             
-            if user_id in self.operator_connections:
-                del self.operator_connections[user_id]
+            self.user_connections.pop(user_id, None)
+            self.connection_metadata.pop(user_id, None)
+            self.operator_connections.pop(user_id, None)
             
-            # Удаляем из всех ролей
-            for role_set in self.role_connections.values():
-                role_set.discard(user_id)
+            # Удаляем из роли пользователя
+            role = self.user_roles.pop(user_id, None)
+            if role is not None:
+                self.role_connections[role].discard(user_id)
             
-            # Удаляем из всех чатов
-            for chat_users in self.chat_connections.values():
-                chat_users.discard(user_id)
+            # Удаляем из чатов пользователя
+            for chat_id in self.user_chats.pop(user_id, ()):
+                self._discard_chat_participant(chat_id, user_id)
             
             logger.info(f"Пользователь {user_id} отключен")
+            return 0
     
     async def join_chat(self, user_id: int, chat_id: int):
         """Присоединение пользователя к чату"""
         async with self._lock:
-            if chat_id not in self.chat_connections:
-                self.chat_connections[chat_id] = set()
-            
-            self.chat_connections[chat_id].add(user_id)
+            chat_users = self.chat_connections.get(chat_id)
+            if chat_users is None:
+                chat_users = self.chat_connections[chat_id] = set()
+                if self._chat_presence_listener is not None:
+                    self._chat_presence_listener(chat_id, True)
+            chat_users.add(user_id)
+            self.user_chats.setdefault(user_id, set()).add(chat_id)
             logger.info(f"Пользователь {user_id} присоединился к чату {chat_id}")
     
     async def leave_chat(self, user_id: int, chat_id: int):
         """Выход пользователя из чата"""
         async with self._lock:
-            if chat_id in self.chat_connections:
-                self.chat_connections[chat_id].discard(user_id)
-                
-                # Удаляем пустые чаты
-                if not self.chat_connections[chat_id]:
-                    del self.chat_connections[chat_id]
+            user_chats = self.user_chats.get(user_id)
+            if user_chats is not None:
+                user_chats.discard(chat_id)
+                if not user_chats:
+                    del self.user_chats[user_id]
+            
+            self._discard_chat_participant(chat_id, user_id)
             
             logger.info(f"Пользователь {user_id} вышел из чата {chat_id}")
     
-    async def send_to_user(self, user_id: int, message: Dict[str, Any]) -> bool:
-        """Отправка сообщения конкретному пользователю"""
-        if user_id in self.user_connections:
-            try:
-                websocket = self.user_connections[user_id]
-                await websocket.send_json(message)
-                return True
-            except Exception as e:
-                logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-                # Удаляем неработающее соединение
-                await self.disconnect_user(user_id)
-        return False
+    def _discard_chat_participant(self, chat_id: int, user_id: int):
+        """Удаление участника из чата (пустые чаты удаляются)"""
+        chat_users = self.chat_connections.get(chat_id)
+        if chat_users is not None:
+            chat_users.discard(user_id)
+            if not chat_users:
+                del self.chat_connections[chat_id]
+                if self._chat_presence_listener is not None:
+                    self._chat_presence_listener(chat_id, False)
+    
+    async def send_to_user(self, user_id: int, message: Dict[str, Any],
+                           websocket: Optional[WebSocket] = None) -> bool:
+        """
+        Отправка сообщения конкретному пользователю (во все его сокеты
+        или только в websocket, если он указан).
+        
+        Сообщение ставится в исходящие очереди сокетов и отправляется их
+        задачами-писателями, поэтому вызывающий код не ждет сеть.
+        """
+        sockets = self.user_connections.get(user_id)
+        if not sockets:
+            return False
+        if websocket is not None:
+            if websocket not in sockets:
+                return False
+            sockets = (websocket,)
+        
+        text = _encode(message)
+        key = coalesce_key(message)
+        accepted = False
+        for websocket in sockets:
+            delivery = self._enqueue(user_id, websocket, text, key)
+            if delivery == Delivery.OVERFLOW:
+                await self._close_slow_consumer(user_id, websocket)
+            elif delivery != Delivery.DROPPED:
+                accepted = True
+        return accepted
+    
+    def _enqueue(self, user_id: int, websocket: WebSocket, text: str, key=None) -> str:
+        """Постановка кадра в исходящую очередь сокета (без await)"""
+        outbox = self._outboxes.get(websocket)
+        if outbox is None:
+            outbox = self._outboxes[websocket] = OutboundQueue(websocket)
+        
+        delivery = outbox.put(text, key)
+        if delivery == Delivery.QUEUED:
+            if outbox.writer is None:
+                outbox.writer = asyncio.create_task(self._write(user_id, outbox))
+        elif delivery == Delivery.COALESCED:
+            self.coalesced_frames += 1
+        elif delivery == Delivery.DROPPED:
+            self.dropped_frames += 1
+        return delivery
+    
+    async def _write(self, user_id: int, outbox: OutboundQueue):
+        """Задача-писатель сокета: отправляет кадры по порядку, пока очередь не опустеет"""
+        websocket = outbox.websocket
+        try:
+            while outbox:
+                text, enqueued_at = outbox.pop()
+                try:
+                    await asyncio.wait_for(websocket.send_text(text), WEBSOCKET_SEND_TIMEOUT)
+                except Exception as e:
+                    logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e!r}")
+                    self.delivery_latency.observe(time.monotonic() - enqueued_at, failed=1)
+                    # Удаляем неработающий сокет (если он еще не закрыт)
+                    if websocket in self.user_connections.get(user_id, ()):
+                        await self.disconnect_user(user_id, websocket)
+                    return
+                self.delivery_latency.observe(time.monotonic() - enqueued_at)
+        finally:
+            outbox.writer = None
+            if self._outboxes.get(websocket) is outbox:
+                del self._outboxes[websocket]
+    
+    def _drop_outbox(self, websocket: WebSocket):
+        """Удаление исходящей очереди сокета с остановкой писателя"""
+        outbox = self._outboxes.pop(websocket, None)
+        if outbox is not None and outbox.writer is not None and outbox.writer is not asyncio.current_task():
+            outbox.writer.cancel()
+    
+    async def _close_slow_consumer(self, user_id: int, websocket: WebSocket):
+        """Закрытие сокета, который не успевает читать обязательные сообщения"""
+        if websocket not in self.user_connections.get(user_id, ()):
+            return
+        
+        logger.warning(f"Сокет пользователя {user_id} не успевает читать сообщения - закрываем")
+        self.slow_consumers_closed += 1
+        await self.disconnect_user(user_id, websocket)
+        try:
+            await asyncio.wait_for(websocket.close(code=1013), WEBSOCKET_SEND_TIMEOUT)
+        except Exception:
+            pass
+    
+    async def flush(self):
+        """Ожидание отправки всех исходящих кадров (корректное завершение, тесты)"""
+        while True:
+            writers = [outbox.writer for outbox in self._outboxes.values() if outbox.writer is not None]
+            if not writers:
+                return
+            await asyncio.gather(*writers, return_exceptions=True)
+    
+    async def _broadcast(self, user_ids: Iterable[int], message: Dict[str, Any], exclude_user: Optional[int] = None):
+        """
+        Рассылка сообщения пользователям: сообщение сериализуется один раз и
+        ставится в исходящие очереди получателей без ожидания сети, поэтому
+        медленное соединение не задерживает остальных. Соединения, которые
+        не успевают читать, закрываются после рассылки.
+        """
+        recipients = [
+            (user_id, websocket) for user_id in user_ids if user_id != exclude_user
+            for websocket in self.user_connections.get(user_id, ())
+        ]
+        if not recipients:
+            return
+        
+        started = time.perf_counter()
+        text = _encode(message)
+        key = coalesce_key(message)
+        overflowed = [
+            (user_id, websocket) for user_id, websocket in recipients
+            if self._enqueue(user_id, websocket, text, key) == Delivery.OVERFLOW
+        ]
+        self.broadcast_latency.observe(time.perf_counter() - started, len(overflowed))
+        
+        for user_id, websocket in overflowed:
+            await self._close_slow_consumer(user_id, websocket)
     
     async def broadcast_to_chat(self, chat_id: int, message: Dict[str, Any], exclude_user: Optional[int] = None):
         """Рассылка сообщения всем участникам чата"""
         if chat_id not in self.chat_connections:
             return
         
-        participants = self.chat_connections[chat_id].copy()
-        if exclude_user:
-            participants.discard(exclude_user)
-        
-        for user_id in participants:
-            await self.send_to_user(user_id, message)
+        await self._broadcast(tuple(self.chat_connections[chat_id]), message, exclude_user)
     
     async def broadcast_to_role(self, role: str, message: Dict[str, Any], exclude_user: Optional[int] = None):
         """Рассылка сообщения всем пользователям с определенной ролью"""
         if role not in self.role_connections:
             return
         
-        users = self.role_connections[role].copy()
-        if exclude_user:
-            users.discard(exclude_user)
-        
-        for user_id in users:
-            await self.send_to_user(user_id, message)
+        await self._broadcast(tuple(self.role_connections[role]), message, exclude_user)
     
     async def broadcast_to_operators(self, message: Dict[str, Any], operator_types: Optional[List[str]] = None):
-        """Рассылка сообщения операторам"""
+        """Рассылка сообщения операторам (одной рассылкой по всем типам)"""
         if operator_types is None:
             operator_types = ['support', 'lawyer', 'salesman']
         
+        operators = set()
         for role in operator_types:
-            await self.broadcast_to_role(role, message)
+            operators.update(self.role_connections.get(role, ()))
+        
+        await self._broadcast(operators, message)
     
     # Специализированные методы для событий чата поддержки
     
@@ -186,15 +394,26 @@ class WebSocketConnectionManager:
         }
         
         # Отправляем всем операторам поддержки кроме того, кто принял
-        operators = self.role_connections['support'].copy()
-        if except_operator:
-            operators.discard(except_operator)
+        await self.broadcast_to_role('support', message, exclude_user=except_operator)
+    
+    async def hide_clients_from_operators(self, client_ids: List[int]):
+        """Скрытие пакета клиентов от операторов одним сообщением (после автоназначения)"""
+        if not client_ids:
+            return
         
-        for operator_id in operators:
-            await self.send_to_user(operator_id, message)
+        message = {
+            'type': 'clients_taken',
+            'payload': {
+                'client_ids': client_ids
+            }
+        }
+        await self.broadcast_to_role('support', message)
     
-    async def notify_chat_assigned(self, chat_id: int, operator_id: int, client_id: int):
-        """Уведомление о назначении чата"""
+    async def notify_chat_assigned(self, chat_id: int, operator_id: int, client_id: int, chat_fanout=None):
+        """
+        Уведомление о назначении чата. Событие для участников чата рассылается
+        через chat_fanout (по всем узлам, с seq), без него - только локальным соединениям.
+        """
         # Уведомляем оператора
         operator_message = {
             'type': 'chat_assigned',
@@ -206,7 +425,11 @@ class WebSocketConnectionManager:
         }
         await self.send_to_user(operator_id, operator_message)
         
-        # Уведомляем клиента
+        # Добавляем участников в чат
+        await self.join_chat(operator_id, chat_id)
+        await self.join_chat(client_id, chat_id)
+        
+        # Уведомляем клиента как участника чата
         client_message = {
             'type': 'operator_assigned',
             'payload': {
@@ -214,15 +437,15 @@ class WebSocketConnectionManager:
                 'operator_id': operator_id
             }
         }
-        await self.send_to_user(client_id, client_message)
-        
-        # Добавляем участников в чат
-        await self.join_chat(operator_id, chat_id)
-        await self.join_chat(client_id, chat_id)
+        await (chat_fanout or self).broadcast_to_chat(chat_id, client_message, exclude_user=operator_id)
     
     async def notify_chat_transferred(self, chat_id: int, new_operator_id: int, 
-                                    previous_operator_id: int, reason: Optional[str] = None):
-        """Уведомление о переводе чата"""
+                                    previous_operator_id: int, reason: Optional[str] = None,
+                                    chat_fanout=None):
+        """
+        Уведомление о переводе чата. Событие для участников чата рассылается
+        через chat_fanout (по всем узлам, с seq), без него - только локальным соединениям.
+        """
         # Уведомляем нового оператора
         new_operator_message = {
             'type': 'chat_transferred_to_you',
@@ -255,7 +478,7 @@ class WebSocketConnectionManager:
                 'reason': reason
             }
         }
-        await self.broadcast_to_chat(chat_id, transfer_message)
+        await (chat_fanout or self).broadcast_to_chat(chat_id, transfer_message)
         
         # Обновляем участников чата
         await self.leave_chat(previous_operator_id, chat_id)
@@ -308,6 +531,7 @@ class WebSocketConnectionManager:
         """Получение статистики соединений"""
         return {
             'total_connections': len(self.user_connections),
+            'total_sockets': sum(len(sockets) for sockets in self.user_connections.values()),
             'operator_connections': len(self.operator_connections),
             'active_chats': len(self.chat_connections),
             'connections_by_role': {
@@ -315,6 +539,15 @@ class WebSocketConnectionManager:
             },
             'chat_participants': {
                 chat_id: len(users) for chat_id, users in self.chat_connections.items()
+            },
+            'broadcast_latency': self.broadcast_latency.snapshot(),
+            'delivery_latency': self.delivery_latency.snapshot(),
+            'outbound': {
+                'pending_connections': len(self._outboxes),
+                'pending_frames': sum(len(outbox) for outbox in self._outboxes.values()),
+                'dropped_frames': self.dropped_frames,
+                'coalesced_frames': self.coalesced_frames,
+                'slow_consumers_closed': self.slow_consumers_closed
             }
         }
     
@@ -322,6 +555,10 @@ class WebSocketConnectionManager:
         """Проверка, подключен ли пользователь"""
         return user_id in self.user_connections
     
+    def get_connection_metadata(self, user_id: int) -> Dict[str, Any]:
+        """Получение метаданных соединения пользователя"""
+        return self.connection_metadata.get(user_id) or {}
+    
     def get_chat_participants(self, chat_id: int) -> Set[int]:
         """Получение участников чата"""
         return self.chat_connections.get(chat_id, set()).copy()